@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""
+Compares sending email on a new connection per message against sending
+on pooled connections. Run from src/python with
+
+    python3 -m tests.bench_emailer
+"""
+
+import argparse
+import time
+
+from multiprocessing import Queue
+
+from tests.smtp_standin import StandinSMTPServer
+from utdesign_procurement.emailer import Emailer
+
+def bench(server, messages, maxMessages):
+    """
+    Send some emails through the stand-in server.
+
+    :param server: (StandinSMTPServer).
+    :param messages: (int). How many emails to send.
+    :param maxMessages: (int). The Emailer's max_messages_per_connection.
+    :return: (seconds taken, connections made)
+    """
+    emailer = Emailer(Queue(), 'admin@utdallas.edu', 'oddrun', False,
+                      smtp_host='localhost', smtp_port=server.port,
+                      smtp_ssl=False, max_messages_per_connection=maxMessages)
+
+    connections = server.connections
+    start = time.perf_counter()
+    for i in range(messages):
+        emailer.emailSend('student%s@utdallas.edu' % i, 'Benchmark', '<p>%s</p>' % i)
+    emailer.close()
+
+    return time.perf_counter() - start, server.connections - connections
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--connect-delay', type=float, default=0.02,
+                        help='seconds the server takes to accept a connection')
+    args = parser.parse_args()
+
+    server = StandinSMTPServer(connectDelay=args.connect_delay).start()
+    try:
+        for name, maxMessages in (('connection per message', 1),
+                                  ('pooled', 100)):
+            seconds, connections = bench(server, args.messages, maxMessages)
+            print('%-24s %7.3fs %8.1f msg/s %4d connections' % (
+                name, seconds, args.messages / seconds, connections))
+    finally:
+        server.stop()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Compares hashing passwords on the server threads against hashing them in
+a PasswordHasher's process pool, while a whole class logs in at once.
+Run from src/python with
+
+    python3 -m tests.bench_passwords
+"""
+
+import argparse
+import cherrypy
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utdesign_procurement.passwords import DEFAULT_PARAMS, PasswordHasher, hashRecord
+
+# how many threads CherryPy serves requests with by default
+SERVER_THREADS = 10
+
+def login(hasher, user):
+    """
+    Check a login like userLogin does.
+
+    :return: (seconds taken, True if the login was refused with a 503)
+    """
+    start = time.perf_counter()
+    try:
+        assert hasher.verify(user, 'oddrun')
+        refused = False
+    except cherrypy.HTTPError as e:
+        assert e.status == 503
+        refused = True
+    return time.perf_counter() - start, refused
+
+def otherCall(submitted):
+    """
+    Stand in for an unrelated API call, which serializes a page of requests.
+
+    :return: seconds since the call was submitted to the server threads
+    """
+    page = [{'requestNumber': i, 'vendor': 'Digikey', 'items': list(range(20))} for i in range(50)]
+    json.loads(json.dumps(page))
+    return time.perf_counter() - submitted
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+def bench(hasher, logins, calls, interval):
+    """
+    Submit a burst of logins to the server threads, along with unrelated
+    API calls submitted every interval seconds.
+
+    :return: dict of results
+    """
+    user = {'password': hashRecord('oddrun', DEFAULT_PARAMS)}
+
+    # start the hashing processes before timing
+    hasher.verify(user, 'oddrun')
+
+    with ThreadPoolExecutor(SERVER_THREADS) as server:
+        start = time.perf_counter()
+        loginFutures = [server.submit(login, hasher, user) for i in range(logins)]
+        callFutures = []
+        for i in range(calls):
+            callFutures.append(server.submit(otherCall, time.perf_counter()))
+            time.sleep(interval)
+
+        loginResults = [future.result() for future in loginFutures]
+        callLatencies = [future.result() for future in callFutures]
+        seconds = time.perf_counter() - start
+
+    accepted = [taken for taken, refused in loginResults if not refused]
+    return {
+        'seconds': seconds,
+        'accepted': len(accepted),
+        'refused': len(loginResults) - len(accepted),
+        'loginP50': percentile(accepted, 0.5),
+        'callP50': percentile(callLatencies, 0.5),
+        'callP95': percentile(callLatencies, 0.95),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.02,
+                        help='seconds between unrelated API calls')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    for name, hasher in (('server threads', PasswordHasher(workers=0)),
+                         ('process pool', PasswordHasher(workers=args.workers,
+                                                         max_pending=SERVER_THREADS - 2))):
+        try:
+            result = bench(hasher, args.logins, args.calls, args.interval)
+        finally:
+            hasher.shutdown()
+        print('%-15s %7.3fs %4d logins %4d refused, login p50 %6.3fs, '
+              'other calls p50 %6.3fs p95 %6.3fs' % (
+                  name, result['seconds'], result['accepted'], result['refused'],
+                  result['loginP50'], result['callP50'], result['callP95']))
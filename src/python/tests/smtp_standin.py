@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import socketserver
+import threading
+import time
+
+class StandinSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    A small plain text SMTP server that keeps every message it receives,
+    for testing the Emailer without sending real email.
+
+    :param port: (int). The port to listen on, or 0 for any free port.
+    :param connectDelay: (float). Seconds to wait before greeting a new
+        connection, standing in for the TLS handshake and login of a real
+        server.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, connectDelay=0):
+        super().__init__(('localhost', port), StandinSMTPHandler)
+        self.connectDelay = connectDelay
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+
+        # how many of the next MAIL commands to refuse, as a server that
+        # is temporarily unavailable would
+        self.rejectNext = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serve in a background thread.
+
+        :return: self
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StandinSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib: EHLO, AUTH, MAIL, RCPT, DATA,
+    NOOP, RSET and QUIT.
+    """
+
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode('ascii'))
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.connectDelay)
+        self.reply('220 localhost stand-in SMTP')
+
+        sender, recipients = None, []
+        for raw in self.rfile:
+            line = raw.decode('utf-8').rstrip('\r\n')
+            command = line[:4].upper()
+
+            if command in ('EHLO', 'HELO'):
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command == 'AUTH':
+                self.reply('235 Authentication successful')
+            elif command == 'MAIL':
+                with self.server.lock:
+                    reject = self.server.rejectNext > 0
+                    self.server.rejectNext -= reject
+                if reject:
+                    self.reply('451 Try again later')
+                    continue
+                sender, recipients = line[10:].strip('<> '), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line[8:].strip('<> '))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for raw in self.rfile:
+                    if raw in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(raw.decode('utf-8'))
+                with self.server.lock:
+                    self.server.messages.append({
+                        'from': sender,
+                        'to': recipients,
+                        'data': ''.join(data)
+                    })
+                self.reply('250 OK')
+            elif command in ('NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
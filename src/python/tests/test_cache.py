@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import pymongo as pm
+
+from unittest import TestCase
+
+from utdesign_procurement.cache import UserCache
+
+class UserCacheTester(TestCase):
+    """
+    Tests caching the role and project numbers of users.
+    """
+
+    def setUp(self):
+        self.now = 0
+        self.colUsers = pm.MongoClient()['procurement']['test_users']
+        self.colUsers.delete_many({})
+        self.colUsers.insert_one({
+            'email': 'student@utdallas.edu',
+            'role': 'student',
+            'projectNumbers': [1],
+            'status': 'current'
+        })
+
+    def tearDown(self):
+        self.colUsers.drop()
+
+    def clock(self):
+        return self.now
+
+    def test_invalidate(self):
+        """
+        A cached user is read again once invalidated, and not before.
+
+        :return:
+        """
+
+        cache = UserCache(self.colUsers, ttl=30, clock=self.clock)
+        self.assertEqual({'role': 'student', 'projectNumbers': [1]},
+                         cache.get('student@utdallas.edu'))
+
+        self.colUsers.update_one({'email': 'student@utdallas.edu'},
+                                 {'$addToSet': {'projectNumbers': 2}})
+        self.assertEqual([1], cache.get('student@utdallas.edu')['projectNumbers'])
+
+        cache.invalidate(['student@utdallas.edu'])
+        self.assertEqual([1, 2], cache.get('student@utdallas.edu')['projectNumbers'])
+
+    def test_expiry(self):
+        """
+        A cached user is read again after ttl seconds, which is how changes
+        made by other processes are seen. Removed users have no context.
+
+        :return:
+        """
+
+        cache = UserCache(self.colUsers, ttl=30, clock=self.clock)
+        self.assertIsNotNone(cache.get('student@utdallas.edu'))
+        self.assertIsNone(cache.get('nobody@utdallas.edu'))
+
+        self.colUsers.update_one({'email': 'student@utdallas.edu'},
+                                 {'$set': {'status': 'removed'}})
+        self.now = 29
+        self.assertIsNotNone(cache.get('student@utdallas.edu'))
+        self.now = 31
+        self.assertIsNone(cache.get('student@utdallas.edu'))
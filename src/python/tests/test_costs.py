@@ -10,7 +10,8 @@ from unittest import TestCase
 
 import sys
 # sys.path.insert(0, '../utdesign_procurement')
-from utdesign_procurement.utils import lenientConvertToCents
+from utdesign_procurement.apigateway import ApiGateway
+from utdesign_procurement.utils import lenientConvertToCents, STATUS_SET, SPENT_STATUS_SET
 
 def convertToDollarStr(cents):
     cents = int(cents)
@@ -47,6 +48,159 @@ class CostTester(TestCase):
         for user in ["student", "manager", "admin"]:
             self.do_login(user, projectData)
 
+        # the budget ledger should agree with a full recompute
+        self.assertEqual([], ApiGateway(email_handler=None).reconcileBudgets([844]))
+
+    def test_budget_aggregation(self):
+        """
+        Test that the budgets computed by aggregation are the same as those
+        of the old formula, which scanned each project's requests and costs
+        one at a time.
+
+        :return:
+        """
+
+        # connect to MongoDB
+        client = pm.MongoClient()
+        db = client['procurement']
+        self.colCosts = db['costs']
+        self.colProjects = db['projects']
+        self.colRequests = db['requests']
+
+        projectNumbers = [98001, 98002, 98003]
+        query = {"projectNumber": {"$in": projectNumbers}}
+        for col in (self.colProjects, self.colRequests, self.colCosts):
+            col.delete_many(query)
+
+        try:
+            for projectNumber in projectNumbers:
+                self.colProjects.insert_one({
+                    "projectNumber": projectNumber,
+                    "defaultBudget": 100000,
+                    "status": "active"
+                })
+
+            # the first project has a request in every status, the second
+            # one in every spent status, and the third has none
+            requests = []
+            for i, status in enumerate(sorted(STATUS_SET | SPENT_STATUS_SET)):
+                requests.append({"projectNumber": 98001, "status": status,
+                                 "requestTotal": 100 * (i + 1)})
+            for i, status in enumerate(sorted(SPENT_STATUS_SET)):
+                requests.append({"projectNumber": 98002, "status": status,
+                                 "requestTotal": 1000 * (i + 1)})
+            # a saved request doesn't have a total yet
+            requests.append({"projectNumber": 98002, "status": "saved"})
+            self.colRequests.insert_many(requests)
+
+            self.colCosts.insert_many([
+                {"projectNumber": 98001, "type": "reimbursement", "amount": 500},
+                {"projectNumber": 98001, "type": "refund", "amount": 200},
+                {"projectNumber": 98002, "type": "refund", "amount": 700},
+                {"projectNumber": 98003, "type": "reimbursement", "amount": 300},
+                {"projectNumber": 98003, "type": "new budget", "amount": 100000},
+            ])
+
+            gateway = ApiGateway(email_handler=None)
+            projects = gateway.calculateBudgets(projectNumbers)
+            self.assertEqual(sorted(projectNumbers), sorted(projects))
+
+            for projectNumber in projectNumbers:
+                available, pending = self.old_budget(projectNumber)
+                self.assertEqual(available, projects[projectNumber]["availableBudget"])
+                self.assertEqual(pending, projects[projectNumber]["pendingBudget"])
+
+                # the ledger is stored too
+                projectDoc = self.colProjects.find_one({"projectNumber": projectNumber})
+                self.assertEqual(available, projectDoc["availableBudget"])
+                self.assertEqual(pending, projectDoc["pendingBudget"])
+
+            # all projects at once gives the same answer
+            projects = gateway.calculateBudgets()
+            for projectNumber in projectNumbers:
+                self.assertEqual(self.old_budget(projectNumber),
+                                 (projects[projectNumber]["availableBudget"],
+                                  projects[projectNumber]["pendingBudget"]))
+        finally:
+            for col in (self.colProjects, self.colRequests, self.colCosts):
+                col.delete_many(query)
+
+    def test_budget_ledger_upgrade(self):
+        """
+        Test that a project stored before the budget ledger, with budgets
+        that were never kept up to date, has its ledger built when the
+        server starts.
+
+        :return:
+        """
+
+        # connect to MongoDB
+        client = pm.MongoClient()
+        db = client['procurement']
+        self.colCosts = db['costs']
+        self.colProjects = db['projects']
+        self.colRequests = db['requests']
+
+        query = {"projectNumber": 98004}
+        for col in (self.colProjects, self.colRequests, self.colCosts):
+            col.delete_many(query)
+
+        try:
+            # the stored budgets leave out the request and the refund
+            self.colProjects.insert_one({
+                "projectNumber": 98004,
+                "defaultBudget": 100000,
+                "availableBudget": 100000,
+                "pendingBudget": 100000,
+                "status": "active"
+            })
+            self.colRequests.insert_one({"projectNumber": 98004, "status": "ordered",
+                                         "requestTotal": 2500})
+            self.colCosts.insert_one({"projectNumber": 98004, "type": "refund",
+                                      "amount": 500})
+
+            ApiGateway(email_handler=None)
+
+            projectDoc = self.colProjects.find_one(query)
+            self.assertTrue(projectDoc["budgetLedger"])
+            self.assertEqual(self.old_budget(98004),
+                             (projectDoc["availableBudget"], projectDoc["pendingBudget"]))
+            self.assertEqual((98000, 98000),
+                             (projectDoc["availableBudget"], projectDoc["pendingBudget"]))
+        finally:
+            for col in (self.colProjects, self.colRequests, self.colCosts):
+                col.delete_many(query)
+
+    def old_budget(self, projectNumber):
+        """
+        Compute the budget of a project the way it was done before the
+        aggregation, by looking at each of its requests and costs.
+
+        :param projectNumber: project number
+
+        :return: (available budget, pending budget)
+        """
+
+        project = self.colProjects.find_one({"projectNumber": projectNumber})
+
+        pendingCosts = 0
+        actualCosts = 0
+        for req in self.colRequests.find({"projectNumber": projectNumber}):
+            total = req.get("requestTotal", 0)
+            if req["status"] in SPENT_STATUS_SET:
+                actualCosts += total
+            pendingCosts += total
+
+        miscCosts = 0
+        for co in self.colCosts.find({"projectNumber": projectNumber}):
+            if co["type"] == "refund":
+                miscCosts -= co["amount"]
+            elif co["type"] == "reimbursement":
+                miscCosts += co["amount"]
+
+        return (project["defaultBudget"] - actualCosts - miscCosts,
+                project["defaultBudget"] - pendingCosts - miscCosts)
+
     def do_admin_login(self):
         """
         Login as the admin.
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import tempfile
+import time
+
+from multiprocessing import Queue, Value
+from unittest import TestCase
+
+from tests.smtp_standin import StandinSMTPServer
+from datetime import datetime, timedelta
+from utdesign_procurement.emailer import EmailHandler, Emailer, TemplateCache
+from utdesign_procurement.outbox import Outbox
+
+class FakeClock(object):
+    """
+    A clock for an Outbox that only moves when it is advanced. The time is
+    shared with the email workers, so it can be advanced while they run.
+    """
+
+    def __init__(self, start=None):
+        self.start = start if start is not None else datetime.now()
+        self.offset = Value('d', 0)
+
+    def __call__(self):
+        return self.start + timedelta(seconds=self.offset.value)
+
+    def advance(self, seconds):
+        with self.offset.get_lock():
+            self.offset.value += seconds
+
+class EmailerTester(TestCase):
+    """
+    Tests sending email through a stand-in SMTP server.
+    """
+
+    def setUp(self):
+        self.server = StandinSMTPServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def make_emailer(self, **smtp):
+        """
+        Make an Emailer that sends to the stand-in server.
+
+        :return: Emailer
+        """
+        return Emailer(Queue(), 'admin@utdallas.edu', 'oddrun', False,
+                       smtp_host='localhost', smtp_port=self.server.port,
+                       smtp_ssl=False, **smtp)
+
+    def make_outbox(self, **kwargs):
+        """
+        Make an empty Outbox in a test collection.
+
+        :return: Outbox
+        """
+        outbox = Outbox(collection='test_outbox', **kwargs)
+        outbox.collection.drop()
+        return outbox
+
+    def make_handler(self, outbox=None, **kwargs):
+        """
+        Make an EmailHandler that sends to the stand-in server.
+
+        :return: EmailHandler
+        """
+        return EmailHandler('admin@utdallas.edu', 'oddrun', False,
+                            os.path.join(os.path.dirname(__file__), '..', '..', 'smtp'),
+                            outbox=outbox or self.make_outbox(),
+                            smtp_host='localhost', smtp_port=self.server.port,
+                            smtp_ssl=False, **kwargs)
+
+    def wait_for(self, condition, timeout=10):
+        """
+        Wait until condition() is true, and fail the test if it isn't
+        within timeout seconds.
+
+        :return:
+        """
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('timed out after %s seconds' % timeout)
+            time.sleep(0.01)
+
+    def test_pooled_connection(self):
+        """
+        Emails share a connection until max_messages_per_connection of them
+        have been sent on it.
+
+        :return:
+        """
+
+        emailer = self.make_emailer(max_messages_per_connection=3)
+        for i in range(7):
+            emailer.emailSend('student%s@utdallas.edu' % i, 'Test', '<p>%s</p>' % i)
+        emailer.close()
+
+        self.assertEqual(3, self.server.connections)
+        self.assertEqual(['student%s@utdallas.edu' % i for i in range(7)],
+                         [message['to'][0] for message in self.server.messages])
+
+    def test_dropped_connection(self):
+        """
+        An email is still sent when the server has dropped the pooled
+        connection since the last email.
+
+        :return:
+        """
+
+        emailer = self.make_emailer(keepalive=0)
+        emailer.emailSend('student@utdallas.edu', 'First', '<p>1</p>')
+
+        # drop the connection without the pool knowing
+        emailer.pool._idle[0].server.sock.shutdown(socket.SHUT_RDWR)
+
+        emailer.emailSend('student@utdallas.edu', 'Second', '<p>2</p>')
+        emailer.close()
+
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual(2, len(self.server.messages))
+
+    def test_workers(self):
+        """
+        Several workers share the queue, every email is sent before die()
+        returns, and every worker stops.
+
+        :return:
+        """
+
+        handler = self.make_handler(workers=3)
+        handler.start()
+
+        for i in range(9):
+            handler.send('student%s@utdallas.edu' % i, 'Test', '<p>%s</p>' % i)
+        handler.die()
+
+        self.assertEqual(['student%s@utdallas.edu' % i for i in range(9)],
+                         sorted(message['to'][0] for message in self.server.messages))
+
+        # however the emails were shared out, each worker connected at most
+        # once, and reused its connection
+        self.assertGreaterEqual(self.server.connections, 1)
+        self.assertLessEqual(self.server.connections, 3)
+
+        stats = handler.workerStats()
+        self.assertEqual([0, 1, 2], [worker['worker'] for worker in stats])
+        self.assertEqual(9, sum(worker['sent'] for worker in stats))
+        self.assertFalse(any(worker['alive'] for worker in stats))
+
+    def test_lanes(self):
+        """
+        Security email goes before normal email, which goes before bulk
+        email, however long the other email has waited, except that bulk
+        email gets one claim in every bulkShare claims.
+
+        :return:
+        """
+
+        now = [datetime(2020, 1, 1)]
+        outbox = self.make_outbox(clock=lambda: now[0], lease=3600, bulkShare=3)
+
+        outbox.put('bulk@utdallas.edu', 'Bulk', '', lane='bulk')
+        outbox.put('normal@utdallas.edu', 'Normal', '')
+        now[0] += timedelta(seconds=3600)
+        outbox.put('security@utdallas.edu', 'Security', '', lane='security')
+        self.assertEqual(['security@utdallas.edu', 'normal@utdallas.edu', 'bulk@utdallas.edu'],
+                         [outbox.claim()['to'] for i in range(3)])
+
+        for i in range(2):
+            outbox.put('bulk%s@utdallas.edu' % i, 'Bulk', '', lane='bulk')
+        for i in range(4):
+            outbox.put('normal%s@utdallas.edu' % i, 'Normal', '')
+        self.assertEqual(['normal0@utdallas.edu', 'normal1@utdallas.edu', 'bulk0@utdallas.edu',
+                          'normal2@utdallas.edu', 'normal3@utdallas.edu', 'bulk1@utdallas.edu'],
+                         [outbox.claim()['to'] for i in range(6)])
+
+    def test_backoff(self):
+        """
+        A failed email is retried after a backoff that doubles every
+        attempt, and is marked failed after its last attempt.
+
+        :return:
+        """
+
+        now = [datetime(2020, 1, 1)]
+        outbox = self.make_outbox(clock=lambda: now[0], backoff=10, maxAttempts=3)
+        _id = outbox.put('student@utdallas.edu', 'Test', '')
+
+        for delay in (10, 20):
+            outbox.failed(outbox.claim(), 'error')
+            message = outbox.collection.find_one({'_id': _id})
+            self.assertEqual('queued', message['status'])
+            self.assertEqual(now[0] + timedelta(seconds=delay), message['nextAttempt'])
+
+            # not due yet
+            self.assertIsNone(outbox.claim())
+            now[0] = message['nextAttempt']
+
+        outbox.failed(outbox.claim(), 'error')
+        message = outbox.collection.find_one({'_id': _id})
+        self.assertEqual('failed', message['status'])
+        self.assertEqual(3, message['attempts'])
+        self.assertIsNone(outbox.claim())
+
+    def test_retry(self):
+        """
+        An email the SMTP server refuses is sent on a later attempt.
+
+        :return:
+        """
+
+        self.server.rejectNext = 2
+        outbox = self.make_outbox(backoff=0.1)
+        handler = self.make_handler(outbox=outbox, workers=1)
+        handler.start()
+        handler.send('student@utdallas.edu', 'Test', '<p>retry</p>')
+
+        # wait for the retries, since die() doesn't wait for them
+        self.wait_for(lambda: self.server.messages)
+        handler.die()
+
+        self.assertEqual(1, len(self.server.messages))
+        message = outbox.collection.find_one()
+        self.assertEqual('sent', message['status'])
+        self.assertEqual(3, message['attempts'])
+        self.assertEqual(2, handler.workerStats()[0]['failed'])
+
+    def test_crash_recovery(self):
+        """
+        Emails queued before a restart are sent after it, and an email
+        claimed by a worker that died is sent once its lease runs out.
+
+        :return:
+        """
+
+        clock = FakeClock()
+        outbox = self.make_outbox(clock=clock, lease=60)
+        outbox.put('queued@utdallas.edu', 'Queued', '<p>queued</p>')
+        outbox.put('claimed@utdallas.edu', 'Claimed', '<p>claimed</p>', lane='security')
+
+        # a worker claims an email, then dies without sending it
+        self.assertEqual('claimed@utdallas.edu', outbox.claim()['to'])
+        clock.advance(60)
+
+        handler = self.make_handler(outbox=outbox, workers=1)
+        handler.start()
+        handler.die()
+
+        self.assertEqual(['claimed@utdallas.edu', 'queued@utdallas.edu'],
+                         [message['to'][0] for message in self.server.messages])
+        self.assertEqual(2, outbox.collection.count_documents({'status': 'sent'}))
+
+    def test_batching(self):
+        """
+        Emails with the same content are sent in one SMTP transaction, up
+        to max_recipients_per_message recipients.
+
+        :return:
+        """
+
+        outbox = self.make_outbox()
+        outbox.put(['a1@utdallas.edu', 'a2@utdallas.edu'], 'Same', '<p>same</p>')
+        outbox.put('b@utdallas.edu', 'Same', '<p>same</p>')
+        outbox.put('c@utdallas.edu', 'Same', '<p>same</p>')
+        outbox.put('d@utdallas.edu', 'Different', '<p>different</p>')
+
+        handler = self.make_handler(outbox=outbox, workers=1,
+                                    max_recipients_per_message=3)
+        handler.start()
+        handler.die()
+
+        self.assertEqual([['a1@utdallas.edu', 'a2@utdallas.edu', 'b@utdallas.edu'],
+                          ['c@utdallas.edu'],
+                          ['d@utdallas.edu']],
+                         [message['to'] for message in self.server.messages])
+        self.assertIn('To: undisclosed-recipients:;', self.server.messages[0]['data'])
+        self.assertEqual(4, outbox.collection.count_documents({'status': 'sent'}))
+        self.assertEqual(4, handler.workerStats()[0]['sent'])
+
+    def test_digest(self):
+        """
+        Notifications to managers and admins are held and sent as one
+        digest per recipient, while security email is sent straight away.
+
+        :return:
+        """
+
+        clock = FakeClock()
+        outbox = self.make_outbox(clock=clock)
+        handler = self.make_handler(outbox=outbox, workers=1, digest_window=60)
+
+        handler.notifyRequestManager('manager@utdallas.edu', 844, 1)
+        handler.notifyUpdateManager('manager@utdallas.edu', 844, 2)
+        handler.notifyRequestAdmin(['admin@utdallas.edu', 'manager@utdallas.edu'], 844, 3)
+        handler.userForgotPassword('manager@utdallas.edu', 'uuid', 'tomorrow')
+
+        handler.start()
+        self.wait_for(lambda: self.server.messages)
+        self.assertEqual([['manager@utdallas.edu']],
+                         [message['to'] for message in self.server.messages])
+        self.assertIn('Password Reset', self.server.messages[0]['data'])
+
+        # end the digest window, and wake the worker to send the digests
+        clock.advance(60)
+        handler.queue.put('wake')
+        self.wait_for(lambda: len(self.server.messages) == 3)
+        handler.die()
+
+        digests = {message['to'][0]: message['data'] for message in self.server.messages[1:]}
+        self.assertEqual({'manager@utdallas.edu', 'admin@utdallas.edu'}, set(digests))
+        self.assertIn('You Have 3 New Notifications', digests['manager@utdallas.edu'])
+        self.assertIn('Subject: You Have 1 New Notification\n', digests['admin@utdallas.edu'].replace('\r\n', '\n'))
+        self.assertEqual(0, outbox.collection.count_documents({'status': {'$ne': 'sent'}}))
+
+    def test_templates(self):
+        """
+        Every template is compiled to the module directory up front, and a
+        template rendered again with the same arguments isn't rendered again.
+
+        :return:
+        """
+
+        templateDir = os.path.join(os.path.dirname(__file__), '..', '..', 'smtp')
+        with tempfile.TemporaryDirectory() as moduleDir:
+            templates = TemplateCache(templateDir, moduleDir)
+            templates.warm()
+
+            compiled = set(name for root, dirs, files in os.walk(moduleDir)
+                           for name in files if name.endswith('.py'))
+            self.assertEqual(set(name + '.py' for name in os.listdir(templateDir)
+                                 if name.endswith('.html')), compiled)
+
+            args = {'domain': 'localhost', 'requestNumber': 1, 'projectNumber': 844}
+            body = templates.render('notifyRequestManager.html', **args)
+            self.assertIs(body, templates.render('notifyRequestManager.html', **args))
+
+            args['requestNumber'] = 2
+            self.assertIn('#2', templates.render('notifyRequestManager.html', **args))
+
+    def test_template_directory(self):
+        """
+        Compiled templates are only kept in a directory no other user can
+        write to.
+
+        :return:
+        """
+
+        templateDir = os.path.join(os.path.dirname(__file__), '..', '..', 'smtp')
+        self.assertEqual(0o700, os.stat(TemplateCache(templateDir).module_directory).st_mode & 0o777)
+
+        with tempfile.TemporaryDirectory() as moduleDir:
+            os.chmod(moduleDir, 0o777)
+            with self.assertRaises(ValueError):
+                TemplateCache(templateDir, moduleDir)
+
+    def test_render_in_worker(self):
+        """
+        A notification is queued as its template and arguments, and is
+        rendered by the worker that sends it.
+
+        :return:
+        """
+
+        outbox = self.make_outbox()
+        handler = self.make_handler(outbox=outbox, workers=1)
+        handler.notifyRequestManager('manager@utdallas.edu', 844, 5)
+
+        message = outbox.collection.find_one()
+        self.assertEqual('notifyRequestManager.html', message['template'])
+        self.assertEqual({'domain': handler.domain, 'requestNumber': 5, 'projectNumber': 844},
+                         message['renderArgs'])
+        self.assertNotIn('html', message)
+
+        handler.start()
+        handler.die()
+
+        self.assertEqual(1, len(self.server.messages))
+        self.assertIn('request #5', self.server.messages[0]['data'])
+
+        # the arguments are dropped once the email is sent
+        message = outbox.collection.find_one()
+        self.assertEqual('sent', message['status'])
+        self.assertNotIn('renderArgs', message)
+
+    def test_rate_limit(self):
+        """
+        The workers share the rate limits. Emails over the daily limit are
+        given back to the outbox for later, and show up in the backlog.
+
+        :return:
+        """
+
+        outbox = self.make_outbox()
+        for i in range(12):
+            outbox.put('student%s@utdallas.edu' % i, 'Test %s' % i, '<p>%s</p>' % i)
+
+        handler = self.make_handler(outbox=outbox, workers=2, max_per_second=5,
+                                    max_per_day=10, backlog_limit=1)
+        handler.start()
+        handler.die()
+
+        # each worker would have sent up to 10 if they didn't share the
+        # daily limit. How they are paced is tested in test_ratelimit.
+        self.assertEqual(10, len(self.server.messages))
+
+        backlog = handler.backlog()
+        self.assertEqual(2, backlog['queued'])
+        self.assertTrue(backlog['backpressure'])
+        self.assertEqual(0, backlog['limits']['dayRemaining'])
+        self.assertEqual(0, outbox.collection.count_documents({'status': 'queued', 'attempts': {'$ne': 0}}))
+
+    def test_metrics(self):
+        """
+        The workers' metrics are collected by the handler, and exported as
+        JSON and in the Prometheus text format.
+
+        :return:
+        """
+
+        self.server.rejectNext = 1
+        outbox = self.make_outbox(backoff=0.1)
+        handler = self.make_handler(outbox=outbox, workers=2)
+        handler.start()
+        handler.send('student@utdallas.edu', 'Test', '<p>retry</p>')
+        handler.sendTemplate('admin@utdallas.edu', 'Test', 'digest.html',
+                             {'domain': 'localhost', 'items': []}, lane='bulk')
+
+        self.wait_for(lambda: len(self.server.messages) == 2)
+        handler.die()
+
+        snapshot = handler.currentMetrics().snapshot()
+        counters = snapshot['counters']
+        self.assertEqual([{'labels': {'template': 'digest.html'}, 'value': 1},
+                          {'labels': {'template': 'html'}, 'value': 1}],
+                         counters['emails_sent_total'])
+        self.assertEqual(1, sum(row['value'] for row in counters['email_failures_total']))
+        self.assertIn({'labels': {'lane': 'bulk', 'template': 'digest.html'}, 'value': 1},
+                      counters['emails_queued_total'])
+
+        histograms = snapshot['histograms']
+        self.assertEqual(2, sum(row['count'] for row in histograms['email_latency_seconds']))
+        self.assertEqual(2, histograms['smtp_send_seconds'][0]['count'])
+        self.assertGreaterEqual(histograms['smtp_connect_seconds'][0]['count'], 1)
+        self.assertIn({'labels': {'status': 'queued'}, 'value': 0},
+                      snapshot['gauges']['email_outbox'])
+
+        text = handler.metrics.prometheus()
+        self.assertIn('# TYPE email_latency_seconds histogram', text)
+        self.assertIn('emails_sent_total{template="html"} 1', text)
+        self.assertIn('smtp_send_seconds_bucket{le="+Inf"} 2', text)
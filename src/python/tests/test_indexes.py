@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import pymongo as pm
+
+from unittest import TestCase
+
+from utdesign_procurement.indexes import (_planStages, checkIndexes,
+    ensureIndexes, REQUIRED_INDEXES)
+
+class IndexesTester(TestCase):
+    """
+    Tests that the required indexes exist and are used by the queries the
+    API runs most.
+    """
+
+    def setUp(self):
+        # connect to MongoDB
+        client = pm.MongoClient()
+        self.db = client['procurement']
+
+    def test_indexes(self):
+        """
+        Create the required indexes twice, then check that none of the hot
+        queries scans a whole collection.
+
+        :return:
+        """
+
+        # creating the indexes again must not fail
+        ensureIndexes(self.db)
+        ensureIndexes(self.db)
+
+        for collection, indexes in REQUIRED_INDEXES.items():
+            names = self.db[collection].index_information()
+            for index in indexes:
+                self.assertIn(index.document['name'], names)
+
+        self.assertEqual([], checkIndexes(self.db))
+
+    def test_conflicts(self):
+        """
+        Indexes that conflict with required ones, such as ones made by
+        hand, don't stop the required indexes from being created.
+
+        :return:
+        """
+
+        db = pm.MongoClient()['test_procurement_indexes']
+        try:
+            # an index with a required name but other keys, and an
+            # equivalent index under another name
+            db['users'].create_index([('role', pm.ASCENDING), ('email', pm.ASCENDING)],
+                                     name='role')
+            db['users'].create_index([('email', pm.ASCENDING)], name='email_1')
+
+            ensureIndexes(db)
+
+            indexes = db['users'].index_information()
+            self.assertEqual([('role', pm.ASCENDING)], indexes['role']['key'])
+            self.assertIn('email_1', indexes)
+            self.assertIn('projectNumbers', indexes)
+        finally:
+            pm.MongoClient().drop_database('test_procurement_indexes')
+
+    def test_plan_stages(self):
+        """
+        The stages of a plan are found in classic and slot based plans.
+
+        :return:
+        """
+
+        scan = {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}
+        self.assertIn('COLLSCAN', _planStages(scan))
+        self.assertIn('COLLSCAN', _planStages({'queryPlan': scan, 'slotBasedPlan': {}}))
+
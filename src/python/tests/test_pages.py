@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import json
+import pymongo as pm
+import requests
+
+from unittest import TestCase
+
+class PagesTester(TestCase):
+    """
+    Tests paging through the admin data tables.
+    """
+
+    def setUp(self):
+        # get domain
+        self.domain = 'http://localhost:8080'
+
+        # TODO, don't hardcode credentials here
+        self.admin_cookies = self.do_user_login('admin@utdallas.edu', 'oddrun')
+
+    def test_keyset_pages(self):
+        """
+        Page through /requestData, /userData and /projectData by page
+        number and by pageToken, and check that both give the same rows
+        in the same order.
+
+        :return:
+        """
+
+        for endpoint, sortBy in (('requestData', 'requestNumber'),
+                                 ('requestData', 'vendor'),
+                                 ('userData', 'email'),
+                                 ('projectData', 'projectNumber')):
+            for order in ('ascending', 'descending'):
+                numbered = []
+                pageNumber = 0
+                while True:
+                    page = self.do_post(endpoint, {
+                        'sortBy': sortBy,
+                        'order': order,
+                        'pageNumber': pageNumber
+                    })
+                    if not page:
+                        break
+                    numbered.extend(row['_id'] for row in page)
+                    pageNumber += 1
+
+                keyset = []
+                pageToken = None
+                while True:
+                    page = self.do_post(endpoint, {
+                        'sortBy': sortBy,
+                        'order': order,
+                        'pageToken': pageToken
+                    })
+                    self.assertLessEqual(len(page['results']), 10)
+                    keyset.extend(row['_id'] for row in page['results'])
+                    pageToken = page['nextPageToken']
+                    if pageToken is None:
+                        break
+
+                self.assertEqual(numbered, keyset)
+
+    def test_bad_page_token(self):
+        """
+        A pageToken that wasn't made for this sort is rejected.
+
+        :return:
+        """
+
+        page = self.do_post('requestData', {
+            'sortBy': 'requestNumber',
+            'pageToken': None
+        })
+
+        if page['nextPageToken'] is not None:
+            self.do_post('requestData', {
+                'sortBy': 'vendor',
+                'pageToken': page['nextPageToken']
+            }, expectedStatus=400)
+
+        self.do_post('requestData', {
+            'sortBy': 'requestNumber',
+            'pageToken': 'not a token'
+        }, expectedStatus=400)
+
+    def test_page_counts(self):
+        """
+        Check that /requestPages counts a newly submitted request, even
+        though the count was cached before it was submitted.
+
+        :return:
+        """
+
+        # connect to MongoDB
+        colRequests = pm.MongoClient()['procurement']['requests']
+        visible = {'status': {'$nin': ['saved', 'cancelled']}}
+
+        pages = self.do_post('requestPages', {})
+        self.assertEqual(pages, self.do_post('requestPages', {}))
+
+        # submit requests until the table needs one more page
+        student_cookies = self.do_user_login('xander@utdallas.edu', 'oddrun')
+        while True:
+            self.do_submit_request(student_cookies)
+            count = colRequests.count_documents(visible)
+            if count % 10 == 1:
+                break
+
+        self.assertEqual(count // 10 + 1, self.do_post('requestPages', {}))
+
+    def test_query(self):
+        """
+        Check that /requestQuery, /userQuery and /projectQuery return the
+        same page and page count as the data and pages endpoints.
+
+        :return:
+        """
+
+        for name in ('request', 'user', 'project'):
+            for pageNumber in (0, 1):
+                data = {'order': 'descending', 'pageNumber': pageNumber}
+
+                query = self.do_post('%sQuery' % name, data)
+                self.assertEqual(self.do_post('%sData' % name, data), query['results'])
+                self.assertEqual(self.do_post('%sPages' % name, {}), query['pages'])
+
+                if query['facets']:
+                    self.assertEqual(query['count'], sum(query['facets'].values()))
+
+    def do_submit_request(self, student_cookies):
+        """
+        Submit a request through /procurementSave.
+
+        :param student_cookies: CookieJar. A valid student session id.
+
+        :return:
+        """
+
+        response = requests.post(
+            '%s/procurementSave' % self.domain,
+            cookies = student_cookies,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps({
+                "submit": True,
+                "manager": 'manager@utdallas.edu',
+                "vendor": 'Oracle',
+                "projectNumber": 844,
+                "URL": 'https://www.oracle.com/index.html',
+                "items": [{
+                    "description": "Prophecy",
+                    "partNo": "1",
+                    "itemURL": 'https://www.oracle.com/prophecy',
+                    "quantity": 1,
+                    "unitCost": "4.20",
+                    "totalCost": "4.20"
+                }]
+            }),
+        )
+
+        # see if the response comes back okay
+        if not (200 <= response.status_code <= 300):
+            raise ValueError(response.content.decode("utf-8"))
+
+    def do_user_login(self, email, password):
+        """
+        Login as some user.
+        Test the /userLogin REST endpoint.
+
+        :return: CookieJar. The cookies returned by /userLogin
+        """
+
+        response = requests.post(
+            '%s/userLogin' % self.domain,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps({
+                "email": email,
+                "password": password,
+            })
+        )
+
+        # see if the response comes back okay
+        if not (200 <= response.status_code <= 300):
+            raise ValueError(response.content.decode("utf-8"))
+
+        # save our cookies for later
+        return response.cookies
+
+    def do_post(self, endpoint, data, expectedStatus=None):
+        """
+        Post to some REST endpoint as the admin.
+
+        :param endpoint: str. The name of the endpoint.
+        :param data: dict. The json data to send.
+        :param expectedStatus: int. The status code the call should fail
+            with, or None if it should succeed.
+
+        :return: the json response, if the call succeeded
+        """
+
+        response = requests.post(
+            '%s/%s' % (self.domain, endpoint),
+            cookies = self.admin_cookies,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps(data),
+        )
+
+        if expectedStatus is not None:
+            self.assertEqual(expectedStatus, response.status_code)
+            return None
+
+        # see if the response comes back okay
+        if not (200 <= response.status_code <= 300):
+            raise ValueError(response.content.decode("utf-8"))
+
+        return json.loads(response.content.decode('utf-8'))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import cherrypy
+import hashlib
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from utdesign_procurement.passwords import (DEFAULT_PARAMS, MIN_PARAMS,
+    PasswordHasher, calibrate, checkRecord, hashRecord, userRecord)
+from utdesign_procurement.utils import generateSalt
+
+class PasswordHasherTester(TestCase):
+    """
+    Tests hashing passwords in the PasswordHasher's process pool.
+    """
+
+    def setUp(self):
+        self.user = {'password': hashRecord('oddrun', DEFAULT_PARAMS)}
+
+    def test_verify(self):
+        """
+        The pool hashes passwords into records that verify.
+
+        :return:
+        """
+
+        hasher = PasswordHasher(workers=1)
+        try:
+            record = hasher.hash('oddrun')
+            self.assertEqual('scrypt', record['algorithm'])
+            self.assertTrue(checkRecord(record, 'oddrun'))
+            self.assertTrue(hasher.verify(self.user, 'oddrun'))
+            self.assertFalse(hasher.verify(self.user, 'not oddrun'))
+            self.assertFalse(hasher.verify({'email': 'nopassword@utdallas.edu'}, 'oddrun'))
+        finally:
+            hasher.shutdown()
+
+    def test_records(self):
+        """
+        Passwords verify whatever parameters they were hashed with,
+        including passwords stored before hash records, and only passwords
+        hashed with other parameters need a rehash.
+
+        :return:
+        """
+
+        salt = generateSalt()
+        legacy = {'salt': salt,
+                  'password': hashlib.pbkdf2_hmac('sha256', b'oddrun', salt, 100000)}
+        pbkdf2 = {'password': hashRecord('oddrun', {'algorithm': 'pbkdf2_sha256',
+                                                   'iterations': 1000})}
+
+        hasher = PasswordHasher(workers=0)
+        for user in (legacy, pbkdf2, self.user):
+            self.assertTrue(hasher.verify(user, 'oddrun'))
+            self.assertFalse(hasher.verify(user, 'not oddrun'))
+
+        self.assertEqual('pbkdf2_sha256', userRecord(legacy)['algorithm'])
+        self.assertTrue(hasher.needsRehash(legacy))
+        self.assertTrue(hasher.needsRehash(pbkdf2))
+        self.assertFalse(hasher.needsRehash(self.user))
+        self.assertTrue(PasswordHasher(workers=0, params=MIN_PARAMS['pbkdf2_sha256'])
+                        .needsRehash(pbkdf2))
+        self.assertRaises(ValueError, hashRecord, 'oddrun', {'algorithm': 'md5'})
+
+    def test_calibrate(self):
+        """
+        Calibration never picks parameters weaker than the minimum.
+
+        :return:
+        """
+
+        self.assertEqual(MIN_PARAMS['scrypt'], calibrate(0, 'scrypt'))
+        self.assertEqual(MIN_PARAMS['pbkdf2_sha256'], calibrate(0, 'pbkdf2_sha256'))
+        self.assertGreater(calibrate(1, 'pbkdf2_sha256')['iterations'], 100000)
+
+    def test_saturated(self):
+        """
+        Logins past max_pending are refused with a 503 right away, and the
+        rest are hashed.
+
+        :return:
+        """
+
+        hasher = PasswordHasher(workers=1, max_pending=2)
+
+        def login():
+            try:
+                return hasher.verify(self.user, 'oddrun')
+            except cherrypy.HTTPError as e:
+                return e.status
+
+        try:
+            with ThreadPoolExecutor(8) as threads:
+                results = list(threads.map(lambda i: login(), range(8)))
+        finally:
+            hasher.shutdown()
+
+        self.assertIn(503, results)
+        self.assertIn(True, results)
+        self.assertEqual(set(results), {True, 503})
+
+    def test_timeout(self):
+        """
+        A hash that takes longer than the timeout is refused with a 503,
+        and keeps its slot until the worker is done with it.
+
+        :return:
+        """
+
+        slow = {'algorithm': 'pbkdf2_sha256', 'iterations': 2000000}
+        user = {'password': hashRecord('oddrun', MIN_PARAMS['pbkdf2_sha256'])}
+        hasher = PasswordHasher(workers=1, max_pending=1, timeout=0.01, params=slow)
+        try:
+            for i in range(2):
+                with self.assertRaises(cherrypy.HTTPError) as caught:
+                    hasher.hash('oddrun')
+                self.assertEqual(503, caught.exception.status)
+
+            # the slot comes back once the slow hash is done
+            hasher.timeout = 30
+            for i in range(50):
+                try:
+                    self.assertTrue(hasher.verify(user, 'oddrun'))
+                    break
+                except cherrypy.HTTPError:
+                    time.sleep(0.1)
+            else:
+                self.fail('the slot was never given back')
+        finally:
+            hasher.shutdown()
+
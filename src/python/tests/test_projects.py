@@ -91,8 +91,9 @@ class ProjectTester(TestCase):
             "projectName": "test project",
             "membersEmails": [student, manager],
             "defaultBudget": budget,
-            "availableBudget": budget,
-            "pendingBudget": budget
+            # the budgets start from the defaultBudget, whatever the client says
+            "availableBudget": "999999.00",
+            "pendingBudget": "999999.00"
         }
 
         response = requests.post(
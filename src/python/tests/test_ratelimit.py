@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+from unittest import TestCase
+
+from utdesign_procurement.ratelimit import DAY, RateLimiter
+
+class RateLimiterTester(TestCase):
+    """
+    Simulates sending email through the RateLimiter with a fake clock.
+    """
+
+    def setUp(self):
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def send(self, limiter, count, recipients=1):
+        """
+        Send emails as fast as the limiter allows, sleeping on the fake
+        clock whenever it says to wait.
+
+        :param limiter: (RateLimiter).
+        :param count: (int). How many emails to send.
+        :param recipients: (int). How many recipients each email has.
+        :return: list of the times each email was sent at
+        """
+        times = []
+        while len(times) < count:
+            wait = limiter.reserve(recipients)
+            if wait:
+                self.now += wait
+            else:
+                times.append(self.now)
+        return times
+
+    def test_per_second(self):
+        """
+        After a burst, emails are sent at the per second rate, and no
+        second ever has more than the burst plus the rate.
+
+        :return:
+        """
+
+        limiter = RateLimiter(perSecond=5, burst=10, clock=self.clock)
+        times = self.send(limiter, 100)
+
+        self.assertEqual([0] * 10, times[:10])
+        self.assertAlmostEqual((100 - 10) / 5, times[-1])
+        for start in times:
+            inSecond = [t for t in times if start <= t < start + 1]
+            self.assertLessEqual(len(inSecond), 10 + 5)
+
+    def test_per_day(self):
+        """
+        Once the daily limit is used up, emails wait for the first emails
+        of the day to be more than a day old, even though the per second
+        bucket is full. No day ever has more than the daily limit.
+
+        :return:
+        """
+
+        sent = []
+        limiter = RateLimiter(perSecond=10, perDay=100, clock=self.clock,
+                              sentToday=lambda: len([t for t in sent if t > self.now - DAY]))
+        while len(sent) < 250:
+            wait = limiter.reserve()
+            if wait:
+                self.now += wait
+            else:
+                sent.append(self.now)
+                limiter.done()
+
+        self.assertLess(sent[99], 10)
+        self.assertGreaterEqual(sent[100], DAY)
+        for start in sent:
+            self.assertLessEqual(len([t for t in sent if start <= t < start + DAY]), 100)
+        self.assertEqual(50, limiter.status()['dayRemaining'])
+
+    def test_recipients(self):
+        """
+        Every recipient takes a token. An email with more recipients than
+        the burst is sent once the bucket is full, and the emails after it
+        wait for the bucket to refill what it took.
+
+        :return:
+        """
+
+        limiter = RateLimiter(perSecond=2, burst=4, clock=self.clock)
+        self.assertEqual([0, 2, 4], self.send(limiter, 3, recipients=4))
+        self.assertEqual([6], self.send(limiter, 1, recipients=20))
+        self.assertEqual([6 + (16 + 1) / 2], self.send(limiter, 1))
+
+    def test_pending(self):
+        """
+        Recipients reserved but not yet sent count against the day, so
+        workers sending at once can't go over the daily limit together.
+
+        :return:
+        """
+
+        # the 8 recipients fail, so sentToday never counts them
+        limiter = RateLimiter(perDay=10, clock=self.clock, sentToday=lambda: 2,
+                              sentTodayTTL=0)
+        self.assertEqual(0, limiter.reserve(8))
+        self.assertGreater(limiter.reserve(1), 0)
+        limiter.done(8)
+        self.assertEqual(0, limiter.reserve(8))
+
+    def test_sent_today_cache(self):
+        """
+        sentToday is only called once every sentTodayTTL seconds, and
+        recipients done since it was called still count against the day.
+
+        :return:
+        """
+
+        sent = []
+        calls = []
+
+        def sentToday():
+            calls.append(self.now)
+            return len(sent)
+
+        limiter = RateLimiter(perDay=10, clock=self.clock, sentToday=sentToday,
+                              sentTodayTTL=5)
+        for i in range(10):
+            self.assertEqual(0, limiter.reserve())
+            sent.append(self.now)
+            limiter.done()
+        self.assertGreater(limiter.reserve(), 0)
+        self.assertEqual([0], calls)
+
+        self.now += 5
+        self.assertGreater(limiter.reserve(), 0)
+        self.assertEqual(0, limiter.status()['dayRemaining'])
+        self.assertEqual([0, 5], calls)
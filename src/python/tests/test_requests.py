@@ -119,6 +119,201 @@ class RequestsTester(TestCase):
             admin_cookies,
         )
 
+    def test_requests_bulk(self):
+        """
+        Tests moving many approved procurement requests through ordered,
+        ready for pickup and complete at once.
+
+        :return:
+        """
+
+        # get domain
+        self.domain = 'http://localhost:8080'
+
+        # connect to MongoDB
+        client = pm.MongoClient()
+        db = client['procurement']
+        self.colRequests = db['requests']
+
+        # TODO, don't hardcode credentials here
+        student_email = 'xander@utdallas.edu'
+        manager_email = 'manager@utdallas.edu'
+        admin_email = 'admin@utdallas.edu'
+
+        student_password = manager_password = admin_password = 'oddrun'
+
+        project_number = 844
+
+        student_cookies = self.do_user_login(student_email, student_password)
+        manager_cookies = self.do_user_login(manager_email, manager_password)
+        admin_cookies = self.do_user_login(admin_email, admin_password)
+
+        requestIds = []
+        for i in range(3):
+            requestId, requestNumber = self.do_save_request(
+                student_cookies,
+                manager_email,
+                project_number)
+            self.do_approve_manager(requestId, manager_cookies)
+            requestIds.append(requestId)
+
+        # a request that was never approved is skipped
+        pendingId, pendingNumber = self.do_save_request(
+            student_cookies,
+            manager_email,
+            project_number)
+
+        j = self.do_transition_bulk(requestIds + [pendingId], 'ordered', admin_cookies,
+                                    {requestIds[0]: "2.00"})
+        self.assertEqual(sorted(requestIds), sorted(j['updated']))
+        self.assertEqual([pendingId], j['skipped'])
+
+        requestDoc = self.colRequests.find_one({"_id": ObjectId(requestIds[0])})
+        self.assertEqual(200, requestDoc['shippingCost'])
+
+        self.do_transition_bulk(requestIds, 'ready for pickup', admin_cookies)
+        self.do_transition_bulk(requestIds, 'complete', admin_cookies)
+
+        for requestId in requestIds:
+            requestDoc = self.colRequests.find_one({"_id": ObjectId(requestId)})
+            self.assertEqual('complete', requestDoc['status'])
+            self.assertEqual(
+                ['ordered', 'ready for pickup', 'complete'],
+                [entry['newState'] for entry in requestDoc['history'][-3:]])
+
+        requestDoc = self.colRequests.find_one({"_id": ObjectId(pendingId)})
+        self.assertEqual('pending', requestDoc['status'])
+
+    def test_statuses_summary(self):
+        """
+        Tests that /procurementStatuses leaves out items and history in
+        summary mode, and that /procurementDetail returns them.
+
+        :return:
+        """
+
+        # get domain
+        self.domain = 'http://localhost:8080'
+
+        # connect to MongoDB
+        client = pm.MongoClient()
+        db = client['procurement']
+        self.colRequests = db['requests']
+
+        # TODO, don't hardcode credentials here
+        student_cookies = self.do_user_login('xander@utdallas.edu', 'oddrun')
+
+        requestId, requestNumber = self.do_save_request(
+            student_cookies,
+            'manager@utdallas.edu',
+            844)
+
+        summaries = self.do_post('procurementStatuses', student_cookies, {
+            'projectNumbers': [844],
+            'summary': True
+        })
+        summary = [s for s in summaries if s['_id'] == requestId][0]
+        self.assertEqual(requestNumber, summary['requestNumber'])
+        self.assertNotIn('items', summary)
+        self.assertNotIn('history', summary)
+
+        detail = self.do_post('procurementDetail', student_cookies, {
+            '_id': requestId
+        })
+        self.assertEqual(requestId, detail['_id'])
+        self.assertEqual(1, len(detail['items']))
+        self.assertIn('history', detail)
+
+    def test_transition_stale_state(self):
+        """
+        Tests that a transition on a request that has already left the
+        state it expects is refused with a 400, and that the request's
+        status and history are left alone.
+
+        :return:
+        """
+
+        # get domain
+        self.domain = 'http://localhost:8080'
+
+        # connect to MongoDB
+        client = pm.MongoClient()
+        db = client['procurement']
+        self.colRequests = db['requests']
+
+        # TODO, don't hardcode credentials here
+        student_cookies = self.do_user_login('xander@utdallas.edu', 'oddrun')
+        manager_cookies = self.do_user_login('manager@utdallas.edu', 'oddrun')
+        admin_cookies = self.do_user_login('admin@utdallas.edu', 'oddrun')
+
+        requestId, requestNumber = self.do_save_request(
+            student_cookies,
+            'manager@utdallas.edu',
+            844)
+
+        self.do_approve_manager(requestId, manager_cookies)
+        before = self.colRequests.find_one({"_id": ObjectId(requestId)})
+
+        # none of these transitions starts from manager approved
+        for endpoint, cookies, data in [
+                ('procurementApproveManager', manager_cookies, {"_id": requestId}),
+                ('procurementRejectManager', manager_cookies, {"_id": requestId, "comment": ""}),
+                ('procurementUpdateManager', manager_cookies, {"_id": requestId, "comment": ""}),
+                ('procurementReady', admin_cookies, {"_id": requestId}),
+                ('procurementComplete', admin_cookies, {"_id": requestId})]:
+            response = self.do_post_response(endpoint, cookies, data)
+            self.assertEqual(400, response.status_code, endpoint)
+
+            after = self.colRequests.find_one({"_id": ObjectId(requestId)})
+            self.assertEqual('manager approved', after['status'])
+            self.assertEqual(before['history'], after['history'])
+
+    def do_post_response(self, endpoint, cookies, data):
+        """
+        Post to some REST endpoint without checking the response.
+
+        :param endpoint: str. The name of the endpoint.
+        :param cookies: CookieJar. A valid session id.
+        :param data: dict. The json data to send.
+
+        :return: the response
+        """
+
+        return requests.post(
+            '%s/%s' % (self.domain, endpoint),
+            cookies = cookies,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps(data),
+        )
+
+    def do_post(self, endpoint, cookies, data):
+        """
+        Post to some REST endpoint.
+
+        :param endpoint: str. The name of the endpoint.
+        :param cookies: CookieJar. A valid session id.
+        :param data: dict. The json data to send.
+
+        :return: the json response
+        """
+
+        response = requests.post(
+            '%s/%s' % (self.domain, endpoint),
+            cookies = cookies,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps(data),
+        )
+
+        # see if the response comes back okay
+        if not (200 <= response.status_code <= 300):
+            raise ValueError(response.content.decode("utf-8"))
+
+        return json.loads(response.content.decode('utf-8'))
+
     def do_user_login(self, email, password):
         """
         Login as the admin.
@@ -605,3 +800,46 @@ class RequestsTester(TestCase):
         self.assertEqual('complete', requestDoc['status'])
 
 
+
+    def do_transition_bulk(self, requestIds, status, cookies, amounts=None):
+        """
+        Test the /procurementTransitionBulk REST endpoint.
+
+        :param requestIds: list of str. The ids of the requests to change.
+        :param status: str. The status to change them to.
+        :param cookies: CookieJar. A valid admin session id.
+        :param amounts: dict of request id to shipping cost, or None.
+
+        :return: dict. The updated and skipped request ids.
+        """
+
+        data = {
+            "_ids": requestIds,
+            "status": status
+        }
+        if amounts is not None:
+            data["amounts"] = amounts
+
+        response = requests.post(
+            '%s/procurementTransitionBulk' % self.domain,
+            cookies = cookies,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps(data),
+        )
+
+        # see if the response comes back okay
+        if not (200 <= response.status_code <= 300):
+            raise ValueError(response.content.decode("utf-8"))
+
+        j = json.loads(response.content.decode('utf-8'))
+        self.assertIn('updated', j)
+        self.assertIn('skipped', j)
+
+        # check that the updated requests now have the proper status
+        for requestId in j['updated']:
+            requestDoc = self.colRequests.find_one({"_id": ObjectId(requestId)})
+            self.assertEqual(status, requestDoc['status'])
+
+        return j
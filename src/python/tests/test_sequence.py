@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import cherrypy
+import pymongo as pm
+import json
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from utdesign_procurement.apigateway import ApiGateway
+
+class SequenceTester(TestCase):
+    """
+    Tests that request numbers stay unique when many requests are saved
+    at the same time.
+    """
+
+    def setUp(self):
+        # get domain
+        self.domain = 'http://localhost:8080'
+
+        # connect to MongoDB
+        client = pm.MongoClient()
+        db = client['procurement']
+        self.colRequests = db['requests']
+
+        self.threads = 16
+        self.saves = 64
+
+    def test_concurrent_save(self):
+        """
+        Hammer the /procurementSave REST endpoint from many threads at once
+        and check that every saved request got its own request number.
+
+        :return:
+        """
+
+        student_cookies = self.do_user_login('xander@utdallas.edu', 'oddrun')
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            results = list(executor.map(
+                lambda i: self.do_save_request(student_cookies, i),
+                range(self.saves)))
+
+        requestNumbers = [requestNumber for requestId, requestNumber in results]
+        self.assertEqual(len(requestNumbers), len(set(requestNumbers)))
+
+        # every request must also be its own document in MongoDB
+        requestIds = [requestId for requestId, requestNumber in results]
+        self.assertEqual(len(requestIds), len(set(requestIds)))
+        for requestNumber in requestNumbers:
+            self.assertEqual(1, self.colRequests.find({'requestNumber': requestNumber}).count())
+
+    def test_concurrent_sequence_blocks(self):
+        """
+        Reserve request numbers from many threads and two gateways that
+        lease blocks of numbers, as separate server processes would, and
+        check that no number is handed out twice.
+
+        :return:
+        """
+
+        gateways = [ApiGateway(email_handler=None, sequenceBlockSize=7),
+                    ApiGateway(email_handler=None, sequenceBlockSize=5)]
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            numbers = list(executor.map(
+                lambda i: gateways[i % 2].sequence(),
+                range(self.saves * 4)))
+
+        self.assertEqual(len(numbers), len(set(numbers)))
+
+    def test_invalid_sequence(self):
+        """
+        A sequence without a valid number is refused before it is
+        incremented, so no numbers are used up.
+
+        :return:
+        """
+
+        gateway = ApiGateway(email_handler=None)
+        gateway.colSequence = pm.MongoClient()['procurement']['test_sequence']
+        gateway.colSequence.drop()
+        try:
+            gateway.colSequence.insert_one({'name': 'requests'})
+            with self.assertRaises(cherrypy.HTTPError):
+                gateway.sequence()
+            self.assertNotIn('number', gateway.colSequence.find_one({'name': 'requests'}))
+        finally:
+            gateway.colSequence.drop()
+
+    def do_user_login(self, email, password):
+        """
+        Login as some user.
+        Test the /userLogin REST endpoint.
+
+        :return: CookieJar. The cookies returned by /userLogin
+        """
+
+        response = requests.post(
+            '%s/userLogin' % self.domain,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps({
+                "email": email,
+                "password": password,
+            })
+        )
+
+        # see if the response comes back okay
+        if not (200 <= response.status_code <= 300):
+            raise ValueError(response.content.decode("utf-8"))
+
+        # save our cookies for later
+        return response.cookies
+
+    def do_save_request(self, student_cookies, index):
+        """
+        Save (but don't submit) a request through /procurementSave.
+
+        :param student_cookies: CookieJar. A valid student session id.
+        :param index: int. Used to tell the saved requests apart.
+
+        :return: tuple of the MongoDB ObjectId and the request number
+        """
+
+        response = requests.post(
+            '%s/procurementSave' % self.domain,
+            cookies = student_cookies,
+            headers = {
+                'Content-type': 'application/json'
+            },
+            data = json.dumps({
+                "submit": False,
+                "projectNumber": 844,
+                "vendor": 'Concurrent Vendor %d' % index,
+            }),
+        )
+
+        # see if the response comes back okay
+        if not (200 <= response.status_code <= 300):
+            raise ValueError(response.content.decode("utf-8"))
+
+        j = json.loads(response.content.decode('utf-8'))
+        self.assertIn('_id', j)
+        self.assertIn('requestNumber', j)
+
+        return j['_id'], j['requestNumber']
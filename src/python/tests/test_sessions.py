@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from utdesign_procurement.sessions import MongoSession
+
+class TestSession(MongoSession):
+    collection_name = 'test_sessions'
+    eager_keys = ('role',)
+
+class MongoSessionTester(TestCase):
+    """
+    Tests storing sessions in MongoDB, as several server processes would
+    share them.
+    """
+
+    def setUp(self):
+        TestSession.setup()
+        TestSession.collection().delete_many({})
+
+    def make_session(self, id=None):
+        """
+        Make a session like CherryPy does at the start of a request.
+
+        :param id: (str). The session id from the cookie, if any.
+        :return: TestSession
+        """
+        return TestSession(id, timeout=60)
+
+    def test_round_trip(self):
+        """
+        A session saved by one request is loaded by the next, including
+        values MongoDB can't store, like sets.
+
+        :return:
+        """
+
+        session = self.make_session()
+        session['email'] = 'admin@utdallas.edu'
+        session['role'] = 'admin'
+        session['bulkProjectsOverwrite'] = {1, 2}
+        session['odd.key'] = 3
+        session.save()
+
+        session = self.make_session(session.id)
+        self.assertFalse(session.missing)
+        self.assertEqual('admin', session['role'])
+        self.assertEqual({1, 2}, session['bulkProjectsOverwrite'])
+        self.assertEqual(3, session.get('odd.key'))
+        self.assertEqual({'email', 'role', 'bulkProjectsOverwrite', 'odd.key'}, set(session.keys()))
+        self.assertNotIn('projectNumbers', session)
+
+    def test_lazy(self):
+        """
+        Only the keys a request uses are fetched, along with the eager
+        keys, and only the keys it changes are written back.
+
+        :return:
+        """
+
+        first = self.make_session()
+        first['role'] = 'admin'
+        first['email'] = 'admin@utdallas.edu'
+        first['bulkUserMetadata'] = {'valid': 1, 'invalid': 0}
+        first.save()
+
+        # two requests on different processes use the same session
+        second = self.make_session(first.id)
+        third = self.make_session(first.id)
+
+        self.assertEqual('admin@utdallas.edu', second['email'])
+        self.assertEqual({'email', 'role'}, set(second._values))
+
+        third['bulkUserMetadata']['invalid'] += 1
+        second['email'] = 'other@utdallas.edu'
+        second.save()
+        third.save()
+
+        session = self.make_session(first.id)
+        self.assertEqual('other@utdallas.edu', session['email'])
+        self.assertEqual({'valid': 1, 'invalid': 1}, session['bulkUserMetadata'])
+
+    def test_delete(self):
+        """
+        Deleted keys are removed from the stored session, and a deleted
+        session isn't loaded again.
+
+        :return:
+        """
+
+        session = self.make_session()
+        session['role'] = 'admin'
+        session['bulkUserData'] = ['lots of users']
+        session.save()
+
+        session = self.make_session(session.id)
+        self.assertEqual(['lots of users'], session.pop('bulkUserData'))
+        self.assertIsNone(session.pop('bulkUserData', None))
+        session.save()
+
+        session = self.make_session(session.id)
+        self.assertNotIn('bulkUserData', session)
+        session.delete()
+
+        self.assertTrue(self.make_session(session.id).missing)
+
+    def test_expiry(self):
+        """
+        An expired session isn't loaded, and a session that was only read
+        is refreshed without being created.
+
+        :return:
+        """
+
+        session = self.make_session()
+        session['role'] = 'admin'
+        session.save()
+        TestSession.collection().update_one(
+            {'_id': session.id}, {'$set': {'expiration': datetime.utcnow() - timedelta(seconds=1)}})
+        self.assertTrue(self.make_session(session.id).missing)
+
+        visitor = self.make_session()
+        self.assertIsNone(visitor.get('role'))
+        visitor.save()
+        self.assertIsNone(TestSession.collection().find_one({'_id': visitor.id}))
+
+    def test_locks(self):
+        """
+        A session's lock is dropped once no request holds it, so the locks
+        don't pile up with every visitor.
+
+        :return:
+        """
+
+        session = self.make_session()
+        session.acquire_lock()
+
+        # another request for the same session waits for the lock
+        other = self.make_session(session.id)
+        waiting = threading.Thread(target=lambda: (other.acquire_lock(), other.release_lock()))
+        waiting.start()
+        for i in range(50):
+            if TestSession.locks[session.id][1] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(2, TestSession.locks[session.id][1])
+
+        session.release_lock()
+        waiting.join()
+        self.assertFalse(other.locked)
+        self.assertNotIn(session.id, TestSession.locks)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import cherrypy
+import pymongo as pm
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from utdesign_procurement.throttle import LoginThrottle
+
+class LoginThrottleTester(TestCase):
+    """
+    Simulates login attempts against the LoginThrottle with a fake clock,
+    with attempts kept in memory and in MongoDB.
+    """
+
+    def setUp(self):
+        # the TTL index expires attempts by the real time, so the fake
+        # clock starts there
+        self.now = time.time()
+        self.colAttempts = pm.MongoClient()['procurement']['test_loginAttempts']
+        self.colAttempts.drop()
+
+    def tearDown(self):
+        self.colAttempts.drop()
+
+    def clock(self):
+        return self.now
+
+    def make_throttles(self, **kwargs):
+        """
+        :return: a throttle that keeps attempts in memory, and one that
+            keeps them in MongoDB
+        """
+        return [LoginThrottle(clock=self.clock, **kwargs),
+                LoginThrottle(collection=self.colAttempts, clock=self.clock, **kwargs)]
+
+    def assertRefused(self, throttle, email, address):
+        with self.assertRaises(cherrypy.HTTPError) as context:
+            throttle.attempt(email, address)
+        self.assertEqual(429, context.exception.status)
+
+    def test_per_email(self):
+        """
+        An email is refused once it has used its attempts, from any
+        address, until its oldest attempt leaves the window.
+
+        :return:
+        """
+
+        for throttle in self.make_throttles(perEmail=3, window=60):
+            for i in range(3):
+                throttle.attempt('admin@utdallas.edu', '10.0.0.%d' % i)
+                self.now += 10
+            self.assertRefused(throttle, 'admin@utdallas.edu', '10.0.0.9')
+            throttle.attempt('student@utdallas.edu', '10.0.0.9')
+
+            self.now += 31
+            throttle.attempt('admin@utdallas.edu', '10.0.0.9')
+            self.assertRefused(throttle, 'admin@utdallas.edu', '10.0.0.9')
+
+    def test_per_address(self):
+        """
+        An address is refused once it has used its attempts, whatever the
+        email, but successful logins don't count against it.
+
+        :return:
+        """
+
+        for throttle in self.make_throttles(perAddress=3, window=60):
+            for i in range(10):
+                at = throttle.attempt('student%d@utdallas.edu' % i, '10.0.0.1')
+                throttle.succeeded('student%d@utdallas.edu' % i, '10.0.0.1', at)
+
+            for i in range(3):
+                throttle.attempt('guess%d@utdallas.edu' % i, '10.0.0.1')
+            self.assertRefused(throttle, 'student0@utdallas.edu', '10.0.0.1')
+            throttle.attempt('student0@utdallas.edu', '10.0.0.2')
+
+    def test_succeeded(self):
+        """
+        Logging in forgets the failed attempts against the email, and a
+        cancelled attempt doesn't count.
+
+        :return:
+        """
+
+        for throttle in self.make_throttles(perEmail=3, window=60):
+            for i in range(2):
+                throttle.attempt('admin@utdallas.edu', '10.0.0.1')
+            at = throttle.attempt('admin@utdallas.edu', '10.0.0.1')
+            throttle.cancel('admin@utdallas.edu', '10.0.0.1', at)
+
+            at = throttle.attempt('admin@utdallas.edu', '10.0.0.1')
+            throttle.succeeded('admin@utdallas.edu', '10.0.0.1', at)
+            for i in range(3):
+                throttle.attempt('admin@utdallas.edu', '10.0.0.1')
+            self.assertRefused(throttle, 'admin@utdallas.edu', '10.0.0.1')
+
+    def test_concurrent(self):
+        """
+        Attempts made at once on several processes sharing the collection
+        never get more than the limit through.
+
+        :return:
+        """
+
+        throttles = [LoginThrottle(perEmail=3, window=60, collection=self.colAttempts,
+                                   clock=self.clock) for i in range(8)]
+
+        def attempt(throttle):
+            try:
+                throttle.attempt('admin@utdallas.edu', '10.0.0.1')
+                return True
+            except cherrypy.HTTPError:
+                return False
+
+        with ThreadPoolExecutor(8) as threads:
+            results = list(threads.map(attempt, throttles))
+
+        self.assertLessEqual(sum(results), 3)
+        self.assertEqual(sum(results), self.colAttempts.count_documents({'key': 'email:admin@utdallas.edu'}))
+
+    def test_window_change(self):
+        """
+        A throttle with a new window changes the TTL index of the
+        collection instead of failing to start.
+
+        :return:
+        """
+
+        LoginThrottle(window=60, collection=self.colAttempts)
+        LoginThrottle(window=120, collection=self.colAttempts)
+        ttl = self.colAttempts.index_information()['attemptedAt_ttl']
+        self.assertEqual(120, ttl['expireAfterSeconds'])
+
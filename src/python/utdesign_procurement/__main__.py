@@ -1,12 +1,112 @@
 #!/usr/bin/env python3
 
+import argparse
 import cherrypy, os
+import pymongo as pm
+import sys
 
+from utdesign_procurement.apigateway import ApiGateway
 from utdesign_procurement.server import Root
 from utdesign_procurement.emailer import EmailHandler
+from utdesign_procurement.indexes import checkIndexes, ensureIndexes
+from utdesign_procurement.passwords import ALGORITHMS, PasswordHasher, calibrate, timeHash
+from utdesign_procurement.throttle import LoginThrottle
+
+# server.conf names utdesign_procurement.sessions.MongoSession, which can
+# only be found once the module is imported
+import utdesign_procurement.sessions
 
 def main():
 
+    parser = argparse.ArgumentParser(prog='utdesign_procurement')
+    parser.add_argument('command', nargs='?', default='serve',
+                        choices=('serve', 'reconcile-budgets', 'check-indexes',
+                                 'calibrate-passwords'),
+                        help='"serve" (default) runs the server. '
+                             '"reconcile-budgets" rebuilds the budget '
+                             'ledger of every project and reports drift. '
+                             '"check-indexes" creates the required indexes '
+                             'and reports queries that scan a whole collection. '
+                             '"calibrate-passwords" picks the password hash '
+                             'parameters for this host and saves them.')
+    parser.add_argument('--target', type=float, default=0.25,
+                        help='seconds one password hash should take, for '
+                             'calibrate-passwords')
+    parser.add_argument('--algorithm', default='scrypt', choices=sorted(ALGORITHMS),
+                        help='the password hash algorithm, for calibrate-passwords')
+    parser.add_argument('--sequence-block-size', type=int, default=1,
+                        help='how many request numbers each server process '
+                             'reserves at a time, for serve. Larger blocks '
+                             'save database round trips, but leave gaps in '
+                             'the numbering when the server restarts.')
+    args = parser.parse_args()
+
+    if args.command == 'reconcile-budgets':
+        reconcileBudgets()
+    elif args.command == 'check-indexes':
+        sys.exit(checkIndexesCommand())
+    elif args.command == 'calibrate-passwords':
+        calibratePasswords(args.target, args.algorithm)
+    else:
+        serve(args.sequence_block_size)
+
+def reconcileBudgets():
+    """
+    Rebuild the budget ledger of every project from its requests and costs,
+    and print every project whose ledger had drifted.
+    """
+
+    gateway = ApiGateway(email_handler=None)
+    drift = gateway.reconcileBudgets()
+
+    for project in drift:
+        print('Project %s: available %s -> %s, pending %s -> %s' % (
+            project['projectNumber'],
+            project['availableBudget'], project['expectedAvailableBudget'],
+            project['pendingBudget'], project['expectedPendingBudget']))
+
+    print('%d project budget(s) corrected.' % len(drift))
+
+def checkIndexesCommand():
+    """
+    Create the required indexes, then explain() the queries the API runs
+    most and print every one that still scans a whole collection.
+
+    :return: exit status. 1 if any query scans a whole collection.
+    """
+
+    db = pm.MongoClient()['procurement']
+    ensureIndexes(db)
+    scans = checkIndexes(db)
+
+    for scan in scans:
+        print('Collection scan on %s: filter %s, sort %s, collation %s' % (
+            scan['collection'], scan['filter'], scan['sort'], scan['collation']))
+
+    print('%d collection scan(s) found.' % len(scans))
+    return 1 if scans else 0
+
+def calibratePasswords(target, algorithm):
+    """
+    Find the strongest password hash parameters that take about target
+    seconds on this host, and save them for the server. Passwords hashed
+    with other parameters are hashed again when their users log in.
+
+    :param target: (float). Seconds one hash should take.
+    :param algorithm: (str). An algorithm in passwords.ALGORITHMS.
+    """
+
+    params = calibrate(target, algorithm)
+
+    db = pm.MongoClient()['procurement']
+    db['settings'].replace_one({'_id': 'passwordHash'}, dict(params, _id='passwordHash'),
+                               upsert=True)
+
+    print('Password hash parameters: %s (%.3fs per hash)' % (
+        ', '.join('%s=%s' % item for item in sorted(params.items())), timeHash(params)))
+
+def serve(sequenceBlockSize=1):
+
     # setup the email server
 
     email_template_dir = os.path.abspath(os.path.join(
@@ -19,7 +119,11 @@ def main():
     email_handler = EmailHandler(email_user='noreplygettit@gmail.com',
                          email_password='0ddrun knows all',
                          email_inwardly=True,               #set to True for testing; set to False for production to send emails to all
-                         template_dir=email_template_dir)
+                         template_dir=email_template_dir,
+                         workers=2,
+                         # a free gmail account can send to 500 recipients a day
+                         max_per_second=2,
+                         max_per_day=500)
 
     #configure the cherrypy server
     cherrypy.Application.wwwDir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -29,8 +133,19 @@ def main():
         os.path.dirname(os.path.realpath(__file__)),
         '..', '..', 'etc', 'server.conf'))
 
+    # password hashing gets its own processes. Logins past max_pending are
+    # refused, so they can't take all of CherryPy's 10 threads. The hash
+    # parameters are the ones saved by calibrate-passwords, if it was run.
+    params = pm.MongoClient()['procurement']['settings'].find_one({'_id': 'passwordHash'}, {'_id': False})
+    password_hasher = PasswordHasher(workers=2, max_pending=8, params=params)
+
+    # login attempts are kept in MongoDB, like sessions, so that every
+    # server process counts them together
+    login_throttle = LoginThrottle(collection=pm.MongoClient()['procurement']['loginAttempts'])
+
     cherrypy.tree.mount(
-        Root(email_handler, show_debugger=True),
+        Root(email_handler, show_debugger=True, password_hasher=password_hasher,
+             login_throttle=login_throttle, sequenceBlockSize=sequenceBlockSize),
         '/',
         config=server_config)
 
@@ -48,6 +163,11 @@ def main():
         cherrypy.engine.block()
 
     email_handler.die()
+    password_hasher.shutdown()
+
+    for stats in email_handler.workerStats():
+        cherrypy.log('Email worker %(worker)s: %(sent)s sent, %(failed)s failed, '
+                     '%(busySeconds).1fs sending' % stats)
 
 if __name__ == '__main__':
     main()
@@ -3,17 +3,24 @@
 import cherrypy
 import os
 import pymongo as pm
+import threading
 import pandas as pd
 import xlsxwriter
 
 from bson.objectid import ObjectId
+from bson.son import SON
 from io import BytesIO
 from uuid import uuid4
 
-from utdesign_procurement.utils import (authorizedRoles, generateSalt,
-    hashPassword, checkProjectNumbers, checkValidData, checkValidID,
-    checkValidNumber, verifyPassword, requestCreate, convertToCents,
-    getKeywords, getProjectKeywords, getRequestKeywords, lenientConvertToCents)
+from utdesign_procurement.cache import CountCache, UserCache
+from utdesign_procurement.indexes import ensureIndexes
+from utdesign_procurement.passwords import PasswordHasher
+from utdesign_procurement.throttle import LoginThrottle
+from utdesign_procurement.utils import (authorizedRoles, checkProjectNumbers, checkValidData, checkValidID,
+    checkValidNumber, requestCreate, convertToCents,
+    getKeywords, getProjectKeywords, getRequestKeywords, lenientConvertToCents,
+    encodePageToken, getKeysetFilter, SPENT_STATUS_SET, REQUEST_SORT_KEYS,
+    PROJECT_SORT_KEYS, USER_SORT_KEYS, REQUEST_SUMMARY_KEYS)
 
 from datetime import datetime, timedelta
 
@@ -21,9 +28,24 @@ absDir = os.getcwd()
 
 class ApiGateway(object):
 
-    def __init__(self, email_handler):
+    def __init__(self, email_handler, sequenceBlockSize=1, password_hasher=None,
+                 login_throttle=None):
+        """
+        :param email_handler: the EmailHandler used to send notifications
+        :param sequenceBlockSize: (int). How many request numbers this
+            process reserves from the database at a time. 1 reserves a
+            number per request. Larger blocks save round trips, but leave
+            gaps in the numbering whenever the server restarts.
+        :param password_hasher: (PasswordHasher). Hashes passwords for
+            userLogin and userVerify. By default, a pool of one process
+            per CPU.
+        :param login_throttle: (LoginThrottle). Limits login attempts per
+            email and client address. By default, kept in memory.
+        """
 
         self.email_handler = email_handler
+        self.passwordHasher = password_hasher if password_hasher is not None else PasswordHasher()
+        self.loginThrottle = login_throttle if login_throttle is not None else LoginThrottle()
 
         client = pm.MongoClient()
         db = client['procurement']
@@ -36,6 +58,27 @@ class ApiGateway(object):
         self.colSequence = db['sequence']
         self.reportUUIDs = []
 
+        ensureIndexes(db)
+
+        # projects from before the budget ledger have budgets that were
+        # stored once and never kept up to date
+        self._buildBudgetLedgers()
+
+        # counts for the *Pages endpoints. Writes that can change which
+        # documents match a table filter must invalidate their collection.
+        self.countCache = CountCache()
+
+        # the role and project numbers authorizedRoles checks every call
+        # against. Writes that change a user's role, projects or status
+        # must invalidate the user.
+        self.userCache = UserCache(self.colUsers)
+
+        # request numbers reserved by this process but not yet handed out
+        self.sequenceBlockSize = max(1, int(sequenceBlockSize))
+        self._sequenceLock = threading.Lock()
+        self._sequenceNext = 0
+        self._sequenceEnd = 0
+
     # API Functions go below. DO EXPOSE THESE
 
     @cherrypy.expose
@@ -175,6 +218,10 @@ class ApiGateway(object):
 
         # insert the data into the database
         self.colRequests.replace_one(query, myRequest, upsert=True)
+        self.countCache.invalidate(self.colRequests)
+
+        # the request total or status may have changed, so update the budget
+        self._budgetApply(oldRequest, myRequest)
 
         # send emails only if status is pending i.e. request is officially submitted
         if status == 'pending':
@@ -200,25 +247,47 @@ class ApiGateway(object):
 
     def sequence(self):
         """
-        Check the current sequence value of requests, return it,
-        and increment the value.
+        Return the next request number. Numbers are reserved from the
+        database with an atomic $inc, so concurrent requests never get the
+        same number, even across server processes.
+
+        If sequenceBlockSize is greater than 1, a whole block of numbers is
+        reserved at once and handed out from memory.
         """
 
-        query = {"name": "requests"}
-        current = self.colSequence.find_one(query)
+        # without blocks, the database does all of the locking
+        if self.sequenceBlockSize == 1:
+            return self._sequenceReserve(1)
 
-        if not current or 'number' not in current:
-            raise cherrypy.HTTPError(500, "Fatal error! No sequence found for requests.")
+        with self._sequenceLock:
+            if self._sequenceNext >= self._sequenceEnd:
+                self._sequenceNext = self._sequenceReserve(self.sequenceBlockSize)
+                self._sequenceEnd = self._sequenceNext + self.sequenceBlockSize
 
-        current = current['number']
+            number = self._sequenceNext
+            self._sequenceNext += 1
 
-        updateRule = {"$set":
-                          {"number": current + 1}
-                    }
+        return number
+
+    def _sequenceReserve(self, count):
+        """
+        Atomically reserve a number of consecutive request numbers.
+
+        :param count: (int). How many numbers to reserve
+        :return: the first of the reserved numbers
+        """
+
+        # only a sequence with a valid number is incremented, so a broken
+        # sequence doesn't use up numbers on every call
+        current = self.colSequence.find_one_and_update(
+            {"name": "requests", "number": {"$type": "number"}},
+            {"$inc": {"number": count}},
+            return_document=pm.ReturnDocument.BEFORE)
 
-        self.colSequence.update_one(query, updateRule)
+        if not current:
+            raise cherrypy.HTTPError(500, "Fatal error! No sequence found for requests.")
 
-        return int(current)
+        return int(current['number'])
 
 
     @cherrypy.expose
@@ -289,9 +358,15 @@ class ApiGateway(object):
                 "vendor": (string, optional),
                 "projectNumbers": (int or list of ints, optional),
                 "URL": (string, optional),
-                "statuses": (string or list of strings, optional)
+                "statuses": (string or list of strings, optional),
+                "summary": (boolean, optional)
             }
 
+        If summary is true, only the fields shown in lists of requests are
+        returned: _id, status, requestNumber, manager, vendor,
+        projectNumber, URL, requestSubtotal, shippingCost and requestTotal.
+        Use procurementDetail to load the rest of a request.
+
         Returns::
 
             [
@@ -329,6 +404,7 @@ class ApiGateway(object):
         else:
             data = dict()
 
+        summary = checkValidData('summary', data, bool, optional=True, default=False)
 
         filters = []
 
@@ -381,17 +457,60 @@ class ApiGateway(object):
         else:
             bigFilter = {}
 
-        listRequests = []
-        for request in self.colRequests.find(bigFilter):
-            request['_id'] = str(request['_id'])
-            if 'history' in request:
-                for hist in range(len(request['history'])):
-                    if 'timestamp' in request['history'][hist]:
-                        request['history'][hist]['timestamp'] = request['history'][hist]['timestamp'].isoformat(' ')[0:16]
-            listRequests.append(request)
+        if summary:
+            cursor = self.colRequests.find(bigFilter, list(REQUEST_SUMMARY_KEYS))
+        else:
+            cursor = self.colRequests.find(bigFilter)
+
+        listRequests = [self._requestRow(request) for request in cursor]
 
         return listRequests
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    @authorizedRoles("student", "manager", "admin")
+    def procurementDetail(self):
+        """
+        Return the whole of one procurement request, including its items
+        and history. This is the request that procurementStatuses
+        returns only the summary of when "summary" is true.
+
+        Non-admin users may only see requests of their own projects, and
+        managers may not see saved or cancelled requests.
+
+        Expected Input::
+
+            {
+                "_id": (string)
+            }
+
+        :return: the request, as returned by procurementStatuses
+        """
+        # check that we actually have json
+        if hasattr(cherrypy.request, 'json'):
+            data = cherrypy.request.json
+        else:
+            raise cherrypy.HTTPError(400, 'No data was given')
+
+        myID = checkValidID(data)
+
+        findQuery = {'_id': ObjectId(myID)}
+
+        # non-admins are limited to their projectNumbers
+        if cherrypy.session['role'] != 'admin':
+            findQuery['projectNumber'] = {'$in': cherrypy.session['projectNumbers']}
+
+        # managers should not see saved things
+        if cherrypy.session['role'] == 'manager':
+            findQuery['status'] = {'$nin': ['saved', 'cancelled']}
+
+        myRequest = self.colRequests.find_one(findQuery)
+        if myRequest is None:
+            raise cherrypy.HTTPError(400, 'Request not found in database')
+
+        return self._requestRow(myRequest)
+
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @authorizedRoles("student")
@@ -427,28 +546,15 @@ class ApiGateway(object):
                 }
             ]
         }
-        updateQuery = {'_id': ObjectId(myID)}
-        currentState = list(self.colRequests.find(findQuery))[0]["status"]
-        updateRule = {'$set':
-                          {'status': "cancelled"},
-                      "$push":
-                          {"history":
-                            {
-                            "actor": cherrypy.session["email"],
-                            "timestamp": datetime.now(),
-                            "comment": "cancelled by user",
-                            "oldState": currentState,
-                            "newState": "cancelled"
-                            }
-                          }
-                      }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        oldRequest = self.colRequests.find_one(findQuery)
+        if oldRequest is None:
+            raise cherrypy.HTTPError(
+                400, 'Request matching id and status not found in database')
+
+        # the transition only succeeds if nobody changed the status since
+        myRequest = self._transition(myID, oldRequest["status"], "cancelled", "cancelled by user")
+
+        self._budgetApply(oldRequest, myRequest)
 
         # send confirmation emails to students
         teamEmails = self.getTeamEmails(myRequest['projectNumber'])
@@ -499,33 +605,7 @@ class ApiGateway(object):
         # TODO check this action is allowed
 
         myID = checkValidID(data)
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "pending"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            '$set':
-                {'status': "manager approved"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": "approved by manager",
-                    "oldState": "pending",
-                    "newState": "manager approved"
-                    }
-                }
-        }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        myRequest = self._transition(myID, "pending", "manager approved", "approved by manager")
 
         if myRequest['oic'] == 0:
             myRequest['oic'] = 1
@@ -584,33 +664,7 @@ class ApiGateway(object):
         myComment = checkValidData("comment", data, str)
         if myComment == "":
             myComment = "No comment"
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "pending"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            "$set":
-                {'status': "updates for manager"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": myComment,
-                    "oldState": "pending",
-                    "newState": "updates for manager"
-                    }
-                }
-        }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        myRequest = self._transition(myID, "pending", "updates for manager", myComment)
 
         if myRequest['oic'] == 0:
             myRequest['oic'] = 1
@@ -665,33 +719,7 @@ class ApiGateway(object):
         if myComment == "":
             myComment = "No comment"
 
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "manager approved"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            "$set":
-                {'status': "updates for manager"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": myComment,
-                    "oldState": "manager approved",
-                    "newState": "updates for manager"
-                    }
-                }
-        }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        myRequest = self._transition(myID, "manager approved", "updates for manager", myComment)
 
         if myRequest['oic'] == 1:
             myRequest['oic'] = 2
@@ -775,27 +803,17 @@ class ApiGateway(object):
                 {'_id': ObjectId(myID)},
                 {'status': "updates for manager"}
             ]}
-        updateQuery = {'_id': ObjectId(myID)}
+        # the old request is needed to update the budget
+        oldRequest = self.colRequests.find_one(findQuery)
+        if oldRequest is None:
+            raise cherrypy.HTTPError(
+                400, 'Request matching id and status not found in database')
 
-        # find old history and append to myRequest
-        oldHistory = self.colRequests.find_one(findQuery)["history"]   #will have history
-        oldHistory.append({
-            "actor": cherrypy.session["email"],
-            "timestamp": datetime.now(),
-            "comment": "submitted by " + cherrypy.session["email"],
-            "oldState": "updates for manager",
-            "newState": "pending"
+        myRequest = self._transition(myID, "updates for manager", "pending", "submitted by " + cherrypy.session["email"], {
+            "$set": myRequest
         })
-        myRequest["history"] = oldHistory
-
-        updateRule = {"$set": myRequest}
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
 
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementResubmitToManger: missing request with id %s" % myID)
-            return
+        self._budgetApply(oldRequest, myRequest)
 
         # send confirmation emails to students
         teamEmails = self.getTeamEmails(myRequest['projectNumber'])
@@ -861,27 +879,17 @@ class ApiGateway(object):
                 {'_id': ObjectId(myID)},
                 {'status': "updates for admin"}
             ]}
-        updateQuery = {'_id': ObjectId(myID)}
+        # the old request is needed to update the budget
+        oldRequest = self.colRequests.find_one(findQuery)
+        if oldRequest is None:
+            raise cherrypy.HTTPError(
+                400, 'Request matching id and status not found in database')
 
-        # find old history and append to myRequest
-        oldHistory = self.colRequests.find_one(findQuery)["history"]   #will have history
-        oldHistory.append({
-            "actor": cherrypy.session["email"],
-            "timestamp": datetime.now(),
-            "comment": "submitted by " + cherrypy.session["email"],
-            "oldState": "updates for admin",
-            "newState": "manager approved"
+        myRequest = self._transition(myID, "updates for admin", "manager approved", "submitted by " + cherrypy.session["email"], {
+            "$set": myRequest
         })
-        myRequest["history"] = oldHistory
 
-        updateRule = {"$set": myRequest}
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementResubmitToAction: missing request with id %s" % myID)
-            return
+        self._budgetApply(oldRequest, myRequest)
 
         # send confirmation emails to students
         teamEmails = self.getTeamEmails(myRequest['projectNumber'])
@@ -927,34 +935,7 @@ class ApiGateway(object):
         if myComment == "":
             myComment = "No comment"
 
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "manager approved"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            "$set":
-                {'status': "updates for admin"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": myComment,
-                    "oldState": "manager approved",
-                    "newState": "updates for admin"
-                    }
-                }
-        }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        myRequest = self._transition(myID, "manager approved", "updates for admin", myComment)
 
         if myRequest['oic'] == 1:
             myRequest['oic'] = 2
@@ -1004,47 +985,16 @@ class ApiGateway(object):
 
         myID = checkValidID(data)
         shippingAmt = lenientConvertToCents(checkValidData("amount", data, str))
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "manager approved"}
-            ]}
-        try:
-            doc = list(self.colRequests.find(findQuery))[0]
-            totalAmt = int(doc["requestTotal"]) + shippingAmt
-            #~ print()
-            #~ print(totalAmt)
-            #~ print()
-            #~ totalAmt = totalAmt[0]["requestTotal"]
-            updateQuery = {'_id': ObjectId(myID)}
-            updateRule = {
-                "$set":
-                    {'status': "ordered",
-                     'shippingCost': shippingAmt,
-                     'requestTotal': totalAmt},
-                "$push":
-                    {"history":
-                        {
-                        "actor": cherrypy.session["email"],
-                        "timestamp": datetime.now(),
-                        "comment": "marked as ordered by admin",
-                        "oldState": "manager approved",
-                        "newState": "ordered"
-                        }
-                    }
-            }
 
-            self._updateDocument(findQuery, updateQuery, updateRule)
-
-            self.calculateBudget(doc["projectNumber"])
+        # the shipping cost is added onto the request total
+        myRequest = self._transition(myID, "manager approved", "ordered", "marked as ordered by admin", {
+            "$set": {'shippingCost': shippingAmt},
+            "$inc": {'requestTotal': shippingAmt}
+        })
 
-        except:
-            raise cherrypy.HTTPError(400, "Error updating shipping")
-        
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        oldRequest = dict(myRequest, status="manager approved",
+                          requestTotal=myRequest["requestTotal"] - shippingAmt)
+        self._budgetApply(oldRequest, myRequest)
 
         # send confirmation email to admin
         self.email_handler.confirmRequestManagerAdmin(**{
@@ -1087,33 +1037,7 @@ class ApiGateway(object):
             raise cherrypy.HTTPError(400, 'No data was given')
 
         myID = checkValidID(data)
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "ordered"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            "$set":
-                {'status': "ready for pickup"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": "marked as ready by admin",
-                    "oldState": "ordered",
-                    "newState": "ready for pickup"
-                    }
-                }
-        }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        myRequest = self._transition(myID, "ordered", "ready for pickup", "marked as ready by admin")
 
         # send confirmation email to admin
         self.email_handler.confirmRequestManagerAdmin(**{
@@ -1157,33 +1081,7 @@ class ApiGateway(object):
             raise cherrypy.HTTPError(400, 'No data was given')
 
         myID = checkValidID(data)
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "ready for pickup"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            "$set":
-                {'status': "complete"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": "marked as complete by admin",
-                    "oldState": "ready for pickup",
-                    "newState": "complete"
-                    }
-                }
-        }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        myRequest = self._transition(myID, "ready for pickup", "complete", "marked as complete by admin")
 
         # send confirmation email to admin
         self.email_handler.confirmRequestManagerAdmin(**{
@@ -1204,6 +1102,147 @@ class ApiGateway(object):
             'role': 'admin'
         })
 
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    @authorizedRoles("admin")
+    def procurementTransitionBulk(self):
+        """
+        Change the status of many procurement requests at once to ordered,
+        ready for pickup or complete, as procurementOrder, procurementReady
+        and procurementComplete do for a single request.
+
+        All of the requests are updated with one bulk write, the budget of
+        each affected project is updated once, and each team gets one
+        email listing all of its requests.
+
+        Requests that are not in the status before the target status are
+        skipped.
+
+        Expected Input::
+
+            {
+                "_ids": [(string), ...],
+                "status": (string) "ordered", "ready for pickup" or "complete",
+                "amounts": (optional) {
+                    (string) _id: (string) shipping cost, ...
+                }
+            }
+
+        Returns::
+
+            {
+                "updated": [(string) _id, ...],
+                "skipped": [(string) _id, ...]
+            }
+        """
+        # check that we actually have json
+        if hasattr(cherrypy.request, 'json'):
+            data = cherrypy.request.json
+        else:
+            raise cherrypy.HTTPError(400, 'No data was given')
+
+        # new status -> (old status, history comment, confirmation action, notification action)
+        transitions = {
+            "ordered": ("manager approved", "marked as ordered by admin",
+                        "marked as ordered", "ordered"),
+            "ready for pickup": ("ordered", "marked as ready by admin",
+                                 "marked as ready for pickup", "delivered and is ready for pickup"),
+            "complete": ("ready for pickup", "marked as complete by admin",
+                         "marked as picked up", "marked as picked up")
+        }
+
+        newState = checkValidData("status", data, str)
+        if newState not in transitions:
+            raise cherrypy.HTTPError(400, 'Invalid status')
+        oldState, comment, confirmAction, notifyAction = transitions[newState]
+
+        myIDs = checkValidData("_ids", data, list)
+        for myID in myIDs:
+            if not isinstance(myID, str) or not ObjectId.is_valid(myID):
+                raise cherrypy.HTTPError(400, 'Object id not valid')
+        myIDs = list(dict.fromkeys(myIDs))
+        if len(myIDs) == 0:
+            raise cherrypy.HTTPError(400, 'No requests were given')
+
+        amounts = dict()
+        if newState == "ordered":
+            for myID, amount in checkValidData("amounts", data, dict, optional=True, default={}).items():
+                if not isinstance(amount, str):
+                    raise cherrypy.HTTPError(400, 'Invalid amount')
+                amounts[myID] = lenientConvertToCents(amount)
+
+        # every request gets the same history entry, so the requests that
+        # were actually transitioned can be found again afterwards
+        historyEntry = {
+            "actor": cherrypy.session["email"],
+            "timestamp": datetime.now(),
+            "comment": comment,
+            "oldState": oldState,
+            "newState": newState
+        }
+
+        operations = []
+        for myID in myIDs:
+            updateRule = {
+                "$set": {"status": newState},
+                "$push": {"history": historyEntry}
+            }
+            if newState == "ordered":
+                # the shipping cost is added onto the request total
+                shippingAmt = amounts.get(myID, 0)
+                updateRule["$set"]["shippingCost"] = shippingAmt
+                updateRule["$inc"] = {"requestTotal": shippingAmt}
+            operations.append(pm.UpdateOne(
+                {'_id': ObjectId(myID), 'status': oldState}, updateRule))
+        self.colRequests.bulk_write(operations, ordered=False)
+        self.countCache.invalidate(self.colRequests)
+
+        myRequests = list(self.colRequests.find({
+            '_id': {'$in': [ObjectId(myID) for myID in myIDs]},
+            'history': {'$elemMatch': historyEntry}
+        }))
+
+        # update each affected project's budget once
+        deltas = dict()
+        for myRequest in myRequests:
+            shippingAmt = amounts.get(str(myRequest['_id']), 0)
+            oldRequest = dict(myRequest, status=oldState,
+                              requestTotal=myRequest["requestTotal"] - shippingAmt)
+            self._budgetDeltas(oldRequest, myRequest, deltas)
+        self._budgetApplyDeltas(deltas)
+
+        updated = [str(myRequest['_id']) for myRequest in myRequests]
+        skipped = [myID for myID in myIDs if myID not in updated]
+
+        if len(myRequests) > 0:
+            # send one confirmation email to admin
+            self.email_handler.confirmRequestManagerAdminBulk(**{
+                'email': cherrypy.session['email'],
+                'requests': [(myRequest['requestNumber'], myRequest['projectNumber'])
+                             for myRequest in myRequests],
+                'action': confirmAction
+            })
+
+            # send one notification email to each team
+            requestNumbers = dict()
+            for myRequest in myRequests:
+                requestNumbers.setdefault(myRequest['projectNumber'], []).append(
+                    myRequest['requestNumber'])
+            for projectNumber, numbers in requestNumbers.items():
+                self.email_handler.notifyStudentBulk(**{
+                    'teamEmails': self.getTeamEmails(projectNumber),
+                    'requestNumbers': sorted(numbers),
+                    'projectNumber': projectNumber,
+                    'action': notifyAction,
+                    'user': cherrypy.session['email'],
+                    'role': 'admin'
+                })
+
+        return {
+            "updated": updated,
+            "skipped": skipped
+        }
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -1234,33 +1273,9 @@ class ApiGateway(object):
         myComment = checkValidData("comment", data, str)
         if myComment == "":
             myComment = "No comment"
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "pending"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            "$set":
-                {'status': "rejected"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": myComment,
-                    "oldState": "pending",
-                    "newState": "rejected"
-                    }
-                }
-        }
+        myRequest = self._transition(myID, "pending", "rejected", myComment)
 
-        self._updateDocument(findQuery, updateQuery, updateRule)
-
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        self._budgetApply(dict(myRequest, status="pending"), myRequest)
 
         # send confirmation email to manager
         self.email_handler.confirmRequestManagerAdmin(**{
@@ -1320,33 +1335,9 @@ class ApiGateway(object):
         if myComment == "":
             myComment = "No comment"
 
-        findQuery = {
-            '$and': [
-                {'_id': ObjectId(myID)},
-                {'status': "manager approved"}
-            ]}
-        updateQuery = {'_id': ObjectId(myID)}
-        updateRule = {
-            "$set":
-                {'status': "rejected"},
-            "$push":
-                {"history":
-                    {
-                    "actor": cherrypy.session["email"],
-                    "timestamp": datetime.now(),
-                    "comment": myComment,
-                    "oldState": "manager approved",
-                    "newState": "rejected"
-                    }
-                }
-        }
-
-        self._updateDocument(findQuery, updateQuery, updateRule)
+        myRequest = self._transition(myID, "manager approved", "rejected", myComment)
 
-        myRequest = self.colRequests.find_one({'_id': ObjectId(myID)})
-        if myRequest is None:
-            cherrypy.log("Unable to send email in procurementCancel: missing request with id %s" % myID)
-            return
+        self._budgetApply(dict(myRequest, status="manager approved"), myRequest)
 
         # send confirmation email to admin
         self.email_handler.confirmRequestManagerAdmin(**{
@@ -1393,41 +1384,100 @@ class ApiGateway(object):
 
     def calculateBudget(self, projectNumber):
         """
-        Return the available and pending budget for the given project
-        number.
+        Recompute the available and pending budget for the given project
+        number from scratch and store them in the project's budget ledger.
+
+        The ledger is normally kept up to date by _budgetApply as requests
+        and costs change, so this is only needed to rebuild it.
 
         :param projectNumber: int.
-        :return: list containing available and pending budget
+        :return: the project, containing available and pending budget
         """
-        res = list(self.colProjects.find({"projectNumber": projectNumber}))
-        if len(res) <= 0:
+        res = self.calculateBudgets([projectNumber])
+        if projectNumber not in res:
             raise cherrypy.HTTPError(400, "Invalid project number")
 
-        res = res[0]
-        pendingCosts = 0
-        actualCosts = 0
-        requests = self.colRequests.find({"projectNumber": projectNumber})
-        for req in requests:
-            if req["status"] in ["admin approved", "ordered", "ready for pickup", "complete"]:
-                actualCosts += req.get("requestTotal", 0)
-            pendingCosts += req.get("requestTotal", 0)
+        return res[projectNumber]
 
-        miscCosts = 0
-        addCosts = self.colCosts.find({"projectNumber": projectNumber})
-        for co in addCosts:
-            if co["type"] == "refund":
-                miscCosts -= co["amount"]
-            elif co["type"] == "reimbursement":
-                miscCosts += co["amount"]
+    def calculateBudgets(self, projectNumbers=None):
+        """
+        Recompute the available and pending budget of many projects at once
+        and store them in their budget ledgers. This takes the same number
+        of queries no matter how many projects there are.
 
-        res["availableBudget"] = res["defaultBudget"] - actualCosts - miscCosts
-        res["pendingBudget"] = res["defaultBudget"] - pendingCosts - miscCosts
+        :param projectNumbers: list of ints. If None, calculate all projects.
+        :return: dict of projectNumber -> project, containing available
+            and pending budget
+        """
+        projects = self._findBudgetProjects(projectNumbers)
+        budgets = self._computeBudgets(projects, projectNumbers)
 
-        self.colProjects.update_one({"projectNumber": projectNumber}, {"$set": {"availableBudget": res["availableBudget"], "pendingBudget": res["pendingBudget"]}})
+        operations = []
+        for projectNumber, project in projects.items():
+            project["availableBudget"], project["pendingBudget"] = budgets[projectNumber]
+            project["budgetLedger"] = True
+            operations.append(pm.UpdateOne(
+                {"_id": project["_id"]},
+                {"$set": {"availableBudget": project["availableBudget"],
+                          "pendingBudget": project["pendingBudget"],
+                          "budgetLedger": True}}))
 
-        return res
+        if operations:
+            self.colProjects.bulk_write(operations, ordered=False)
 
-    @cherrypy.expose
+        return projects
+
+    def reconcileBudgets(self, projectNumbers=None):
+        """
+        Rebuild the budget ledger of the given projects from scratch and
+        report every project whose ledger had drifted from its requests
+        and costs.
+
+        Returns::
+
+            [
+                {
+                    "projectNumber": (int),
+                    "availableBudget": (int, ledger value before the rebuild),
+                    "pendingBudget": (int, ledger value before the rebuild),
+                    "expectedAvailableBudget": (int),
+                    "expectedPendingBudget": (int)
+                }
+            ]
+
+        :param projectNumbers: list of ints. If None, check all projects.
+        :return: list of projects whose ledger was corrected
+        """
+        projects = self._findBudgetProjects(projectNumbers)
+        budgets = self._computeBudgets(projects, projectNumbers)
+
+        drift = []
+        operations = []
+        for projectNumber, project in projects.items():
+            available, pending = budgets[projectNumber]
+            drifted = (project.get("availableBudget") != available or
+                       project.get("pendingBudget") != pending)
+            if drifted:
+                drift.append({
+                    "projectNumber": projectNumber,
+                    "availableBudget": project.get("availableBudget"),
+                    "pendingBudget": project.get("pendingBudget"),
+                    "expectedAvailableBudget": available,
+                    "expectedPendingBudget": pending
+                })
+            if drifted or not project.get("budgetLedger"):
+                operations.append(pm.UpdateOne(
+                    {"_id": project["_id"]},
+                    {"$set": {"availableBudget": available,
+                              "pendingBudget": pending,
+                              "budgetLedger": True}}))
+
+        if operations:
+            self.colProjects.bulk_write(operations, ordered=False)
+
+        return drift
+
+    @cherrypy.expose
     @cherrypy.tools.json_in()
     @authorizedRoles("admin")
     def addCost(self):
@@ -1474,9 +1524,16 @@ class ApiGateway(object):
             #~ newBudget = list(self.colProjects.find({"projectNumber": cost["projectNumber"]}))[0]["defaultBudget"] - cost["amount"]
             #~ self.colProjects.update_one({"projectNumber": cost["projectNumber"]}, {"$set": {"defaultBudget": newBudget}})
         if cost["type"] == "new budget":
-            self.colProjects.update_one({"projectNumber": cost["projectNumber"]}, {"$set": {"defaultBudget": cost["amount"]}})
+            oldProject = self.colProjects.find_one_and_update({"projectNumber": cost["projectNumber"]}, {"$set": {"defaultBudget": cost["amount"]}})
+            self.countCache.invalidate(self.colProjects)
+            if oldProject is None:
+                raise cherrypy.HTTPError(400, "Invalid project number")
+            difference = cost["amount"] - oldProject["defaultBudget"]
+        else:
+            difference = -self._costContribution(cost)
 
-        self.calculateBudget(cost["projectNumber"])
+        if not self._budgetInc(cost["projectNumber"], difference, difference):
+            raise cherrypy.HTTPError(400, "Invalid project number")
 
         # TODO send confirmation email to admin
         # TODO send notification emails to students
@@ -1567,12 +1624,13 @@ class ApiGateway(object):
                 “sponsorName”: (string),
                 “projectName”: (string),
                 “membersEmails: [(string), …], # list of strings
-                “defaultBudget”: (string),
-                “availableBudget”: (string),
-                “pendingBudget”: (string)
+                “defaultBudget”: (string)
             }
+
+        The available and pending budgets start from the defaultBudget, less
+        any requests and costs already filed under the projectNumber. An
+        availableBudget or pendingBudget in the input is ignored.
         """
-        # TODO defaultBudget, availableBudget, pendingBudget not yet optional
         # TODO default budget from value in database
         # TODO discuss available and pending budget
         # check that we actually have json
@@ -1593,11 +1651,10 @@ class ApiGateway(object):
             else:
                 myProject[key] = myProjectNumber
 
-        for key in ("defaultBudget", "availableBudget", "pendingBudget"):
+        for key in ("defaultBudget",):
             myProject[key] = checkValidData(key, data, str)
             myProject[key] = lenientConvertToCents(myProject[key])
 
-
         for key in ("sponsorName", "projectName"):
             myProject[key] = checkValidData(key, data, str)
 
@@ -1611,12 +1668,21 @@ class ApiGateway(object):
                     raise cherrypy.HTTPError(400, "invalid %s type, emails must be strings" % key)
             myProject[key] = newEmailList
 
+        # seed the budget ledger from the default budget, never from the
+        # client
+        myProject["availableBudget"], myProject["pendingBudget"] = self._computeBudgets(
+            {myProjectNumber: myProject}, [myProjectNumber])[myProjectNumber]
+        myProject["budgetLedger"] = True
+
         # insert the data into the database
         self.colProjects.insert(myProject)
+        self.countCache.invalidate(self.colProjects)
 
         # insert the project into each user's data
         for user in myProject["membersEmails"]:
             self.colUsers.update_one({"email": user}, {"$addToSet": {"projectNumbers": myProject["projectNumber"]}})
+        self.countCache.invalidate(self.colUsers)
+        self.userCache.invalidate(myProject["membersEmails"])
 
         # TODO send confirmation email to admin? maybe not
 
@@ -1712,7 +1778,6 @@ class ApiGateway(object):
         # TODO validate projectNumbers; verify projectNumbers is list of ints
 
         validNum = []
-        result = []
         if 'projectNumbers' in data:
             # if not admin, find only authorized projects
             if cherrypy.session['role'] == 'admin':
@@ -1721,28 +1786,29 @@ class ApiGateway(object):
                 for pNum in data['projectNumbers']:
                     if pNum in cherrypy.session['projectNumbers']:
                         validNum.append(pNum)
-
-            for project in validNum:
-                for res in self.colProjects.find({'projectNumber': project, 'status': 'active'}):
-                    res['_id'] = str(res['_id'])
-                    result.append(res)
-            #~ return result
+            query = {'projectNumber': {'$in': validNum}, 'status': 'active'}
         else:
             if cherrypy.session['role'] != 'admin':
                 validNum = cherrypy.session['projectNumbers']
-                for project in validNum:
-                    for res in self.colProjects.find({'projectNumber': project, 'status': 'active'}):
-                        res['_id'] = str(res['_id'])
-                        result.append(res)
-                #~ return result
+                query = {'projectNumber': {'$in': validNum}, 'status': 'active'}
             else:   # is admin
-                for res in self.colProjects.find({'status': 'active'}):
-                    res['_id'] = str(res['_id'])
-                    result.append(res)
-                #~ return result
+                query = {'status': 'active'}
 
-        for res in result:
-            res = self.calculateBudget(res["projectNumber"])
+        result = []
+        for res in self.colProjects.find(query):
+            res['_id'] = str(res['_id'])
+            result.append(res)
+
+        # budgets are kept up to date by the budget ledger. Only projects
+        # which have never had their ledger built need to be calculated.
+        missing = [res["projectNumber"] for res in result if not res.get("budgetLedger")]
+        if missing:
+            budgets = self.calculateBudgets(missing)
+            for res in result:
+                if res["projectNumber"] in budgets:
+                    res["availableBudget"] = budgets[res["projectNumber"]]["availableBudget"]
+                    res["pendingBudget"] = budgets[res["projectNumber"]]["pendingBudget"]
+                    res["budgetLedger"] = True
         return result
 
     @cherrypy.expose
@@ -1800,13 +1866,16 @@ class ApiGateway(object):
         }
 
         # remove users from the project: first find the current users and remove them
-        oldUsers = [oldProject["membersEmails"] for oldProject in self.colProjects.find(findQuery)]
+        oldUsers = [user for oldProject in self.colProjects.find(findQuery)
+                    for user in oldProject["membersEmails"]]
         for user in oldUsers:
             self.colUsers.update_one({"email": user}, {"$pull": {"projectNumbers": myProject["projectNumber"]}})
 
         # add users from the project
         for user in myProject["membersEmails"]:
             self.colUsers.update_one({"email": user}, {"$addToSet": {"projectNumbers": myProject["projectNumber"]}})
+        self.countCache.invalidate(self.colUsers)
+        self.userCache.invalidate(oldUsers + myProject["membersEmails"])
 
         self._updateDocument(findQuery, findQuery, updateRule, collection=self.colProjects)
 
@@ -1881,6 +1950,8 @@ class ApiGateway(object):
 
         # insert the data into the database
         self.colUsers.insert(myUser)
+        self.countCache.invalidate(self.colUsers)
+        self.userCache.invalidate([myUser['email']])
 
         # create a link (invitation) so the user can set a password
         myInvitation = {
@@ -2043,6 +2114,14 @@ class ApiGateway(object):
         to the database and invited by email.
 
         Otherwise, a 400 error is returned.
+
+        Returns::
+
+            {
+                'emailBacklog': (dict, see emailBacklog)
+            }
+
+        :return: the email backlog, including the invitations just queued
         """
 
         # check that we actually have bulk data
@@ -2090,6 +2169,43 @@ class ApiGateway(object):
                 }
             })
 
+        self.countCache.invalidate(self.colUsers)
+        self.userCache.invalidate([myUser['email'] for myUser in data['valid'] + data['existing']])
+
+        return {'emailBacklog': self.email_handler.backlog()}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @authorizedRoles("admin")
+    def emailBacklog(self):
+        """
+        Report how many emails are waiting to be sent. When 'backpressure'
+        is True, the emails are being queued faster than they can be sent,
+        and mass emails such as bulk invitations should wait.
+
+        Returns::
+
+            {
+                'queued': (int),
+                'collecting': (int, digests being collected),
+                'sending': (int),
+                'failed': (int, emails that ran out of attempts),
+                'oldestDueSeconds': (float or None),
+                'limits': {
+                    'perSecond': (float or None),
+                    'perDay': (float or None),
+                    'secondTokens': (float or None),
+                    'dayRemaining': (float or None),
+                } or None,
+                'drainSeconds': (float or None),
+                'backpressure': (bool),
+            }
+
+        :return: the email backlog
+        """
+
+        return self.email_handler.backlog()
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     @authorizedRoles("admin")
@@ -2438,14 +2554,24 @@ class ApiGateway(object):
 
         # insert all new projects
         operations = []
+        overwritten = []
         for project in data['valid']:
             if project['projectNumber'] in cherrypy.session['bulkProjectsOverwrite']:
                 del project['comment']
                 operations.append(pm.UpdateOne({'projectNumber': project['projectNumber']}, {'$set': project}))
+                overwritten.append(project['projectNumber'])
             else:
+                # a new project starts its budget ledger with nothing spent
+                project['availableBudget'] = project['defaultBudget']
+                project['pendingBudget'] = project['defaultBudget']
+                project['budgetLedger'] = True
                 operations.append(pm.InsertOne(project))
 
         self.colProjects.bulk_write(operations)
+        self.countCache.invalidate(self.colProjects)
+
+        # the default budget of overwritten projects may have changed
+        self.reconcileBudgets(overwritten)
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -2731,7 +2857,7 @@ class ApiGateway(object):
         self._updateDocument(updateQuery, updateQuery, updateRule, collection=self.colUsers)
 
         myUser = self.colUsers.find_one({'_id': ObjectId(myID)})
-
+        self.userCache.invalidate([myUser['email']])
 
         # TODO what if user doesn't have netID or course?
         # TODO separate templates for notifying students or managers or admin?
@@ -2782,7 +2908,9 @@ class ApiGateway(object):
 
         self._updateDocument(findQuery, updateQuery, updateRule, collection=self.colUsers)
 
-        myUser = self.colUsers.find_one(findQuery)
+        # the user no longer matches findQuery, which wants a current user
+        myUser = self.colUsers.find_one(updateQuery)
+        self.userCache.invalidate([myUser['email']])
 
         # TODO send confirmation email to admin?
 
@@ -2798,7 +2926,7 @@ class ApiGateway(object):
         """
         Set the password of a new user. Checks that a provided email is
         matched in the database to a provided UUID. If so, creates and
-        stores a password hash and salt for the user.
+        stores a password hash record for the user. See passwords.hashRecord.
 
         The UUID is a key in an invitation document. An invitation is created when
         a user is first invited to use the system and when a user forgets their password.
@@ -2830,14 +2958,12 @@ class ApiGateway(object):
 
         # invitation may not be None, email may be None
         if invitation and invitation.get('email', None) == myData['email']:
-            salt = generateSalt()
-            hash = hashPassword(myData['password'], salt)
             self.colUsers.update({
                 'email': myData['email']
-            }, {'$set': {
-                'salt': salt,
-                'password': hash
-            }})
+            }, {
+                '$set': {'password': self.passwordHasher.hash(myData['password'])},
+                '$unset': {'salt': ''}
+            })
         else:
             raise cherrypy.HTTPError(403, 'Invalid email for this invitation')
 
@@ -2848,6 +2974,12 @@ class ApiGateway(object):
         Take an email and password, check if the password's hash
         is associated with the given email, and if so, log in a user.
 
+        If the password was hashed with other parameters than the server's,
+        it is hashed again with the server's.
+
+        Too many attempts for one email or from one address are refused with
+        a 429 error before the password is hashed. See LoginThrottle.
+
         Expected Input::
 
             {
@@ -2869,9 +3001,38 @@ class ApiGateway(object):
         for key in ("email", "password"):
             myData[key] = checkValidData(key, data, str)
 
+        address = cherrypy.request.remote.ip
+        attempt = self.loginThrottle.attempt(myData['email'], address)
+
         # verify password of user
         user = self.colUsers.find_one({'email': myData['email']})
-        if user and verifyPassword(user, myData['password']):
+        try:
+            verified = bool(user) and self.passwordHasher.verify(user, myData['password'])
+        except cherrypy.HTTPError:
+            # refused for being too busy, which isn't the user's attempt
+            self.loginThrottle.cancel(myData['email'], address, attempt)
+            raise
+
+        if verified:
+            self.loginThrottle.succeeded(myData['email'], address, attempt)
+            if self.passwordHasher.needsRehash(user):
+                try:
+                    record = self.passwordHasher.hash(myData['password'])
+                except cherrypy.HTTPError:
+                    # the hashing pool is full. Rehash on a later login
+                    # rather than refuse this one.
+                    cherrypy.response.headers.pop('Retry-After', None)
+                    record = None
+                if record is not None:
+                    # only replace the hash that was verified, in case the
+                    # password changed in the meantime
+                    self.colUsers.update_one({
+                        '_id': user['_id'],
+                        'password': user['password']
+                    }, {
+                        '$set': {'password': record},
+                        '$unset': {'salt': ''}
+                    })
             cherrypy.session['email'] = user['email']
             cherrypy.session['role'] = user['role']
             cherrypy.session['projectNumbers'] = user.get('projectNumbers', [])
@@ -2989,12 +3150,12 @@ class ApiGateway(object):
         if hasattr(cherrypy.request, 'json'):
             myFilter = getProjectKeywords(cherrypy.request.json)
         else:
-            myFilter = getProjectKeywords()
+            myFilter = getProjectKeywords({})
         #myFilter['status'] = 'current'
 
         pageSize = 10 # TODO stretch goal make this configurable
 
-        div, remainder = divmod(self.colProjects.find(myFilter).count(), pageSize)
+        div, remainder = divmod(self.countCache.count(self.colProjects, myFilter), pageSize)
         if remainder:
             return div + 1
         else:
@@ -3035,7 +3196,7 @@ class ApiGateway(object):
 
         pageSize = 10 # TODO stretch goal make this configurable
 
-        div, remainder = divmod(self.colUsers.find(myFilter).count(), pageSize)
+        div, remainder = divmod(self.countCache.count(self.colUsers, myFilter), pageSize)
         if remainder:
             return div + 1
         else:
@@ -3069,7 +3230,7 @@ class ApiGateway(object):
 
         pageSize = 10 # TODO stretch goal make this configurable
 
-        div, remainder = divmod(self.colRequests.find(myFilter).count(), pageSize)
+        div, remainder = divmod(self.countCache.count(self.colRequests, myFilter), pageSize)
         if remainder:
             return div + 1
         else:
@@ -3096,12 +3257,24 @@ class ApiGateway(object):
                     (Optional. Default: 'ascending')
                 'pageNumber': (int)
                     (Optional. Default: 0)
+                'pageToken': (string or null)
+                    (Optional. See below)
                 primaryFilter: {
                 },
                 secondaryFilter: {
                 }
             }
 
+        If pageToken is given, pageNumber is ignored and the requests are
+        paged by keyset instead, which costs the same for every page.
+        Pass null for the first page, then the nextPageToken of each
+        response for the page after it. The response is then::
+
+            {
+                "results": [...],
+                "nextPageToken": (string, or null on the last page)
+            }
+
         :return: a list of at most 10 requests
         """
         # check that we actually have json
@@ -3111,48 +3284,62 @@ class ApiGateway(object):
             raise cherrypy.HTTPError(400, 'No data was given')
 
         # prepare the sort, order, and page number
-        sortBy = checkValidData('sortBy', data, str, default='requestNumber',
-                                optional=True)
+        sortBy, order, pageNumber = self._pageArguments(data, REQUEST_SORT_KEYS, 'requestNumber')
 
-        keyList = ('requestNumber', 'projectNumber', 'status', 'vendor', 'URL', 'requestTotal', 'shippingCost')
-        if sortBy not in keyList:
-            raise cherrypy.HTTPError(400, 'sortBy must be any of %s. Not %s' % (', '.join(keyList), sortBy))
+        pageSize = 10 # TODO stretch goal make this configurable
 
-        order = checkValidData('order', data, str, default='ascending',
-                                optional=True)
+        myFilter = getRequestKeywords(data)
 
-        if order not in ('ascending', 'descending'):
-            raise cherrypy.HTTPError(
-                400, 'order must be ascending or descending. Not %s.' % order)
+        page, nextPageToken = self._findPage(self.colRequests, myFilter, sortBy,
+                                             order, pageNumber, pageSize, data)
 
-        direction = pm.ASCENDING if order == 'ascending' else pm.DESCENDING
+        retUsers = [self._requestRow(request) for request in page]
 
-        pageNumber = checkValidData('pageNumber', data, int, default=0,
-                                optional=True)
+        if 'pageToken' in data:
+            return {'results': retUsers, 'nextPageToken': nextPageToken}
+        return retUsers
 
-        if pageNumber < 0:
-            raise cherrypy.HTTPError(
-                400, "Invalid pageNumber format. "
-                     "Expected nonnegative integer. "
-                     "See: %s" % pageNumber)
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    @authorizedRoles("admin")
+    def requestQuery(self):
+        """
+        Return a page of requests, the number of pages and the number of
+        requests in each status, all from one query. This replaces a
+        call to requestData followed by one to requestPages.
 
-        pageSize = 10 # TODO stretch goal make this configurable
+        Expected Input::
 
-        myFilter = getRequestKeywords(data)
+            The same as requestData, including the optional pageToken.
 
-        # finds users who are current only
-        cursor = self.colRequests.find(myFilter).collation({ 'locale': 'en' }).sort(sortBy, direction)
+        Returns::
 
-        retUsers = []
-        for request in cursor[pageSize*pageNumber: pageSize*(pageNumber+1)]:
-            request['_id'] = str(request['_id'])
-            if 'history' in request:
-                for hist in range(len(request['history'])):
-                    if 'timestamp' in request['history'][hist]:
-                        request['history'][hist]['timestamp'] = request['history'][hist]['timestamp'].isoformat(' ')[0:16]
-            retUsers.append(request)
+            {
+                "results": [...], # as returned by requestData
+                "pages": (int), # as returned by requestPages
+                "count": (int), # the number of requests matching the filters
+                "facets": {
+                    (string) status: (int) number of requests, ...
+                },
+                "nextPageToken": (string or null, only if pageToken was given)
+            }
+        """
+        # check that we actually have json
+        if hasattr(cherrypy.request, 'json'):
+            data = cherrypy.request.json
+        else:
+            raise cherrypy.HTTPError(400, 'No data was given')
 
-        return retUsers
+        # prepare the sort, order, and page number
+        sortBy, order, pageNumber = self._pageArguments(data, REQUEST_SORT_KEYS, 'requestNumber')
+
+        pageSize = 10 # TODO stretch goal make this configurable
+
+        myFilter = getRequestKeywords(data)
+
+        return self._queryPage(self.colRequests, myFilter, sortBy, order, pageNumber,
+                               pageSize, data, self._requestRow, facetKey='status')
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -3174,6 +3361,9 @@ class ApiGateway(object):
                     (Optional. Default: "ascending")
                 'pageNumber': (int)
                     (Optional. Default: 0)
+                'pageToken': (string or null)
+                    (Optional. See requestData. Can't be used to sort
+                    by membersEmails)
                 'keywordSearch': (dict)
                     {
                         "projectNumber": (int, optional),
@@ -3206,57 +3396,61 @@ class ApiGateway(object):
             raise cherrypy.HTTPError(400, 'No data was given')
 
         # prepare the sort, order, and page number
-        sortBy = checkValidData('sortBy', data, str, default='projectNumber',
-                                optional=True)
+        sortBy, order, pageNumber = self._pageArguments(data, PROJECT_SORT_KEYS, 'projectNumber')
 
-        if sortBy not in ('projectNumber', 'sponsorName', 'projectName', 'membersEmails', 'defaultBudget'):
-            raise cherrypy.HTTPError(
-                400, 'sortBy must be any of projectNumber, sponsorName, projectName, membersEmails, defaultBudget. Not %s'
-                     % sortBy)
-
-        order = checkValidData('order', data, str, default='ascending',
-                                optional=True)
+        pageSize = 10 # TODO stretch goal make this configurable
 
-        if order not in ('ascending', 'descending'):
-            raise cherrypy.HTTPError(
-                400, 'order must be ascending or descending. Not %s.' % order)
+        myFilter = getProjectKeywords(data.get('keywordSearch', {}))
+        #myFilter['status'] = 'current'
 
-        direction = pm.ASCENDING if order == 'ascending' else pm.DESCENDING
+        page, nextPageToken = self._findPage(self.colProjects, myFilter, sortBy,
+                                             order, pageNumber, pageSize, data)
 
-        pageNumber = checkValidData('pageNumber', data, int, default=0,
-                                optional=True)
+        retProjects = [self._projectRow(proj) for proj in page]
 
-        if pageNumber < 0:
-            raise cherrypy.HTTPError(
-                400, "Invalid pageNumber format. "
-                     "Expected nonnegative integer. "
-                     "See: %s" % pageNumber)
+        if 'pageToken' in data:
+            return {'results': retProjects, 'nextPageToken': nextPageToken}
+        return retProjects
 
-        pageSize = 10 # TODO stretch goal make this configurable
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    @authorizedRoles("admin")
+    def projectQuery(self):
+        """
+        Return a page of projects and the number of pages from one query.
+        This replaces a call to projectData followed by one to
+        projectPages.
 
-        myFilter = getProjectKeywords(data.get('keywordSearch', {}))
-        #myFilter['status'] = 'current'
+        Expected Input::
 
-        # finds projects who are current only
-        projectCursor = self.colProjects.find(myFilter).collation({ 'locale': 'en' }).sort(sortBy, direction)
+            The same as projectData, including the optional pageToken.
 
-        retProjects = []
-        for proj in projectCursor[pageSize*pageNumber: pageSize*(pageNumber+1)]:
-            myProj = dict()
-            myProj['_id'] = str(proj['_id'])
-            for key in ('sponsorName', 'projectName', 'membersEmails', 'defaultBudget'):
-                myProj[key] = proj.get(key, '')
+        Returns::
 
-            myProj['projectNumber'] = proj.get('projectNumber', '')
+            {
+                "results": [...], # as returned by projectData
+                "pages": (int), # as returned by projectPages
+                "count": (int), # the number of projects matching the filters
+                "facets": {},
+                "nextPageToken": (string or null, only if pageToken was given)
+            }
+        """
+        # check that we actually have json
+        if hasattr(cherrypy.request, 'json'):
+            data = cherrypy.request.json
+        else:
+            raise cherrypy.HTTPError(400, 'No data was given')
 
-            # if myUser['role'] != 'admin':
-            #     for key in ('projectNumbers', 'course'):
-            #         myUser[key] = user[key]
+        # prepare the sort, order, and page number
+        sortBy, order, pageNumber = self._pageArguments(data, PROJECT_SORT_KEYS, 'projectNumber')
 
-            retProjects.append(myProj)
+        pageSize = 10 # TODO stretch goal make this configurable
 
+        myFilter = getProjectKeywords(data.get('keywordSearch', {}))
 
-        return retProjects
+        return self._queryPage(self.colProjects, myFilter, sortBy, order, pageNumber,
+                               pageSize, data, self._projectRow)
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -3367,6 +3561,9 @@ class ApiGateway(object):
                     (Optional. Default: "ascending")
                 'pageNumber': (int)
                     (Optional. Default: 0)
+                'pageToken': (string or null)
+                    (Optional. See requestData. Can't be used to sort
+                    by projectNumbers)
                 'keywordSearch': (dict)
                     {
                         "projectNumbers": (int or list of ints, optional),
@@ -3403,33 +3600,7 @@ class ApiGateway(object):
             raise cherrypy.HTTPError(400, 'No data was given')
 
         # prepare the sort, order, and page number
-        sortBy = checkValidData('sortBy', data, str, default='email',
-                                optional=True)
-
-        if sortBy not in ('projectNumbers', 'firstName', 'lastName', 'netID',
-                'email', 'course', 'role', 'status'):
-            raise cherrypy.HTTPError(
-                400, 'sortBy must be any of projectNumbers, firstName, '
-                     'lastName, netID, email, course, role, status. Not %s'
-                     % sortBy)
-
-        order = checkValidData('order', data, str, default='ascending',
-                                optional=True)
-
-        if order not in ('ascending', 'descending'):
-            raise cherrypy.HTTPError(
-                400, 'order must be ascending or descending. Not %s.' % order)
-
-        direction = pm.ASCENDING if order == 'ascending' else pm.DESCENDING
-
-        pageNumber = checkValidData('pageNumber', data, int, default=0,
-                                optional=True)
-
-        if pageNumber < 0:
-            raise cherrypy.HTTPError(
-                400, "Invalid pageNumber format. "
-                     "Expected nonnegative integer. "
-                     "See: %s" % pageNumber)
+        sortBy, order, pageNumber = self._pageArguments(data, USER_SORT_KEYS, 'email')
 
         pageSize = 10 # TODO stretch goal make this configurable
 
@@ -3440,31 +3611,67 @@ class ApiGateway(object):
         myFilter['status'] = 'current'
 
         # finds users who are current only
-        userCursor = self.colUsers.find(myFilter).collation({ 'locale': 'en' }).sort(sortBy, direction)
+        page, nextPageToken = self._findPage(self.colUsers, myFilter, sortBy,
+                                             order, pageNumber, pageSize, data)
 
-        retUsers = []
-        for user in userCursor[pageSize*pageNumber: pageSize*(pageNumber+1)]:
-            myUser = dict()
-            myUser['_id'] = str(user['_id'])
-            for key in ('firstName', 'lastName', 'email', 'status', 'role'):
-                myUser[key] = user.get(key, '')
+        retUsers = [self._userRow(user) for user in page]
 
-            myUser['netID'] = user.get('netID', '')
+        if 'pageToken' in data:
+            return {'results': retUsers, 'nextPageToken': nextPageToken}
+        return retUsers
 
-            if myUser['role'] != 'admin':
-                for key in ('projectNumbers', 'course'):
-                    myUser[key] = user[key]
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    @authorizedRoles("admin")
+    def userQuery(self):
+        """
+        Return a page of current users, the number of pages and the number
+        of users with each role, all from one query. This replaces a call
+        to userData followed by one to userPages.
 
-            retUsers.append(myUser)
+        Expected Input::
 
+            The same as userData, including the optional pageToken.
 
-        return retUsers
+        Returns::
+
+            {
+                "results": [...], # as returned by userData
+                "pages": (int), # as returned by userPages
+                "count": (int), # the number of users matching the filters
+                "facets": {
+                    (string) role: (int) number of users, ...
+                },
+                "nextPageToken": (string or null, only if pageToken was given)
+            }
+        """
+        # check that we actually have json
+        if hasattr(cherrypy.request, 'json'):
+            data = cherrypy.request.json
+        else:
+            raise cherrypy.HTTPError(400, 'No data was given')
+
+        # prepare the sort, order, and page number
+        sortBy, order, pageNumber = self._pageArguments(data, USER_SORT_KEYS, 'email')
+
+        pageSize = 10 # TODO stretch goal make this configurable
+
+        if 'keywordSearch' in data:
+            myFilter = getKeywords(data['keywordSearch'])
+        else:
+            myFilter = dict()
+        myFilter['status'] = 'current'
+
+        return self._queryPage(self.colUsers, myFilter, sortBy, order, pageNumber,
+                               pageSize, data, self._userRow, facetKey='role')
 
     @cherrypy.expose
     def userLogout(self):
         """
-        Logs out a user by expiring their session.
+        Logs out a user by deleting their session and expiring its cookie.
         """
+        cherrypy.session.delete()
         cherrypy.lib.sessions.expire()
 
     @cherrypy.expose
@@ -3574,6 +3781,249 @@ class ApiGateway(object):
         else:
             raise cherrypy.HTTPError(404, "No such file.")
 
+    # helper function, do not expose!
+    def _transition(self, myID, oldState, newState, comment, updateRule=None):
+        """
+        Move a request from oldState to newState and record it in the
+        request's history. The state is checked and the update applied in
+        a single find_one_and_update, so two users acting on the same
+        request at once can't both succeed.
+
+        :param myID: the MongoDB ObjectId of the request, as a string
+        :param oldState: the status the request must currently have
+        :param newState: the status to give the request
+        :param comment: the comment for the history entry
+        :param updateRule: additional update operators to apply, such as
+            {"$set": {...}, "$inc": {...}}
+        :return: the request after the transition
+        """
+
+        updateRule = dict(updateRule or {})
+        updateRule["$set"] = dict(updateRule.get("$set", {}), status=newState)
+        updateRule["$push"] = {
+            "history": {
+                "actor": cherrypy.session["email"],
+                "timestamp": datetime.now(),
+                "comment": comment,
+                "oldState": oldState,
+                "newState": newState
+            }
+        }
+
+        myRequest = self.colRequests.find_one_and_update(
+            {'_id': ObjectId(myID), 'status': oldState},
+            updateRule,
+            return_document=pm.ReturnDocument.AFTER)
+        self.countCache.invalidate(self.colRequests)
+
+        if myRequest is None:
+            raise cherrypy.HTTPError(
+                400, 'Request matching id and status not found in database')
+
+        return myRequest
+
+    # helper function, do not expose!
+    def _pageArguments(self, data, keyList, defaultSortBy):
+        """
+        Parse and check the sortBy, order and pageNumber of a call to one
+        of the data tables.
+
+        :param data: the json data of the call
+        :param keyList: the keys the table can be sorted by
+        :param defaultSortBy: the key to sort by if none is given
+        :return: tuple of sortBy, order and pageNumber
+        """
+        sortBy = checkValidData('sortBy', data, str, default=defaultSortBy,
+                                optional=True)
+
+        if sortBy not in keyList:
+            raise cherrypy.HTTPError(400, 'sortBy must be any of %s. Not %s' % (', '.join(keyList), sortBy))
+
+        # lists can't be paged by keyset
+        if 'pageToken' in data and sortBy in ('projectNumbers', 'membersEmails'):
+            raise cherrypy.HTTPError(400, 'pageToken can not be used to sort by %s' % sortBy)
+
+        order = checkValidData('order', data, str, default='ascending',
+                                optional=True)
+
+        if order not in ('ascending', 'descending'):
+            raise cherrypy.HTTPError(
+                400, 'order must be ascending or descending. Not %s.' % order)
+
+        pageNumber = checkValidData('pageNumber', data, int, default=0,
+                                optional=True)
+
+        if pageNumber < 0:
+            raise cherrypy.HTTPError(
+                400, "Invalid pageNumber format. "
+                     "Expected nonnegative integer. "
+                     "See: %s" % pageNumber)
+
+        return sortBy, order, pageNumber
+
+    # helper function, do not expose!
+    def _requestRow(self, request):
+        """
+        Prepare a request document to be returned by requestData.
+
+        :param request: a request document
+        :return: the request, with a string _id and readable history timestamps
+        """
+        request['_id'] = str(request['_id'])
+        if 'history' in request:
+            for hist in range(len(request['history'])):
+                if 'timestamp' in request['history'][hist]:
+                    request['history'][hist]['timestamp'] = request['history'][hist]['timestamp'].isoformat(' ')[0:16]
+        return request
+
+    # helper function, do not expose!
+    def _projectRow(self, proj):
+        """
+        Pick the fields of a project document returned by projectData.
+
+        :param proj: a project document
+        :return: dict of the project's fields
+        """
+        myProj = dict()
+        myProj['_id'] = str(proj['_id'])
+        for key in ('sponsorName', 'projectName', 'membersEmails', 'defaultBudget'):
+            myProj[key] = proj.get(key, '')
+
+        myProj['projectNumber'] = proj.get('projectNumber', '')
+
+        return myProj
+
+    # helper function, do not expose!
+    def _userRow(self, user):
+        """
+        Pick the fields of a user document returned by userData.
+
+        :param user: a user document
+        :return: dict of the user's fields
+        """
+        myUser = dict()
+        myUser['_id'] = str(user['_id'])
+        for key in ('firstName', 'lastName', 'email', 'status', 'role'):
+            myUser[key] = user.get(key, '')
+
+        myUser['netID'] = user.get('netID', '')
+
+        if myUser['role'] != 'admin':
+            for key in ('projectNumbers', 'course'):
+                myUser[key] = user[key]
+
+        return myUser
+
+    # helper function, do not expose!
+    def _findPage(self, collection, myFilter, sortBy, order, pageNumber, pageSize, data):
+        """
+        Find one page of documents sorted by sortBy, then _id, with the en
+        collation used by the data tables.
+
+        If data has a pageToken, the page after the token is found by
+        keyset pagination. Otherwise, page pageNumber is found by skipping
+        the pages before it.
+
+        :param collection: the collection to search
+        :param myFilter: the filter of the query
+        :param sortBy: the key to sort by
+        :param order: 'ascending' or 'descending'
+        :param pageNumber: the page to find, if data has no pageToken
+        :param pageSize: the number of documents in a page
+        :param data: the json data of the call
+        :return: tuple of the documents in the page and the token of the
+            next page. The token is None on the last page, or if data has
+            no pageToken.
+        """
+        direction = pm.ASCENDING if order == 'ascending' else pm.DESCENDING
+        sort = [(sortBy, direction), ('_id', direction)]
+
+        if 'pageToken' not in data:
+            cursor = collection.find(myFilter).collation({'locale': 'en'}).sort(sort)
+            return list(cursor[pageSize*pageNumber: pageSize*(pageNumber+1)]), None
+
+        pageToken = data['pageToken']
+        if pageToken is not None and not isinstance(pageToken, str):
+            raise cherrypy.HTTPError(400, 'Invalid pageToken')
+
+        # find one extra document to tell whether there is a next page
+        cursor = collection.find(getKeysetFilter(myFilter, sortBy, order, pageToken))
+        page = list(cursor.collation({'locale': 'en'}).sort(sort).limit(pageSize + 1))
+
+        nextPageToken = None
+        if len(page) > pageSize:
+            page = page[:pageSize]
+            nextPageToken = encodePageToken(sortBy, order, page[-1])
+
+        return page, nextPageToken
+
+    # helper function, do not expose!
+    def _queryPage(self, collection, myFilter, sortBy, order, pageNumber, pageSize,
+                   data, row, facetKey=None):
+        """
+        Find a page of documents, the number of documents and, optionally,
+        the number of documents with each value of facetKey, with a $facet
+        aggregation. Pages are found like _findPage finds them.
+
+        The filter and sort run before the $facet, where MongoDB can use
+        the collation indexes for them, so only $skip and $limit run in the
+        facet. Keyset pages are found with _findPage instead, since the
+        count and facets have to ignore the keyset filter.
+
+        :param collection: the collection to search
+        :param myFilter: the filter of the query
+        :param sortBy: the key to sort by
+        :param order: 'ascending' or 'descending'
+        :param pageNumber: the page to find, if data has no pageToken
+        :param pageSize: the number of documents in a page
+        :param data: the json data of the call
+        :param row: function that prepares a document to be returned
+        :param facetKey: the key to count documents by, or None
+        :return: dict of results, pages, count and facets, and
+            nextPageToken if data has a pageToken
+        """
+        direction = pm.ASCENDING if order == 'ascending' else pm.DESCENDING
+        sort = SON([(sortBy, direction), ('_id', direction)])
+
+        facets = {'count': [{'$count': 'count'}]}
+        if facetKey is not None:
+            facets['facets'] = [{'$group': {'_id': '$' + facetKey, 'count': {'$sum': 1}}}]
+
+        if 'pageToken' in data:
+            page, nextPageToken = self._findPage(collection, myFilter, sortBy, order,
+                                                 pageNumber, pageSize, data)
+            pipeline = [
+                {'$match': myFilter},
+                {'$facet': facets}
+            ]
+        else:
+            facets['results'] = [
+                {'$skip': pageSize * pageNumber},
+                {'$limit': pageSize}
+            ]
+            pipeline = [
+                {'$match': myFilter},
+                {'$sort': sort},
+                {'$facet': facets}
+            ]
+
+        found = next(collection.aggregate(pipeline, collation={'locale': 'en'}))
+        count = found['count'][0]['count'] if found['count'] else 0
+
+        ret = {
+            'pages': (count + pageSize - 1) // pageSize,
+            'count': count,
+            'facets': {str(facet['_id']): facet['count'] for facet in found.get('facets', [])}
+        }
+
+        if 'pageToken' in data:
+            ret['nextPageToken'] = nextPageToken
+        else:
+            page = found['results']
+
+        ret['results'] = [row(doc) for doc in page]
+        return ret
+
     # helper function, do not expose!
     def _updateDocument(self, findQuery, updateQuery, updateRule, collection=None):
         """
@@ -3592,10 +4042,198 @@ class ApiGateway(object):
             collection = self.colRequests
         if collection.find(findQuery).count() > 0:
             collection.update_one(updateQuery, updateRule, upsert=False)
+            self.countCache.invalidate(collection)
         else:
             raise cherrypy.HTTPError(
                 400, 'Request matching id and status not found in database')
 
+    # helper function, do not expose!
+    def _budgetContribution(self, request):
+        """
+        Return how much a request takes out of its project's available and
+        pending budget. This is the rule used by the budget ledger.
+
+        :param request: a request document, or None
+        :return: tuple of (available, pending) costs in cents
+        """
+        if not request:
+            return 0, 0
+
+        total = request.get("requestTotal", 0)
+        if request.get("status") in SPENT_STATUS_SET:
+            return total, total
+        else:
+            return 0, total
+
+    # helper function, do not expose!
+    def _costContribution(self, cost):
+        """
+        Return how much a cost (refund or reimbursement) takes out of its
+        project's budget. Refunds put money back into the budget.
+
+        :param cost: a cost document
+        :return: the cost in cents
+        """
+        if cost["type"] == "refund":
+            return -cost["amount"]
+        elif cost["type"] == "reimbursement":
+            return cost["amount"]
+        else:
+            return 0
+
+    # helper function, do not expose!
+    def _buildBudgetLedgers(self):
+        """
+        Rebuild the budget ledger of every project that doesn't have one
+        yet. A project has a ledger once budgetLedger is set on it, which
+        is done wherever its available and pending budget are computed
+        from its requests and costs.
+        """
+        projectNumbers = [project["projectNumber"] for project in
+                          self.colProjects.find({"budgetLedger": {"$ne": True}},
+                                                {"projectNumber": True})]
+        if projectNumbers:
+            drift = self.reconcileBudgets(projectNumbers)
+            cherrypy.log('Built the budget ledger of %d project(s), %d of which had drifted' % (
+                len(projectNumbers), len(drift)))
+
+    # helper function, do not expose!
+    def _findBudgetProjects(self, projectNumbers=None):
+        """
+        Find the projects whose budgets are to be calculated.
+
+        :param projectNumbers: list of ints. If None, find all projects.
+        :return: dict of projectNumber -> project document
+        """
+        if projectNumbers is None:
+            query = {}
+        else:
+            query = {"projectNumber": {"$in": list(projectNumbers)}}
+
+        return {project["projectNumber"]: project for project in self.colProjects.find(query)}
+
+    # helper function, do not expose!
+    def _computeBudgets(self, projects, projectNumbers=None):
+        """
+        Compute the available and pending budget of many projects with one
+        aggregation over their requests and one over their costs. The rules
+        are the same as those of _budgetContribution and _costContribution.
+
+        :param projects: dict of projectNumber -> project document
+        :param projectNumbers: list of ints the projects were found by, or
+            None if they are all of the projects
+        :return: dict of projectNumber -> (availableBudget, pendingBudget)
+        """
+        if projectNumbers is None:
+            match = {}
+        else:
+            match = {"projectNumber": {"$in": list(projects)}}
+
+        requestTotal = {"$ifNull": ["$requestTotal", 0]}
+        requestCosts = self.colRequests.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": "$projectNumber",
+                "actualCosts": {"$sum": {"$cond": [
+                    {"$in": ["$status", list(SPENT_STATUS_SET)]}, requestTotal, 0]}},
+                "pendingCosts": {"$sum": requestTotal}
+            }}
+        ])
+
+        miscCosts = self.colCosts.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": "$projectNumber",
+                "miscCosts": {"$sum": {"$cond": [
+                    {"$eq": ["$type", "reimbursement"]}, "$amount",
+                    {"$cond": [{"$eq": ["$type", "refund"]}, {"$subtract": [0, "$amount"]}, 0]}]}}
+            }}
+        ])
+
+        costs = {projectNumber: [0, 0, 0] for projectNumber in projects}
+        for group in requestCosts:
+            if group["_id"] in costs:
+                costs[group["_id"]][0] = group["actualCosts"]
+                costs[group["_id"]][1] = group["pendingCosts"]
+        for group in miscCosts:
+            if group["_id"] in costs:
+                costs[group["_id"]][2] = group["miscCosts"]
+
+        budgets = dict()
+        for projectNumber, (actualCosts, pendingCosts, misc) in costs.items():
+            defaultBudget = projects[projectNumber]["defaultBudget"]
+            budgets[projectNumber] = (defaultBudget - actualCosts - misc,
+                                      defaultBudget - pendingCosts - misc)
+        return budgets
+
+    # helper function, do not expose!
+    def _budgetDeltas(self, oldRequest, newRequest, deltas=None):
+        """
+        Find the change in budget caused by a request changing from
+        oldRequest to newRequest, and add it to a dict of deltas.
+        oldRequest is None for a new request.
+
+        :param oldRequest: the request before the change, or None
+        :param newRequest: the request after the change, or None
+        :param deltas: dict of deltas to add to. A new dict if None.
+        :return: dict of projectNumber -> [availableDelta, pendingDelta]
+        """
+        if deltas is None:
+            deltas = dict()
+
+        for request, sign in ((oldRequest, 1), (newRequest, -1)):
+            if request and "projectNumber" in request:
+                available, pending = self._budgetContribution(request)
+                delta = deltas.setdefault(request["projectNumber"], [0, 0])
+                delta[0] += sign * available
+                delta[1] += sign * pending
+
+        return deltas
+
+    # helper function, do not expose!
+    def _budgetApply(self, oldRequest, newRequest):
+        """
+        Update the budget ledger of the affected projects after a request
+        changes from oldRequest to newRequest.
+
+        :param oldRequest: the request before the change, or None
+        :param newRequest: the request after the change, or None
+        """
+        self._budgetApplyDeltas(self._budgetDeltas(oldRequest, newRequest))
+
+    # helper function, do not expose!
+    def _budgetApplyDeltas(self, deltas):
+        """
+        Update the budget ledger of many projects with one bulk write.
+
+        :param deltas: dict of projectNumber -> [availableDelta, pendingDelta],
+            as returned by _budgetDeltas
+        """
+        operations = []
+        for projectNumber, (available, pending) in deltas.items():
+            if available or pending:
+                operations.append(pm.UpdateOne(
+                    {"projectNumber": projectNumber},
+                    {"$inc": {"availableBudget": available, "pendingBudget": pending}}))
+
+        if len(operations) > 0:
+            self.colProjects.bulk_write(operations, ordered=False)
+
+    # helper function, do not expose!
+    def _budgetInc(self, projectNumber, available, pending):
+        """
+        Atomically add to the available and pending budget of a project.
+
+        :param projectNumber: int.
+        :param available: the change in available budget, in cents
+        :param pending: the change in pending budget, in cents
+        :return: True if the project exists
+        """
+        result = self.colProjects.update_one(
+            {"projectNumber": projectNumber},
+            {"$inc": {"availableBudget": available, "pendingBudget": pending}})
+        return result.matched_count > 0
+
     # helper function, do not expose!
     # TODO edge cases?
     def getTeamEmails(self, projectNumber):
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+from bson import json_util
+
+class CountCache(object):
+    """
+    Caches the number of documents matching a filter, so the *Pages
+    endpoints don't count the same documents on every table render.
+
+    Counts are kept per collection. Whoever writes to a collection in a
+    way that could change which documents match a filter must call
+    invalidate() for that collection. Counts also expire after ttl
+    seconds, which bounds how stale they get when another process
+    writes to the database.
+
+    :param ttl: (float). How many seconds a count is kept for.
+    :param clock: (function). Returns the current time in seconds.
+    """
+
+    def __init__(self, ttl=60, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._counts = dict()
+        self._generations = dict()
+
+    def count(self, collection, myFilter):
+        """
+        Return the number of documents in a collection matching a filter.
+        If the filter is empty, the count is estimated from the
+        collection's metadata instead of counted.
+
+        :param collection: a pymongo Collection
+        :param myFilter: (dict). A filter as made by getKeywords,
+            getProjectKeywords or getRequestKeywords.
+        :return: (int).
+        """
+        key = json_util.dumps(myFilter, sort_keys=True)
+        now = self.clock()
+
+        with self._lock:
+            counts = self._counts.setdefault(collection.name, dict())
+            if key in counts and counts[key][1] > now:
+                return counts[key][0]
+            generation = self._generations.get(collection.name, 0)
+
+        if myFilter:
+            count = collection.count_documents(myFilter)
+        else:
+            count = collection.estimated_document_count()
+
+        with self._lock:
+            # don't keep a count that was invalidated while it was counted
+            if self._generations.get(collection.name, 0) == generation:
+                self._counts.setdefault(collection.name, dict())[key] = (count, now + self.ttl)
+
+        return count
+
+    def invalidate(self, collection):
+        """
+        Forget every count of a collection.
+
+        :param collection: a pymongo Collection
+        """
+        with self._lock:
+            self._counts.pop(collection.name, None)
+            self._generations[collection.name] = self._generations.get(collection.name, 0) + 1
+
+class UserCache(object):
+    """
+    Caches the role and project numbers of users, so authorizedRoles can
+    check every call against the user's current membership without
+    querying the users collection every time.
+
+    Whoever changes a user's role, project numbers or status must call
+    invalidate() for that user's email. Entries also expire after ttl
+    seconds, which bounds how stale they get when another process writes
+    to the database.
+
+    :param collection: the users collection
+    :param ttl: (float). How many seconds a user is kept for.
+    :param clock: (function). Returns the current time in seconds.
+    """
+
+    def __init__(self, collection, ttl=30, clock=time.monotonic):
+        self.collection = collection
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._users = dict()
+        self._generation = 0
+
+    def get(self, email):
+        """
+        Return the role and project numbers of a user.
+
+        Returns::
+
+            {
+                'role': (string),
+                'projectNumbers': [(int), ...]
+            }
+
+        :param email: (str). The email of the user.
+        :return: dict, or None if there is no user with the email, or the
+            user was removed.
+        """
+        now = self.clock()
+
+        with self._lock:
+            if email in self._users and self._users[email][1] > now:
+                return self._users[email][0]
+            generation = self._generation
+
+        user = self.collection.find_one({'email': email, 'status': {'$ne': 'removed'}},
+                                        {'role': True, 'projectNumbers': True})
+        if user is None:
+            context = None
+        else:
+            context = {
+                'role': user.get('role'),
+                'projectNumbers': user.get('projectNumbers', [])
+            }
+
+        with self._lock:
+            # don't keep a user that was invalidated while it was read
+            if self._generation == generation:
+                self._users[email] = (context, now + self.ttl)
+
+        return context
+
+    def invalidate(self, emails=None):
+        """
+        Forget some users, so the next call reads them again.
+
+        :param emails: (iterable of str). The emails of the users, or None
+            to forget every user.
+        """
+        with self._lock:
+            if emails is None:
+                self._users.clear()
+            else:
+                for email in emails:
+                    self._users.pop(email, None)
+            self._generation += 1
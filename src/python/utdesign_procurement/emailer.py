@@ -1,51 +1,299 @@
 #!/usr/bin/env python3
 
+import atexit
+import os
+import shutil
 import smtplib
+import stat
+import tempfile
+import threading
+import time
 import traceback
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from functools import partial
 from mako.lookup import TemplateLookup
-from multiprocessing import Process, Queue
+from multiprocessing import Array, Process, Queue
+from queue import Empty, Full
 from string import capwords
 
+from utdesign_procurement.metrics import Metrics, MetricsRecorder, collect
+from utdesign_procurement.outbox import Outbox, recipientList
+from utdesign_procurement.ratelimit import DAY, RateLimiter
 from utdesign_procurement.utils import convertToDollarStr
 
-def email_listen(emailer, queue):
+# the fields of a worker's stats Array
+STAT_SENT, STAT_FAILED, STAT_BUSY = range(3)
+
+# how many metrics the workers can record before the handler collects
+# them. Metrics recorded past that are dropped.
+METRICS_QUEUE_SIZE = 10000
+
+# the longest a worker waits for the rate limiter while holding a claim.
+# Emails that would wait longer are given back to the outbox.
+LIMITER_SLEEP = 1
+
+def email_listen(emailer, outbox, queue, stats=None, poll=5, renderer=None,
+                 limiter=None, metrics=None):
     """
-    Listens for any messages that come through the queue and calls the
-    emailer's send function appropriately
+    Sends the emails in the outbox until a 'die' header comes through the
+    queue. The queue is only a doorbell: a 'wake' header means an email was
+    just added to the outbox. The outbox is also checked when the next retry
+    comes due, or after poll seconds at most.
+
+    Emails with the same content are claimed and sent together, up to the
+    emailer's max_recipients_per_message. Emails queued as a template and
+    its arguments, and digests of held notifications, are rendered here.
 
     :param emailer:
+    :param outbox:
     :param queue:
+    :param stats: (multiprocessing.Array). If given, the number of emails
+        sent and failed and the seconds spent sending are added to it.
+    :param poll: (float). The most seconds to wait between checks of the
+        outbox.
+    :param renderer: (EmailRenderer). Renders the emails. If None, only
+        emails queued as HTML can be sent.
+    :param limiter: (RateLimiter). Limits how fast emails are sent, if given.
+    :param metrics: (Metrics or MetricsRecorder). If given, how long emails
+        waited to be sent, and how many were sent, failed or postponed, are
+        recorded in it.
     :return:
     """
 
-    function_lut = {
-        'send': emailer.emailSend,
-    }
-
     while True:
-        packet = queue.get()
+        batch = outbox.claimBatch(emailer.max_recipients_per_message)
 
-        try:
-            header, kwargs = packet
-        except:
+        if not batch:
+            due = outbox.secondsUntilDue()
+            try:
+                header = queue.get(timeout=poll if due is None else min(due, poll))
+            except Empty:
+                continue
+            if header == 'die':
+                break
             continue
 
-        func = function_lut.get(header, None)
-        if func:
-            try:
-                func(**kwargs)
-            except Exception as e:
-                print("Emailer encountered an exception.")
-                traceback.print_exc()
-        elif header == 'die':
-            break
+        # the emails in a batch have the same content, so they are sent in
+        # one SMTP transaction, to all of their recipients
+        to = []
+        for message in batch:
+            to.extend(address for address in recipientList(message['to'])
+                      if address not in to)
+
+        if limiter is not None:
+            wait = limiter.reserve(len(to))
+            while 0 < wait <= LIMITER_SLEEP:
+                time.sleep(wait)
+                wait = limiter.reserve(len(to))
+            if wait:
+                outbox.postpone(batch, wait)
+                if metrics is not None:
+                    metrics.inc('emails_postponed_total', value=len(batch))
+                continue
+
+        start = time.perf_counter()
+        try:
+            if renderer is not None:
+                subject, html = renderer.render(batch[0])
+            else:
+                subject, html = batch[0]['subject'], batch[0]['html']
+
+            emailer.emailSend(to=to if len(batch) > 1 else batch[0]['to'],
+                              subject=subject, html=html, bcc=len(batch) > 1)
+            for message in batch:
+                outbox.sent(message)
+            result = STAT_SENT
+
+            if metrics is not None:
+                now = outbox.clock()
+                for message in batch:
+                    metrics.observe('email_latency_seconds',
+                                    (now - message['queuedAt']).total_seconds(),
+                                    {'lane': message['lane']})
+                metrics.inc('emails_sent_total', {'template': templateName(batch[0])}, len(batch))
+        except Exception as e:
+            print("Emailer encountered an exception.")
+            traceback.print_exc()
+            for message in batch:
+                outbox.failed(message, repr(e))
+            result = STAT_FAILED
+
+            if metrics is not None:
+                metrics.inc('email_failures_total', {'exception': type(e).__name__}, len(batch))
+
+        if limiter is not None:
+            limiter.done(len(to))
+
+        if stats is not None:
+            with stats.get_lock():
+                stats[result] += len(batch)
+                stats[STAT_BUSY] += time.perf_counter() - start
+
+    emailer.close()
+
+def templateName(message):
+    """
+    :param message: (dict). An email document from the outbox.
+    :return: (str). The name of the email's template, 'digest.html' for a
+        digest, or 'html' for an email queued as HTML.
+    """
+    if 'items' in message:
+        return 'digest.html'
+    return message.get('template', 'html')
+
+def countRequests(count):
+    """
+    :param count: (int). How many requests an email is about.
+    :return: (str). For example, '1 Request Has' or '3 Requests Have'.
+    """
+    return '1 Request Has' if count == 1 else '%d Requests Have' % count
+
+def checkPrivateDirectory(path):
+    """
+    Make sure that only this user can write to a directory.
+
+    :param path: (str). The directory.
+    :return:
+    """
+    info = os.stat(path)
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        raise ValueError('%s belongs to another user' % path)
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ValueError('%s can be written by other users' % path)
+
+class TemplateCache(object):
+    """
+    Compiles the email templates once, and remembers recent renders, so
+    that the same notification isn't rendered again for every recipient
+    or every call with the same arguments.
+
+    Compiled templates are kept in module_directory, so the email workers
+    load them instead of compiling them again. Mako imports the compiled
+    templates as Python modules, so the directory must belong to this user
+    and be writable by no one else. Otherwise, a ValueError is raised.
+
+    :param template_dir: (str). The directory for the mako templates.
+    :param module_directory: (str). The directory for compiled templates.
+        It is made if it doesn't exist. By default, a new private directory
+        in the system's temporary directory, removed when the server exits.
+    :param size: (int). How many renders to remember.
+    """
+
+    def __init__(self, template_dir, module_directory=None, size=256):
+        if module_directory is None:
+            module_directory = tempfile.mkdtemp(prefix='utdesign_procurement_mako_')
+            atexit.register(shutil.rmtree, module_directory, ignore_errors=True)
+        else:
+            os.makedirs(module_directory, mode=0o700, exist_ok=True)
+            checkPrivateDirectory(module_directory)
+
+        self.template_dir = template_dir
+        self.module_directory = module_directory
+        self.size = size
+        self.lookup = TemplateLookup(directories=[template_dir],
+                                     module_directory=module_directory)
+
+        self._lock = threading.Lock()
+        self._renders = OrderedDict()
+
+    def __getstate__(self):
+        # another process loads the compiled templates from module_directory
+        state = self.__dict__.copy()
+        del state['lookup'], state['_lock'], state['_renders']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lookup = TemplateLookup(directories=[self.template_dir],
+                                     module_directory=self.module_directory)
+        self._lock = threading.Lock()
+        self._renders = OrderedDict()
+
+    def warm(self):
+        """
+        Compile every template in the template directory.
+
+        :return:
+        """
+        for name in sorted(os.listdir(self.template_dir)):
+            if name.endswith('.html'):
+                self.lookup.get_template(name)
+
+    def render(self, name, **renderArgs):
+        """
+        Render a template, or return the render from the last time it was
+        rendered with the same arguments.
+
+        :param name: (str). The name of the template.
+        :param renderArgs: the arguments of the template.
+        :return: (str). The rendered template
+        """
+        key = (name, repr(sorted(renderArgs.items())))
+        with self._lock:
+            if key in self._renders:
+                self._renders.move_to_end(key)
+                return self._renders[key]
+
+        body = self.lookup.get_template(name).render(**renderArgs)
+
+        with self._lock:
+            self._renders[key] = body
+            if len(self._renders) > self.size:
+                self._renders.popitem(last=False)
+        return body
+
+class EmailRenderer(object):
+    """
+    Renders the emails claimed from the outbox, in the email workers.
+
+    :param templates: (TemplateCache). The email templates.
+    :param domain: (str). The domain name of the system.
+    """
+
+    def __init__(self, templates, domain):
+        self.templates = templates
+        self.domain = domain
+
+    def render(self, message):
+        """
+        Render an email from the outbox. It is either already rendered, a
+        template and its arguments, or a digest of held notifications.
+
+        :param message: (dict). An outbox document.
+        :return: (subject, html)
+        """
+        if 'items' in message:
+            items = message['items']
+            subject = 'You Have %d New %s' % (len(items), 'Notification' if len(items) == 1 else 'Notifications')
+            return subject, self.templates.render('digest.html', domain=self.domain, items=items)
+
+        if 'template' in message:
+            return message['subject'], self.templates.render(message['template'], **message['renderArgs'])
+
+        return message['subject'], message['html']
 
 class EmailHandler(object):
     """
-    Fills templates and sends emails using an Emailer in a separate thread.
+    Queues templated emails and sends them using an Emailer in separate
+    worker processes, which render them and all take them from the same
+    queue. With more than
+    one worker, a slow SMTP exchange doesn't hold up every other email.
+
+    Emails are written to an Outbox in MongoDB, in a lane (see
+    outbox.LANE_PRIORITIES), and the workers claim them from there. The queue only
+    wakes the workers up when there is a new email.
+
+    If max_per_second or max_per_day is set, the workers share a
+    RateLimiter, which counts every recipient of every email. The daily
+    limit counts the recipients sent to in the last day from the outbox.
+
+    If digest_window is set, routine notifications to managers and admins
+    are held, and each recipient gets one digest of them per window
+    instead. Security email is never held.
 
     In the various function names "confirm" refers to confirming that an
     action taken by a user has in fact been completed successfully.
@@ -59,54 +307,259 @@ class EmailHandler(object):
     :param template_dir: (str). The directory for the mako templates.
     :param domain: (str). The domain name of the system. This will be used
         to populate URLs in templates.
+    :param workers: (int). How many worker processes send emails.
+    :param outbox: (Outbox). Where emails wait to be sent. By default, the
+        outbox collection of the procurement database.
+    :param digest_window: (float). Seconds to hold notifications for before
+        sending them as a digest, or None to send every notification as it
+        happens.
+    :param module_directory: (str). The directory for compiled templates.
+        See TemplateCache.
+    :param max_per_second: (float). The most recipients to send to per
+        second, or None for no limit.
+    :param max_per_day: (float). The most recipients to send to per day,
+        or None for no limit.
+    :param backlog_limit: (int). How many queued emails are too many, for
+        backlog().
+    :param metrics: (Metrics). Where the handler and its workers record
+        metrics of the email pipeline. See currentMetrics().
+    :param smtp: keyword arguments for the Emailer's SMTP connections, such
+        as smtp_host, smtp_port, smtp_ssl and max_messages_per_connection.
     """
 
     def __init__(self, email_user, email_password, email_inwardly,
-                 template_dir, domain='utdprocure.utdallas.edu'):
+                 template_dir, domain='utdprocure.utdallas.edu', workers=2,
+                 outbox=None, digest_window=None, module_directory=None,
+                 max_per_second=None, max_per_day=None, backlog_limit=1000,
+                 metrics=None, **smtp):
 
         self.domain = domain
-        self.templateLookup = TemplateLookup(template_dir)
-
-        self.queue = Queue()
-        self.emailer = Emailer(self.queue, email_user, email_password, email_inwardly)
-        self.process = Process(target=email_listen, args=(self.emailer, self.queue))
-        self._started = False
+        self.templates = TemplateCache(template_dir, module_directory)
+        self.templates.warm()
+        self.outbox = outbox if outbox is not None else Outbox()
+        self.digest_window = digest_window
+        self.renderer = EmailRenderer(self.templates, domain)
+        self.backlog_limit = backlog_limit
+        if max_per_second is None and max_per_day is None:
+            self.limiter = None
+        else:
+            self.limiter = RateLimiter(max_per_second, max_per_day,
+                                       sentToday=partial(self.outbox.recipientsSentSince, DAY))
+
+        # the workers send their metrics to a thread in this process, which
+        # records them in self.metrics
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metricsQueue = Queue(maxsize=METRICS_QUEUE_SIZE)
+        recorder = MetricsRecorder(self.metricsQueue)
+        self.collector = threading.Thread(target=collect, args=(self.metrics, self.metricsQueue),
+                                          daemon=True)
+
+        # a worker only needs one wake up to check the outbox, so the queue
+        # doesn't need to hold more than one per worker
+        self.queue = Queue(maxsize=workers)
+        self.emailer = Emailer(self.queue, email_user, email_password, email_inwardly,
+                               metrics=recorder, **smtp)
+        self.stats = [Array('d', 3) for i in range(workers)]
+        self.processes = [
+            Process(target=email_listen, args=(self.emailer, self.outbox, self.queue, stats),
+                    kwargs={'renderer': self.renderer, 'limiter': self.limiter,
+                            'metrics': recorder})
+            for stats in self.stats
+        ]
+        self._started = None
 
     def start(self):
         """
-        Start the email queue listening process
+        Start the email queue listening processes
 
         :return:
         """
-        self.process.start()
-        self._started = True
+        self.collector.start()
+        for process in self.processes:
+            process.start()
+        self._started = time.monotonic()
 
     def die(self):
         """
-        End the email queue listening process gracefully
+        End the email queue listening processes gracefully. Emails that are
+        due are sent first. Emails waiting for a retry stay in the outbox
+        until the next start.
 
         :return:
         """
 
-        if self._started:
-            self.queue.put(('die', {}))
-            self.process.join()
+        if self._started is not None:
+            # a worker only takes a sentinel once the outbox has nothing
+            # due, and stops at the first one it takes
+            for process in self.processes:
+                self.queue.put('die')
+            for process in self.processes:
+                process.join()
+
+            self.metricsQueue.put(None)
+            self.collector.join()
+
+    def workerStats(self):
+        """
+        Report how many emails each worker has sent, and how fast.
+
+        Returns::
+
+            [
+                {
+                    'worker': (int),
+                    'alive': (bool),
+                    'sent': (int),
+                    'failed': (int),
+                    'busySeconds': (float),
+                    'sentPerSecond': (float),
+                },
+                ...
+            ]
+
+        sentPerSecond is the worker's throughput since the handler started.
+
+        :return: list of dicts, one per worker
+        """
+
+        uptime = time.monotonic() - self._started if self._started is not None else 0
+
+        report = []
+        for worker, (process, stats) in enumerate(zip(self.processes, self.stats)):
+            with stats.get_lock():
+                sent, failed, busy = stats[:]
+            report.append({
+                'worker': worker,
+                'alive': process.is_alive(),
+                'sent': int(sent),
+                'failed': int(failed),
+                'busySeconds': busy,
+                'sentPerSecond': sent / uptime if uptime else 0.0,
+            })
+        return report
+
+    def backlog(self):
+        """
+        Report how many emails are waiting to be sent, and whether that is
+        more than the workers can keep up with.
+
+        Returns::
+
+            {
+                'queued': (int),
+                'collecting': (int),
+                'sending': (int),
+                'failed': (int),
+                'oldestDueSeconds': (float or None),
+                'limits': (dict or None, see RateLimiter.status),
+                'drainSeconds': (float or None, how long the queued emails
+                    take to send at the per second limit),
+                'backpressure': (bool, True if more than backlog_limit
+                    emails are queued),
+            }
+
+        :return: dict
+        """
+
+        backlog = self.outbox.depth()
+        backlog['limits'] = self.limiter.status() if self.limiter is not None else None
+        if self.limiter is not None and self.limiter.perSecond:
+            backlog['drainSeconds'] = backlog['queued'] / self.limiter.perSecond
+        else:
+            backlog['drainSeconds'] = None
+        backlog['backpressure'] = backlog['queued'] > self.backlog_limit
+        return backlog
 
-    def send(self, to, subject, body):
+    def currentMetrics(self):
+        """
+        Update the gauges of the outbox's depth, and get the metrics of the
+        email pipeline.
+
+        Histograms::
+
+            email_latency_seconds{lane}: from queueing an email to sending it
+            smtp_connect_seconds: connecting and logging in to the SMTP server
+            smtp_send_seconds: sending one email, to all of its recipients
+
+        Counters::
+
+            emails_queued_total{lane, template}
+            emails_held_total{template}: notifications held for a digest
+            emails_sent_total{template}
+            email_failures_total{exception}: failed attempts, by exception type
+            emails_postponed_total: emails given back by the rate limiter
+
+        Gauges::
+
+            email_outbox{status}: emails queued, collecting, sending or failed
+            email_oldest_due_seconds: how long the oldest due email has waited
+
+        :return: (Metrics). Export it with snapshot() or prometheus().
+        """
+
+        depth = self.outbox.depth()
+        for status in ('queued', 'collecting', 'sending', 'failed'):
+            self.metrics.set('email_outbox', depth[status], {'status': status})
+        self.metrics.set('email_oldest_due_seconds', depth['oldestDueSeconds'] or 0)
+        return self.metrics
+
+    def send(self, to, subject, body, lane='normal', digest=False):
         """
         Send an email to an address, with a subject, with a given body.
 
         :param to: (str). The recipient email address.
         :param subject: (str). The subject of the email.
         :param body: (str). The HTML content of the message to send.
+        :param lane: (str). 'security', 'normal' or 'bulk'. See outbox.LANE_PRIORITIES.
+        :param digest: (bool). If True, and digests are on, the email is
+            held for the recipient's next digest instead. Only its subject
+            is listed in the digest.
         :return:
         """
 
-        self.queue.put(('send', {
-            'to': to,
-            'subject': subject,
-            'html': body
-        }))
+        self._enqueue(to, subject, lane, digest, html=body)
+
+    def sendTemplate(self, to, subject, template, renderArgs, lane='normal', digest=False):
+        """
+        Send an email rendered from a template. Only the name of the
+        template and its arguments are queued, and an email worker renders
+        it, so the request that caused the email doesn't wait for it.
+
+        :param to: (str). The recipient email address.
+        :param subject: (str). The subject of the email.
+        :param template: (str). The name of the template.
+        :param renderArgs: (dict). The arguments of the template. They are
+            stored in MongoDB until the email is sent.
+        :param lane: (str). 'security', 'normal' or 'bulk'. See outbox.LANE_PRIORITIES.
+        :param digest: (bool). See send().
+        :return:
+        """
+
+        self._enqueue(to, subject, lane, digest, template=template, renderArgs=renderArgs)
+
+    # helper function, do not expose!
+    def _enqueue(self, to, subject, lane, digest, **content):
+        """
+        Put an email in the outbox, or hold it for a digest, and wake a
+        worker up.
+
+        :param content: either the html of the email, or its template and
+            renderArgs
+        :return:
+        """
+
+        template = content.get('template') or 'html'
+        if digest and self.digest_window is not None and lane != 'security':
+            self.outbox.hold(to, subject, self.digest_window)
+            self.metrics.inc('emails_held_total', {'template': template})
+        else:
+            self.outbox.put(to, subject, lane=lane, **content)
+            self.metrics.inc('emails_queued_total', {'lane': lane, 'template': template})
+        try:
+            self.queue.put_nowait('wake')
+        except Full:
+            # every worker already has a wake up waiting
+            pass
 
     def userAdd(self, email=None, uuid=None):
         """
@@ -118,9 +571,8 @@ class EmailHandler(object):
         :return:
         """
 
-        template = self.templateLookup.get_template('userAdd.html')
-        body = template.render(uuid=uuid, domain=self.domain)
-        self.send(email, 'UTDesign GettIt Invite', body)
+        renderArgs = {'uuid': uuid, 'domain': self.domain}
+        self.sendTemplate(email, 'UTDesign GettIt Invite', 'userAdd.html', renderArgs, lane='security')
 
     def userForgotPassword(self, email=None, uuid=None, expiration=None):
         """
@@ -132,9 +584,8 @@ class EmailHandler(object):
         :return:
         """
 
-        template = self.templateLookup.get_template('userForgotPassword.html')
-        body = template.render(uuid=uuid, domain=self.domain, expiration=expiration)
-        self.send(email, 'UTDesign GettIt Password Reset', body)
+        renderArgs = {'uuid': uuid, 'domain': self.domain, 'expiration': expiration}
+        self.sendTemplate(email, 'UTDesign GettIt Password Reset', 'userForgotPassword.html', renderArgs, lane='security')
 
     def procurementSave(self, teamEmails=None, request=None):
         """
@@ -161,14 +612,10 @@ class EmailHandler(object):
         subject = 'New Request For Project %s' % int(request['projectNumber'])
 
         # send email to students
-        template = self.templateLookup.get_template('procurementSaveStudent.html')
-        body = template.render(**renderArgs)
-        self.send(teamEmails, subject, body)
+        self.sendTemplate(teamEmails, subject, 'procurementSaveStudent.html', renderArgs)
 
         # send email to manager
-        template = self.templateLookup.get_template('procurementSaveManager.html')
-        body = template.render(**renderArgs)
-        self.send(request['manager'], subject, body)
+        self.sendTemplate(request['manager'], subject, 'procurementSaveManager.html', renderArgs)
 
     def procurementEditAdmin(self, teamEmails=None, request=None):
         """
@@ -195,10 +642,8 @@ class EmailHandler(object):
         }
 
         subject = 'Request #%s Updated For Project %s' % (int(request['requestNumber']), int(request['projectNumber']))
-        template = self.templateLookup.get_template('procurementUpdated.html')
-        body = template.render(**renderArgs)
-        self.send(teamEmails, subject, body)
-        self.send(request['manager'], subject, body)
+        self.sendTemplate(teamEmails, subject, 'procurementUpdated.html', renderArgs)
+        self.sendTemplate(request['manager'], subject, 'procurementUpdated.html', renderArgs)
 
     def confirmStudent(self, teamEmails, requestNumber, projectNumber, action):
         """
@@ -220,9 +665,7 @@ class EmailHandler(object):
         }
         capitalAction = capwords(action)
         subject = 'Request #%s Has Been %s' % (int(requestNumber), capitalAction)
-        template = self.templateLookup.get_template('confirmStudent.html')
-        body = template.render(**renderArgs)
-        self.send(teamEmails, subject, body)
+        self.sendTemplate(teamEmails, subject, 'confirmStudent.html', renderArgs)
 
     def confirmRequestManagerAdmin(self, email, requestNumber, projectNumber, action):
         """
@@ -243,9 +686,7 @@ class EmailHandler(object):
         }
         capitalAction = capwords(action)
         subject = 'Request #%s Has Been %s' % (int(requestNumber), capitalAction)
-        template = self.templateLookup.get_template('confirmRequestManagerAdmin.html')
-        body = template.render(**renderArgs)
-        self.send(email, subject, body)
+        self.sendTemplate(email, subject, 'confirmRequestManagerAdmin.html', renderArgs)
 
     def notifyStudent(self, teamEmails, requestNumber, projectNumber, action,
                       user, role):
@@ -270,9 +711,53 @@ class EmailHandler(object):
         }
         capitalAction = capwords(action)
         subject = 'Request #%s Has Been %s' % (int(requestNumber), capitalAction)
-        template = self.templateLookup.get_template('notifyStudent.html')
-        body = template.render(**renderArgs)
-        self.send(teamEmails, subject, body)
+        self.sendTemplate(teamEmails, subject, 'notifyStudent.html', renderArgs)
+
+    def confirmRequestManagerAdminBulk(self, email, requests, action):
+        """
+        Sends one email to some email address confirming that some
+        action has happened to many requests.
+
+        :param email:
+        :param requests: list of (requestNumber, projectNumber) tuples
+        :param action:
+        :return:
+        """
+        renderArgs = {
+            'domain': self.domain,
+            'requests': [(int(requestNumber), int(projectNumber))
+                         for requestNumber, projectNumber in requests],
+            'action': action
+        }
+        capitalAction = capwords(action)
+        subject = '%s Been %s' % (countRequests(len(requests)), capitalAction)
+        self.sendTemplate(email, subject, 'confirmRequestManagerAdminBulk.html', renderArgs, lane='bulk')
+
+    def notifyStudentBulk(self, teamEmails, requestNumbers, projectNumber,
+                          action, user, role):
+        """
+        Sends one notification about many requests of a project to
+        some students.
+
+        :param teamEmails:
+        :param requestNumbers: list of request numbers
+        :param projectNumber:
+        :param action:
+        :param user:
+        :param role:
+        :return:
+        """
+        renderArgs = {
+            'domain': self.domain,
+            'requestNumbers': [int(requestNumber) for requestNumber in requestNumbers],
+            'projectNumber': int(projectNumber),
+            'action': action,
+            'user': user,
+            'role': role
+        }
+        capitalAction = capwords(action)
+        subject = '%s Been %s' % (countRequests(len(requestNumbers)), capitalAction)
+        self.sendTemplate(teamEmails, subject, 'notifyStudentBulk.html', renderArgs, lane='bulk')
 
     def notifyRequestManager(self, email, projectNumber, requestNumber):
         """
@@ -290,9 +775,7 @@ class EmailHandler(object):
             'projectNumber': int(projectNumber)
         }
         subject = "Request #%s Has Been Submitted to You" % (int(requestNumber))
-        template = self.templateLookup.get_template('notifyRequestManager.html')
-        body = template.render(**renderArgs)
-        self.send(email, subject, body)
+        self.sendTemplate(email, subject, 'notifyRequestManager.html', renderArgs, digest=True)
 
     def notifyRequestAdmin(self, adminEmails, projectNumber, requestNumber):
         """
@@ -310,9 +793,7 @@ class EmailHandler(object):
             'projectNumber': int(projectNumber)
         }
         subject = "Request #%s Needs Admin Approval" % (int(requestNumber))
-        template = self.templateLookup.get_template('notifyRequestAdmin.html')
-        body = template.render(**renderArgs)
-        self.send(adminEmails, subject, body)
+        self.sendTemplate(adminEmails, subject, 'notifyRequestAdmin.html', renderArgs, digest=True)
 
     def notifyCancelled(self, email, projectNumber, requestNumber):
         """
@@ -330,9 +811,7 @@ class EmailHandler(object):
             'projectNumber': int(projectNumber)
         }
         subject = "Request #%s Has Been Cancelled" % (int(requestNumber))
-        template = self.templateLookup.get_template('notifyCancelled.html')
-        body = template.render(**renderArgs)
-        self.send(email, subject, body)
+        self.sendTemplate(email, subject, 'notifyCancelled.html', renderArgs)
 
     def notifyRejectedAdmin(self, adminEmails, projectNumber, requestNumber, manager):
         """
@@ -352,9 +831,7 @@ class EmailHandler(object):
             'manager': manager
         }
         subject = "Request #%s Has Been Rejected" % (int(requestNumber))
-        template = self.templateLookup.get_template('notifyRejectedAdmin.html')
-        body = template.render(**renderArgs)
-        self.send(adminEmails, subject, body)
+        self.sendTemplate(adminEmails, subject, 'notifyRejectedAdmin.html', renderArgs)
 
     def notifyUserEdit(self, email, projectNumbers, firstName, lastName, netID, course):
         """
@@ -378,9 +855,7 @@ class EmailHandler(object):
             'course': course
         }
         subject = "You Have Been Edited!"
-        template = self.templateLookup.get_template('notifyUserEdit.html')
-        body = template.render(**renderArgs)
-        self.send(email, subject, body)
+        self.sendTemplate(email, subject, 'notifyUserEdit.html', renderArgs)
 
     def notifyUpdateManager(self, email, projectNumber, requestNumber):
         """
@@ -398,9 +873,7 @@ class EmailHandler(object):
             'requestNumber': int(requestNumber)
         }
         subject = "Request #%d Has Been Sent For Updates!" % (requestNumber)
-        template = self.templateLookup.get_template('notifyUpdateManager.html')
-        body = template.render(**renderArgs)
-        self.send(email, subject, body)
+        self.sendTemplate(email, subject, 'notifyUpdateManager.html', renderArgs, digest=True)
 
     def notifyUserRemove(self, email, firstName, lastName):
         """
@@ -418,9 +891,7 @@ class EmailHandler(object):
             'lastName': lastName
         }
         subject = "Your GettIt Account Has Been Deactivated"
-        template = self.templateLookup.get_template('notifyUserRemove.html')
-        body = template.render(**renderArgs)
-        self.send(email, subject, body)
+        self.sendTemplate(email, subject, 'notifyUserRemove.html', renderArgs)
 
     def notifyProjectAdd(self, teamEmails, projectNumber, projectName):
         """
@@ -437,9 +908,7 @@ class EmailHandler(object):
             'projectName': str(projectName),
         }
         subject = "You Have Been Added to Project %s" % (int(projectNumber))
-        template = self.templateLookup.get_template('notifyProjectAdd.html')
-        body = template.render(**renderArgs)
-        self.send(teamEmails, subject, body)
+        self.sendTemplate(teamEmails, subject, 'notifyProjectAdd.html', renderArgs)
 
     def notifyProjectInactivate(self, teamEmails, projectNumber, projectName):
         """
@@ -457,9 +926,7 @@ class EmailHandler(object):
             'projectName': projectName,
         }
         subject = "Project Number %s Has Been Inactivated" % (int(projectNumber))
-        template = self.templateLookup.get_template('notifyProjectInactivate.html')
-        body = template.render(**renderArgs)
-        self.send(teamEmails, subject, body)
+        self.sendTemplate(teamEmails, subject, 'notifyProjectInactivate.html', renderArgs)
 
     def notifyProjectEdit(self, membersEmails, projectNumber, projectName, sponsorName):
         """
@@ -479,9 +946,7 @@ class EmailHandler(object):
             'sponsorName': sponsorName
         }
         subject = "Project Number %s Has Been Edited" % (int(projectNumber))
-        template = self.templateLookup.get_template('notifyProjectEdit.html')
-        body = template.render(**renderArgs)
-        self.send(membersEmails, subject, body)
+        self.sendTemplate(membersEmails, subject, 'notifyProjectEdit.html', renderArgs)
 
     def notifyStudentRejected(self, teamEmails, requestNumber, projectNumber, action,
                       user, role, comment):
@@ -506,29 +971,214 @@ class EmailHandler(object):
         capitalAction = capwords(action)
         print(capitalAction)
         subject = 'Request #%s Has Been %s' % (int(requestNumber), capitalAction)
-        template = self.templateLookup.get_template('notifyStudentRejected.html')
-        body = template.render(**renderArgs)
-        self.send(teamEmails, subject, body)
+        self.sendTemplate(teamEmails, subject, 'notifyStudentRejected.html', renderArgs)
+
+class SMTPConnection(object):
+    """
+    An open, logged in connection to an SMTP server.
+
+    :param server: (smtplib.SMTP). The connection.
+    :param clock: (function). Returns the current time in seconds.
+    """
+
+    def __init__(self, server, clock):
+        self.server = server
+        self.clock = clock
+        self.messages = 0
+        self.lastUsed = clock()
+
+    def alive(self):
+        """
+        Check that the server hasn't dropped the connection, with a NOOP.
+
+        :return: True if the connection can still be used
+        """
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        """
+        Quit the connection. Errors are ignored, since the connection
+        is being thrown away.
+
+        :return:
+        """
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+class SMTPPool(object):
+    """
+    Keeps logged in SMTP connections open between messages, so that each
+    message doesn't pay for its own TCP and TLS handshake and login.
+
+    A connection that has been idle for longer than keepalive seconds is
+    checked with a NOOP before it is used again, and replaced if the
+    server has dropped it. A connection is closed once it has sent
+    max_messages messages, since servers limit how many messages they
+    accept on one connection.
+
+    :param connect: (function). Opens and logs in a new smtplib.SMTP.
+    :param size: (int). The most idle connections to keep open.
+    :param max_messages: (int). The most messages to send on one connection.
+    :param keepalive: (float). Seconds a connection may be idle before it
+        is checked with a NOOP.
+    :param clock: (function). Returns the current time in seconds.
+    """
+
+    def __init__(self, connect, size=1, max_messages=100, keepalive=30,
+                 clock=time.monotonic):
+        self.connect = connect
+        self.size = size
+        self.max_messages = max_messages
+        self.keepalive = keepalive
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._idle = []
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for one message. It is returned to the pool
+        afterwards, unless something went wrong with it.
+
+        :return: context manager giving a smtplib.SMTP
+        """
+        conn = self._acquire()
+        try:
+            yield conn.server
+        except:
+            conn.close()
+            raise
+
+        conn.messages += 1
+        conn.lastUsed = self.clock()
+        self._release(conn)
+
+    def close(self):
+        """
+        Close every idle connection.
+
+        :return:
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+
+            if conn is None:
+                return SMTPConnection(self.connect(), self.clock)
+            if self.clock() - conn.lastUsed < self.keepalive or conn.alive():
+                return conn
+            conn.close()
+
+    def _release(self, conn):
+        if conn.messages < self.max_messages:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(conn)
+                    return
+        conn.close()
 
 class Emailer(object):
     """
     Manages email connections and sends HTML emails in MIMEMultipart messages
+
+    Connections are kept open in an SMTPPool between messages. The pool is
+    made the first time an email is sent, so that it belongs to the email
+    process rather than to the process that made the Emailer.
+
+    :param smtp_host: (str). The SMTP server.
+    :param smtp_port: (int). The SMTP server's port.
+    :param smtp_ssl: (bool). If True, connect with SSL. Otherwise, connect
+        in plain text. Plain text is meant for local test servers.
+    :param max_messages_per_connection: (int). How many emails to send on
+        one connection before reconnecting.
+    :param pool_size: (int). How many idle connections to keep open.
+    :param keepalive: (float). Seconds a connection may be idle before it
+        is checked with a NOOP before being used.
+    :param max_recipients_per_message: (int). The most recipients of one
+        email, when emails with the same content are sent together.
+    :param metrics: (Metrics or MetricsRecorder). If given, the time spent
+        connecting to the SMTP server and sending emails is recorded in it.
     """
 
-    def __init__(self, email_queue, email_user, email_password, email_inwardly):
+    def __init__(self, email_queue, email_user, email_password, email_inwardly,
+                 smtp_host='smtp.gmail.com', smtp_port=465, smtp_ssl=True,
+                 max_messages_per_connection=100, pool_size=1, keepalive=30,
+                 max_recipients_per_message=50, metrics=None):
         self.email_queue = email_queue
         self.email_user = email_user
         self.email_password = email_password
         self.email_inwardly = email_inwardly
 
-    def _emailDo(self, func):
-        server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_ssl = smtp_ssl
+        self.max_messages_per_connection = max_messages_per_connection
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.max_recipients_per_message = max_recipients_per_message
+        self.metrics = metrics
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = SMTPPool(self._connect, size=self.pool_size,
+                                  max_messages=self.max_messages_per_connection,
+                                  keepalive=self.keepalive)
+        return self._pool
+
+    def __getstate__(self):
+        # connections can't be sent to another process
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def _connect(self):
+        start = time.perf_counter()
+        if self.smtp_ssl:
+            server = smtplib.SMTP_SSL(self.smtp_host, self.smtp_port)
+        else:
+            server = smtplib.SMTP(self.smtp_host, self.smtp_port)
         server.ehlo()
-        server.login(self.email_user, self.email_password)
-        func(server)
-        server.quit()
+        if self.email_password:
+            server.login(self.email_user, self.email_password)
+        if self.metrics is not None:
+            self.metrics.observe('smtp_connect_seconds', time.perf_counter() - start)
+        return server
+
+    def _emailDo(self, func):
+        # a pooled connection may have been dropped by the server since it
+        # was last checked, so try once more on a new connection
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as server:
+                    return func(server)
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+
+    def close(self):
+        """
+        Close the pooled SMTP connections.
+
+        :return:
+        """
+        if self._pool is not None:
+            self._pool.close()
 
-    def emailSend(self, to=None, subject=None, html=None):
+    def emailSend(self, to=None, subject=None, html=None, bcc=False):
         """
         Send an email with some HTML content to some email address with some
         subject.
@@ -536,6 +1186,8 @@ class Emailer(object):
         :param to: (str). An email address to send to.
         :param subject: (str). A subject for the email.
         :param html: (str). An HTML content to send in the email.
+        :param bcc: (bool). If True, the recipients aren't listed in the
+            email's To header. For emails sent to several groups at once.
         :return:
         """
 
@@ -550,11 +1202,16 @@ class Emailer(object):
         msg['From'] = self.email_user
         if isinstance(to, str):
             msg['To'] = to
+        elif bcc:
+            msg['To'] = 'undisclosed-recipients:;'
         else:
             msg['To'] = ','.join(to)
 
         msg.attach(MIMEText("This email is meant to be HTML.", 'plain'))
         msg.attach(MIMEText(html, 'html'))
 
+        start = time.perf_counter()
         self._emailDo(
             lambda server: server.sendmail(self.email_user, to, msg.as_string()))
+        if self.metrics is not None:
+            self.metrics.observe('smtp_send_seconds', time.perf_counter() - start)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import cherrypy
+import pymongo as pm
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+# the codes of the errors create_indexes raises when an index conflicts
+# with an existing one: the same keys under another name, or the same name
+# with other keys or options
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+
+# the collation used by the sorted tables in requestData, projectData and
+# userData. A sort with a collation can only use an index with the same one.
+# The tables sort by _id after their sort key, so those indexes end in _id.
+EN_COLLATION = {'locale': 'en'}
+
+# seconds sent and failed emails are kept in the outbox before MongoDB
+# deletes them. Sent emails are counted by the daily rate limit, so they
+# have to be kept for more than a day.
+SENT_EMAIL_TTL = 7 * 24 * 3600
+FAILED_EMAIL_TTL = 30 * 24 * 3600
+
+# collection name -> indexes the API needs.
+# create_indexes is a no-op for indexes that already exist, so these can be
+# created every time the server starts. See ensureIndexes for conflicts.
+REQUIRED_INDEXES = {
+    'requests': [
+        IndexModel([('projectNumber', pm.ASCENDING), ('status', pm.ASCENDING)],
+                   name='projectNumber_status'),
+        IndexModel([('requestNumber', pm.ASCENDING)],
+                   name='requestNumber'),
+        IndexModel([('requestNumber', pm.ASCENDING), ('_id', pm.ASCENDING)],
+                   name='requestNumber_id_en', collation=EN_COLLATION),
+    ],
+    'users': [
+        IndexModel([('email', pm.ASCENDING)], name='email'),
+        IndexModel([('projectNumbers', pm.ASCENDING)], name='projectNumbers'),
+        IndexModel([('role', pm.ASCENDING)], name='role'),
+        IndexModel([('status', pm.ASCENDING), ('email', pm.ASCENDING), ('_id', pm.ASCENDING)],
+                   name='status_email_id_en', collation=EN_COLLATION),
+    ],
+    'projects': [
+        IndexModel([('projectNumber', pm.ASCENDING), ('status', pm.ASCENDING)],
+                   name='projectNumber_status'),
+        IndexModel([('status', pm.ASCENDING), ('projectNumber', pm.ASCENDING), ('_id', pm.ASCENDING)],
+                   name='status_projectNumber_id_en', collation=EN_COLLATION),
+    ],
+    'costs': [
+        IndexModel([('projectNumber', pm.ASCENDING)], name='projectNumber'),
+    ],
+    'invitations': [
+        IndexModel([('uuid', pm.ASCENDING)], name='uuid'),
+    ],
+    'sequence': [
+        IndexModel([('name', pm.ASCENDING)], name='name'),
+    ],
+    'outbox': [
+        IndexModel([('status', pm.ASCENDING), ('priority', pm.ASCENDING),
+                    ('nextAttempt', pm.ASCENDING)],
+                   name='status_priority_nextAttempt'),
+        IndexModel([('status', pm.ASCENDING), ('nextAttempt', pm.ASCENDING)],
+                   name='status_nextAttempt'),
+        IndexModel([('contentHash', pm.ASCENDING), ('status', pm.ASCENDING)],
+                   name='contentHash_status'),
+        IndexModel([('status', pm.ASCENDING), ('sentAt', pm.ASCENDING)],
+                   name='status_sentAt'),
+        IndexModel([('digestTo', pm.ASCENDING)], name='digestTo_collecting',
+                   unique=True, partialFilterExpression={'status': 'collecting'}),
+        IndexModel([('sentAt', pm.ASCENDING)], name='sentAt_ttl',
+                   expireAfterSeconds=SENT_EMAIL_TTL,
+                   partialFilterExpression={'status': 'sent'}),
+        IndexModel([('failedAt', pm.ASCENDING)], name='failedAt_ttl',
+                   expireAfterSeconds=FAILED_EMAIL_TTL,
+                   partialFilterExpression={'status': 'failed'}),
+    ],
+}
+
+# (collection name, filter, sort, collation) of the queries the API runs
+# most. checkIndexes runs explain() on each of these.
+HOT_QUERIES = [
+    ('requests', {'projectNumber': 0, 'status': 'pending'}, None, None),
+    ('requests', {'projectNumber': {'$in': [0]}}, None, None),
+    ('requests', {'requestNumber': 0}, None, None),
+    ('requests', {}, [('requestNumber', pm.ASCENDING), ('_id', pm.ASCENDING)], EN_COLLATION),
+    ('users', {'email': ''}, None, None),
+    ('users', {'projectNumbers': 0}, None, None),
+    ('users', {'role': 'admin'}, None, None),
+    ('users', {'status': 'current'}, [('email', pm.ASCENDING), ('_id', pm.ASCENDING)], EN_COLLATION),
+    ('projects', {'projectNumber': 0}, None, None),
+    ('projects', {'projectNumber': {'$in': [0]}, 'status': 'active'}, None, None),
+    ('projects', {'status': 'active'}, [('projectNumber', pm.ASCENDING), ('_id', pm.ASCENDING)], EN_COLLATION),
+    ('costs', {'projectNumber': 0}, None, None),
+    ('invitations', {'uuid': ''}, None, None),
+    ('sequence', {'name': 'requests'}, None, None),
+    ('outbox', {'status': 'queued'}, [('priority', pm.ASCENDING), ('nextAttempt', pm.ASCENDING)], None),
+    ('outbox', {'status': 'queued'}, [('nextAttempt', pm.ASCENDING)], None),
+]
+
+def ensureIndexes(db):
+    """
+    Create every index in REQUIRED_INDEXES. Indexes that already exist
+    are left alone.
+
+    If a required index conflicts with an existing one, an index of ours
+    with the same name is made again with the required keys and options.
+    An index with the same keys under another name, such as one made by
+    hand, serves the same queries, so it is kept and ours is skipped.
+
+    :param db: the procurement database
+    """
+    for collection, indexes in REQUIRED_INDEXES.items():
+        try:
+            db[collection].create_indexes(indexes)
+        except OperationFailure:
+            for index in indexes:
+                _createIndex(db[collection], index)
+
+def checkIndexes(db):
+    """
+    Run explain() on every query in HOT_QUERIES and find the ones whose
+    winning plan scans a whole collection.
+
+    :param db: the procurement database
+    :return: list of dicts with the collection, filter, sort and collation
+        of every query that does a collection scan
+    """
+    scans = []
+    for collection, myFilter, sort, collation in HOT_QUERIES:
+        cursor = db[collection].find(myFilter)
+        if collation is not None:
+            cursor = cursor.collation(collation)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _planStages(plan):
+            scans.append({
+                'collection': collection,
+                'filter': myFilter,
+                'sort': sort,
+                'collation': collation
+            })
+    return scans
+
+def _createIndex(collection, index):
+    """
+    Create one index of REQUIRED_INDEXES, resolving conflicts with existing
+    indexes like ensureIndexes describes.
+
+    :param collection: the collection to index
+    :param index: (IndexModel).
+    :return:
+    """
+    try:
+        collection.create_indexes([index])
+    except OperationFailure as e:
+        if e.code not in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+            raise
+
+        name = index.document['name']
+        if name not in collection.index_information():
+            cherrypy.log('Index %s on %s already exists under another name: %s' % (
+                name, collection.name, e))
+            return
+
+        collection.drop_index(name)
+        collection.create_indexes([index])
+
+def _planStages(plan):
+    """
+    List the stages of a query plan returned by explain(). With the slot
+    based engine of MongoDB 5 and later, the stages are under queryPlan.
+
+    :param plan: (dict). A plan or stage of a plan.
+    :return: list of stage names
+    """
+    stages = [plan.get('stage')]
+    if 'queryPlan' in plan:
+        stages.extend(_planStages(plan['queryPlan']))
+    if 'inputStage' in plan:
+        stages.extend(_planStages(plan['inputStage']))
+    for inputStage in plan.get('inputStages', []):
+        stages.extend(_planStages(inputStage))
+    return stages
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import threading
+
+from queue import Full
+
+# upper bounds, in seconds, of the histogram buckets. They span SMTP
+# exchanges of a few milliseconds to emails that waited an hour to be sent.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300, 900, 3600)
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms, which can be exported as JSON or in
+    the Prometheus text format.
+
+    Every metric can have labels, a dict of str -> str. Each set of labels
+    is counted separately.
+
+    :param buckets: (tuple of float). The upper bounds of histogram buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._gauges = dict()
+        self._histograms = dict()
+
+    def inc(self, name, labels=None, value=1):
+        """
+        Add to a counter.
+
+        :param name: (str). The name of the counter.
+        :param labels: (dict).
+        :param value: (float). How much to add.
+        :return:
+        """
+        key = _labelsKey(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """
+        Set a gauge.
+
+        :param name: (str). The name of the gauge.
+        :param value: (float).
+        :param labels: (dict).
+        :return:
+        """
+        with self._lock:
+            self._gauges.setdefault(name, dict())[_labelsKey(labels)] = value
+
+    def observe(self, name, value, labels=None):
+        """
+        Add an observation to a histogram.
+
+        :param name: (str). The name of the histogram.
+        :param value: (float).
+        :param labels: (dict).
+        :return:
+        """
+        key = _labelsKey(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, dict())
+            if key not in series:
+                series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            histogram = series[key]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def record(self, event):
+        """
+        Record an event sent by a MetricsRecorder.
+
+        :param event: (tuple). (method name, metric name, value, labels)
+        :return:
+        """
+        method, name, value, labels = event
+        if method == 'inc':
+            self.inc(name, labels, value)
+        elif method == 'set':
+            self.set(name, value, labels)
+        elif method == 'observe':
+            self.observe(name, value, labels)
+
+    def snapshot(self):
+        """
+        Export every metric as JSON.
+
+        Returns::
+
+            {
+                'counters': {
+                    (name): [{'labels': (dict), 'value': (float)}, ...],
+                    ...
+                },
+                'gauges': (same as counters),
+                'histograms': {
+                    (name): [
+                        {
+                            'labels': (dict),
+                            'count': (int),
+                            'sum': (float),
+                            'buckets': [[(upper bound), (cumulative count)], ...]
+                        },
+                        ...
+                    ],
+                    ...
+                }
+            }
+
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'counters': {name: [{'labels': dict(key), 'value': value}
+                                    for key, value in sorted(series.items())]
+                             for name, series in self._counters.items()},
+                'gauges': {name: [{'labels': dict(key), 'value': value}
+                                  for key, value in sorted(series.items())]
+                           for name, series in self._gauges.items()},
+                'histograms': {name: [{'labels': dict(key),
+                                       'count': histogram['count'],
+                                       'sum': histogram['sum'],
+                                       'buckets': self._cumulative(histogram)}
+                                      for key, histogram in sorted(series.items())]
+                               for name, series in self._histograms.items()},
+            }
+
+    def prometheus(self):
+        """
+        Export every metric in the Prometheus text format.
+
+        :return: (str).
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        for kind in ('counters', 'gauges'):
+            for name in sorted(snapshot[kind]):
+                lines.append('# TYPE %s %s' % (name, kind[:-1]))
+                for row in snapshot[kind][name]:
+                    lines.append('%s%s %s' % (name, _formatLabels(row['labels']), row['value']))
+
+        for name in sorted(snapshot['histograms']):
+            lines.append('# TYPE %s histogram' % name)
+            for row in snapshot['histograms'][name]:
+                for bound, count in row['buckets']:
+                    labels = dict(row['labels'], le=bound)
+                    lines.append('%s_bucket%s %s' % (name, _formatLabels(labels), count))
+                lines.append('%s_sum%s %s' % (name, _formatLabels(row['labels']), row['sum']))
+                lines.append('%s_count%s %s' % (name, _formatLabels(row['labels']), row['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def _cumulative(self, histogram):
+        # the caller must hold the lock
+        rows = []
+        total = 0
+        for bound, count in zip(self.buckets, histogram['buckets']):
+            total += count
+            rows.append(['%g' % bound, total])
+        rows.append(['+Inf', histogram['count']])
+        return rows
+
+class MetricsRecorder(object):
+    """
+    Records metrics in another process, by sending them through a queue to
+    the process that holds the Metrics, where collect() records them. It
+    has the same inc, set and observe methods as Metrics.
+
+    Metrics are dropped rather than blocking the sender when the queue
+    is full.
+
+    :param queue: (multiprocessing.Queue).
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def inc(self, name, labels=None, value=1):
+        self._send('inc', name, value, labels)
+
+    def set(self, name, value, labels=None):
+        self._send('set', name, value, labels)
+
+    def observe(self, name, value, labels=None):
+        self._send('observe', name, value, labels)
+
+    def _send(self, method, name, value, labels):
+        try:
+            self.queue.put_nowait((method, name, value, labels))
+        except Full:
+            pass
+
+def collect(metrics, queue):
+    """
+    Record the events sent by MetricsRecorders, until None comes through
+    the queue.
+
+    :param metrics: (Metrics).
+    :param queue: (multiprocessing.Queue).
+    :return:
+    """
+    while True:
+        event = queue.get()
+        if event is None:
+            break
+        metrics.record(event)
+
+def _labelsKey(labels):
+    return tuple(sorted((labels or dict()).items()))
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items()))
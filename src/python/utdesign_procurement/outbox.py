@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import pymongo as pm
+
+from bson import json_util
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# email lanes -> their priority. Due emails are sent lowest priority first,
+# and oldest first within a priority, so security email (invitations,
+# password resets) always goes before other email, however old the rest of
+# the backlog is. Bulk email goes last, but gets one claim in every
+# Outbox.bulkShare claims, so it can't be starved.
+LANE_PRIORITIES = {
+    'security': 0,
+    'normal': 1,
+    'bulk': 2,
+}
+
+class Outbox(object):
+    """
+    A MongoDB collection of emails waiting to be sent, so that emails
+    survive a restart of the server and a failed email is retried instead
+    of dropped.
+
+    An email is 'queued' until a worker claims it. A claimed email is
+    'sending' until the worker marks it 'sent', or until its lease runs
+    out. If sending fails, the email is queued again after a backoff that
+    doubles with every attempt, until maxAttempts attempts have failed and
+    it is marked 'failed'. If a worker dies while sending, another worker
+    claims the email again once the lease runs out, so every email is
+    sent at least once.
+
+    Emails with the same subject and content can be claimed together with
+    claimBatch(), so that they are sent once, to all of their recipients.
+
+    Notifications can also be held with hold(), which collects them in one
+    digest per recipient. A digest is 'collecting' until its window ends,
+    and is then claimed and sent like any other email.
+
+    Each process connects to MongoDB the first time it uses the outbox,
+    since a MongoClient can't be shared with a forked process.
+
+    :param database: (str). The name of the database.
+    :param collection: (str). The name of the collection.
+    :param clock: (function). Returns the current datetime.
+    :param lease: (float). Seconds a worker has to send an email it claimed.
+    :param backoff: (float). Seconds before the first retry of a failed email.
+    :param maxBackoff: (float). The most seconds between two attempts.
+    :param maxAttempts: (int). How many attempts fail before an email is
+        marked 'failed'.
+    :param bulkShare: (int). A due bulk email is claimed at least once in
+        every bulkShare claims of each process, ahead of other email.
+    """
+
+    def __init__(self, database='procurement', collection='outbox',
+                 clock=datetime.now, lease=60, backoff=30, maxBackoff=3600,
+                 maxAttempts=6, bulkShare=10):
+        self.database = database
+        self.collectionName = collection
+        self.clock = clock
+        self.lease = lease
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.maxAttempts = maxAttempts
+        self.bulkShare = bulkShare
+
+        # claims of other email since this process last claimed bulk email
+        self._sinceBulk = 0
+        self._collection = None
+        self._pid = None
+
+    @property
+    def collection(self):
+        if self._collection is None or self._pid != os.getpid():
+            self._collection = pm.MongoClient()[self.database][self.collectionName]
+            self._pid = os.getpid()
+        return self._collection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_collection'] = None
+        return state
+
+    def put(self, to, subject, html=None, lane='normal', template=None,
+            renderArgs=None):
+        """
+        Queue an email, either as HTML or as a template and its arguments
+        for the worker to render.
+
+        :param to: (str or list of str). The recipient email address(es).
+        :param subject: (str). The subject of the email.
+        :param html: (str). The HTML content of the email.
+        :param lane: (str). A lane in LANE_PRIORITIES.
+        :param template: (str). The name of the template of the email.
+        :param renderArgs: (dict). The arguments of the template.
+        :return: the _id of the queued email
+        """
+        if template is None:
+            content = {'html': html}
+            hashed = contentHash(subject, html)
+        else:
+            content = {'template': template, 'renderArgs': renderArgs}
+            hashed = contentHash(subject, template + json_util.dumps(renderArgs, sort_keys=True))
+
+        now = self.clock()
+        return self.collection.insert_one(dict(content, **{
+            'to': to,
+            'subject': subject,
+            'contentHash': hashed,
+            'recipientCount': len(recipientList(to)),
+            'lane': lane,
+            'priority': LANE_PRIORITIES[lane],
+            'status': 'queued',
+            'attempts': 0,
+            'nextAttempt': now,
+            'queuedAt': now,
+        })).inserted_id
+
+    def hold(self, to, subject, window):
+        """
+        Add a notification to the digest of each of its recipients. A digest
+        is started by the first notification held for a recipient, and is
+        due window seconds later.
+
+        :param to: (str or list of str). The recipient email address(es).
+        :param subject: (str). The subject of the notification, which is
+            listed in the digest.
+        :param window: (float). Seconds to collect notifications for.
+        :return:
+        """
+        now = self.clock()
+        for address in recipientList(to):
+            update = {
+                '$push': {'items': {'subject': subject, 'queuedAt': now}},
+                '$setOnInsert': {
+                    'to': address,
+                    'lane': 'normal',
+                    'priority': LANE_PRIORITIES['normal'],
+                    'attempts': 0,
+                    'nextAttempt': now + timedelta(seconds=window),
+                    'queuedAt': now,
+                }
+            }
+
+            # only one digest per recipient can be collecting, so if another
+            # thread started one at the same time, try again to add to theirs
+            for attempt in range(2):
+                try:
+                    self.collection.update_one(
+                        {'digestTo': address, 'status': 'collecting'}, update, upsert=True)
+                    break
+                except DuplicateKeyError:
+                    if attempt:
+                        raise
+
+    def claim(self):
+        """
+        Atomically claim the email with the best priority that is due, or
+        whose lease has run out, oldest first. Digests are due once their
+        window has ended.
+
+        After bulkShare - 1 claims of other email in a row, a due bulk email
+        is claimed first, if there is one.
+
+        :return: the claimed email document, or None if nothing is due
+        """
+        now = self.clock()
+        due = {'$or': [
+            {'status': {'$in': ['queued', 'collecting']}, 'nextAttempt': {'$lte': now}},
+            {'status': 'sending', 'leaseExpires': {'$lte': now}},
+        ]}
+        update = {
+            '$set': {
+                'status': 'sending',
+                'leaseExpires': now + timedelta(seconds=self.lease)
+            },
+            '$inc': {'attempts': 1}
+        }
+        sort = [('priority', pm.ASCENDING), ('nextAttempt', pm.ASCENDING)]
+
+        message = None
+        if self._sinceBulk >= self.bulkShare - 1:
+            message = self.collection.find_one_and_update(
+                dict(due, lane='bulk'), update, sort=sort,
+                return_document=ReturnDocument.AFTER)
+        if message is None:
+            message = self.collection.find_one_and_update(
+                due, update, sort=sort, return_document=ReturnDocument.AFTER)
+
+        if message is not None:
+            self._sinceBulk = 0 if message.get('lane') == 'bulk' else self._sinceBulk + 1
+        return message
+
+    def claimBatch(self, maxRecipients):
+        """
+        Claim the next email that is due, like claim(), along with
+        other due emails with the same subject and content, as long as they
+        have no more than maxRecipients recipients in all.
+
+        :param maxRecipients: (int). The most recipients of the batch.
+        :return: list of the claimed email documents, in claim order.
+            Empty if nothing is due.
+        """
+        message = self.claim()
+        if message is None:
+            return []
+
+        # digests, and emails queued before content hashes were kept, are
+        # sent alone
+        hashed = message.get('contentHash')
+        batch = [message]
+        remaining = maxRecipients - len(recipientList(message['to']))
+        while hashed is not None and remaining > 0:
+            now = self.clock()
+            message = self.collection.find_one_and_update(
+                {
+                    'contentHash': hashed,
+                    'status': 'queued',
+                    'nextAttempt': {'$lte': now},
+                    'recipientCount': {'$lte': remaining}
+                },
+                {
+                    '$set': {
+                        'status': 'sending',
+                        'leaseExpires': now + timedelta(seconds=self.lease)
+                    },
+                    '$inc': {'attempts': 1}
+                },
+                sort=[('priority', pm.ASCENDING), ('nextAttempt', pm.ASCENDING)],
+                return_document=ReturnDocument.AFTER)
+            if message is None:
+                break
+
+            batch.append(message)
+            remaining -= message['recipientCount']
+
+        return batch
+
+    def secondsUntilDue(self):
+        """
+        Find how long until the next queued email or digest is due.
+
+        :return: (float). Seconds until the next queued email is due, 0 if
+            one is due now, or None if no email is queued
+        """
+        message = self.collection.find_one(
+            {'status': {'$in': ['queued', 'collecting']}},
+            {'nextAttempt': True},
+            sort=[('nextAttempt', pm.ASCENDING)])
+
+        if message is None:
+            return None
+        return max((message['nextAttempt'] - self.clock()).total_seconds(), 0)
+
+    def sent(self, message):
+        """
+        Mark a claimed email as sent. Its content is dropped, since the
+        arguments of security email hold invitation and password reset
+        uuids. The rest is deleted by a TTL index (see indexes.py).
+
+        :param message: (dict). The document returned by claim().
+        :return:
+        """
+        self.collection.update_one(
+            {'_id': message['_id'], 'attempts': message['attempts']},
+            {
+                '$set': {'status': 'sent', 'sentAt': self.clock()},
+                '$unset': {'leaseExpires': '', 'html': '', 'renderArgs': ''}
+            })
+
+    def failed(self, message, error):
+        """
+        Queue a claimed email again after a backoff, or mark it 'failed' if
+        it has run out of attempts. Failed emails are deleted by a TTL index
+        (see indexes.py).
+
+        :param message: (dict). The document returned by claim().
+        :param error: (str). What went wrong.
+        :return:
+        """
+        now = self.clock()
+        update = {'error': error}
+        if message['attempts'] >= self.maxAttempts:
+            update.update({'status': 'failed', 'failedAt': now})
+        else:
+            delay = min(self.backoff * 2 ** (message['attempts'] - 1), self.maxBackoff)
+            update.update({
+                'status': 'queued',
+                'nextAttempt': now + timedelta(seconds=delay)
+            })
+
+        self.collection.update_one(
+            {'_id': message['_id'], 'attempts': message['attempts']},
+            {'$set': update, '$unset': {'leaseExpires': ''}})
+
+    def postpone(self, messages, delay):
+        """
+        Give claimed emails back, to be claimed again after a delay. This
+        doesn't count as an attempt.
+
+        :param messages: (list of dict). Documents returned by claim().
+        :param delay: (float). Seconds until they are due again.
+        :return:
+        """
+        nextAttempt = self.clock() + timedelta(seconds=delay)
+        for message in messages:
+            self.collection.update_one(
+                {'_id': message['_id'], 'attempts': message['attempts']},
+                {
+                    '$set': {'status': 'queued', 'nextAttempt': nextAttempt},
+                    '$inc': {'attempts': -1},
+                    '$unset': {'leaseExpires': ''}
+                })
+
+    def depth(self):
+        """
+        Count the emails that haven't been sent, and find how long the
+        oldest due email has been waiting.
+
+        Returns::
+
+            {
+                'queued': (int),
+                'collecting': (int),
+                'sending': (int),
+                'failed': (int),
+                'oldestDueSeconds': (float, or None if no email is due),
+            }
+
+        :return: dict
+        """
+        statuses = ['queued', 'collecting', 'sending', 'failed']
+        depth = dict.fromkeys(statuses, 0)
+        for row in self.collection.aggregate([
+                {'$match': {'status': {'$in': statuses}}},
+                {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            depth[row['_id']] = row['count']
+
+        now = self.clock()
+        oldest = self.collection.find_one(
+            {'status': 'queued', 'nextAttempt': {'$lte': now}},
+            {'nextAttempt': True},
+            sort=[('nextAttempt', pm.ASCENDING)])
+        depth['oldestDueSeconds'] = (
+            (now - oldest['nextAttempt']).total_seconds() if oldest else None)
+        return depth
+
+    def recipientsSentSince(self, seconds):
+        """
+        Count the recipients of the emails sent in the last few seconds.
+
+        :param seconds: (float).
+        :return: (int).
+        """
+        since = self.clock() - timedelta(seconds=seconds)
+        for row in self.collection.aggregate([
+                {'$match': {'status': 'sent', 'sentAt': {'$gte': since}}},
+                {'$group': {
+                    '_id': None,
+                    'count': {'$sum': {'$ifNull': ['$recipientCount', 1]}}
+                }}]):
+            return row['count']
+        return 0
+
+def recipientList(to):
+    """
+    :param to: (str or list of str). One or more email addresses.
+    :return: list of str
+    """
+    return [to] if isinstance(to, str) else list(to)
+
+def contentHash(subject, content):
+    """
+    Identify the content of an email, so emails with the same content can
+    be found with an index.
+
+    :param subject: (str).
+    :param content: (str). The HTML, or the template and its arguments.
+    :return: (str). A hex digest of the subject and content
+    """
+    return hashlib.sha1(('%s\0%s' % (subject, content)).encode('utf-8')).hexdigest()
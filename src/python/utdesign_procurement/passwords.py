@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import cherrypy
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from utdesign_procurement.utils import generateSalt
+
+# password hash algorithms -> the parameters of their hash records
+ALGORITHMS = {
+    'pbkdf2_sha256': ('iterations',),
+    'scrypt': ('n', 'r', 'p'),
+}
+
+# the parameters new passwords are hashed with, unless the server has been
+# calibrated. See calibrate().
+DEFAULT_PARAMS = {'algorithm': 'scrypt', 'n': 2 ** 14, 'r': 8, 'p': 1}
+
+# the parameters of passwords stored before hash records, which were stored
+# as the bare digest with the salt in the user document
+LEGACY_PARAMS = {'algorithm': 'pbkdf2_sha256', 'iterations': 100000}
+
+# calibrate() never picks parameters weaker than these
+MIN_PARAMS = {
+    'pbkdf2_sha256': {'algorithm': 'pbkdf2_sha256', 'iterations': 100000},
+    'scrypt': {'algorithm': 'scrypt', 'n': 2 ** 14, 'r': 8, 'p': 1},
+}
+
+# scrypt needs 128 * r * n bytes of memory, so n is capped to keep every
+# hashing process under 128MB at r=8
+MAX_SCRYPT_N = 2 ** 17
+
+def hashRecord(password, params, salt=None):
+    """
+    Hash a password into a record of the digest and how it was made, so
+    that the parameters can change without breaking stored passwords.
+
+    Returns::
+
+        {
+            'algorithm': 'pbkdf2_sha256',
+            'iterations': (int),
+            'salt': (bytes),
+            'digest': (bytes)
+        }
+
+        or
+
+        {
+            'algorithm': 'scrypt',
+            'n': (int),
+            'r': (int),
+            'p': (int),
+            'salt': (bytes),
+            'digest': (bytes)
+        }
+
+    :param password: (str). A plaintext password.
+    :param params: (dict). The algorithm and its parameters.
+    :param salt: (bytes). By default, a new random salt.
+    :return: dict
+    """
+    if params.get('algorithm') not in ALGORITHMS:
+        raise ValueError('Unknown password hash algorithm: %s' % params.get('algorithm'))
+
+    record = {key: params[key] for key in ('algorithm',) + ALGORITHMS[params['algorithm']]}
+    record['salt'] = salt if salt is not None else generateSalt()
+    record['digest'] = _digest(password, record)
+    return record
+
+def checkRecord(record, password):
+    """
+    :param record: (dict). A hash record made by hashRecord.
+    :param password: (str). A plaintext password.
+    :return: (bool). True if the password matches the record.
+    """
+    return hmac.compare_digest(record['digest'], _digest(password, record))
+
+def userRecord(user):
+    """
+    Find the hash record of a user's password.
+
+    :param user: a user document from database
+    :return: (dict). The hash record, or None if the user has no password.
+    """
+    if not user or 'password' not in user:
+        return None
+    if isinstance(user['password'], dict):
+        return user['password']
+    if 'salt' in user:
+        return dict(LEGACY_PARAMS, salt=user['salt'], digest=user['password'])
+    return None
+
+def sameParams(record, params):
+    """
+    :param record: (dict). A hash record.
+    :param params: (dict). An algorithm and its parameters.
+    :return: (bool). True if the record was hashed with the parameters.
+    """
+    keys = ('algorithm',) + ALGORITHMS.get(params.get('algorithm'), ())
+    return all(record.get(key) == params.get(key) for key in keys)
+
+def timeHash(params, rounds=3):
+    """
+    :param params: (dict). An algorithm and its parameters.
+    :param rounds: (int). How many times to hash.
+    :return: (float). The fewest seconds one hash took.
+    """
+    times = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        hashRecord('calibrate', params)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def calibrate(target, algorithm='scrypt'):
+    """
+    Find the strongest parameters that hash a password in about target
+    seconds on this host, but no weaker than MIN_PARAMS.
+
+    :param target: (float). Seconds one hash should take.
+    :param algorithm: (str). An algorithm in ALGORITHMS.
+    :return: (dict). The algorithm and its parameters.
+    """
+    params = dict(MIN_PARAMS[algorithm])
+
+    if algorithm == 'pbkdf2_sha256':
+        # the time is linear in the iterations
+        iterations = int(params['iterations'] * target / timeHash(params)) // 1000 * 1000
+        params['iterations'] = max(params['iterations'], iterations)
+    else:
+        # the time doubles with n
+        while params['n'] < MAX_SCRYPT_N:
+            stronger = dict(params, n=params['n'] * 2)
+            if timeHash(stronger) > target:
+                break
+            params = stronger
+
+    return params
+
+def _digest(password, record):
+    if record['algorithm'] == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), record['salt'], record['iterations'])
+    if record['algorithm'] == 'scrypt':
+        n, r, p = record['n'], record['r'], record['p']
+        return hashlib.scrypt(password.encode(), salt=record['salt'], n=n, r=r, p=p,
+                              maxmem=256 * r * (n + p), dklen=32)
+    raise ValueError('Unknown password hash algorithm: %s' % record['algorithm'])
+
+class PasswordHasher(object):
+    """
+    Hashes passwords in a pool of worker processes, so that a rush of
+    logins doesn't tie up CherryPy's threads with password hashing and
+    stall every other API call.
+
+    At most max_pending passwords are hashed or waiting to be hashed at
+    once. Past that, logins are refused with a 503 and a Retry-After
+    header right away, rather than queueing up behind each other until
+    the clients time out.
+
+    New passwords are hashed with params. Passwords hashed with other
+    parameters still verify, and needsRehash() tells when to hash them
+    again with params.
+
+    The pool is made the first time a password is hashed in a process,
+    since a pool can't be shared with a forked process.
+
+    :param workers: (int). How many processes hash passwords. By default,
+        one per CPU. If 0, passwords are hashed in the calling thread, with
+        no limit.
+    :param max_pending: (int). The most passwords hashed or waiting to be
+        hashed at once. By default, 4 per worker.
+    :param timeout: (float). The most seconds to wait for a hash.
+    :param retry_after: (int). Seconds a refused client is told to wait.
+    :param params: (dict). The algorithm and parameters new passwords are
+        hashed with. By default, DEFAULT_PARAMS.
+    """
+
+    def __init__(self, workers=None, max_pending=None, timeout=30, retry_after=1,
+                 params=None):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.max_pending = max_pending if max_pending is not None else 4 * max(self.workers, 1)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.params = dict(params if params is not None else DEFAULT_PARAMS)
+        if self.params.get('algorithm') not in ALGORITHMS:
+            raise ValueError('Unknown password hash algorithm: %s' % self.params.get('algorithm'))
+
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def hash(self, password):
+        """
+        Hash a password with a new salt.
+
+        :param password: (str). A plaintext password.
+        :return: (dict). The hash record. See hashRecord.
+        """
+
+        return self._run(hashRecord, password, self.params)
+
+    def verify(self, user, password):
+        """
+        Hash a password and check if it matches the password of a given
+        user.
+
+        :param user: a user document from database
+        :param password: (str). A plaintext password.
+        :return: (bool).
+        """
+
+        record = userRecord(user)
+        if record is None:
+            return False
+        return self._run(checkRecord, record, password)
+
+    def needsRehash(self, user):
+        """
+        :param user: a user document from database
+        :return: (bool). True if the user's password wasn't hashed with
+            params.
+        """
+
+        record = userRecord(user)
+        return record is not None and not sameParams(record, self.params)
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+
+        if not self._pending.acquire(blocking=False):
+            cherrypy.response.headers['Retry-After'] = str(self.retry_after)
+            raise cherrypy.HTTPError(503, 'Too many logins at once. Try again in a moment.')
+
+        # the slot is given back when the worker is done, not when the
+        # caller stops waiting, so max_pending bounds the pool's backlog
+        try:
+            future = self.executor.submit(func, *args)
+        except BrokenProcessPool:
+            self._pending.release()
+            raise self._restart()
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda future: self._pending.release())
+
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            cherrypy.response.headers['Retry-After'] = str(self.retry_after)
+            raise cherrypy.HTTPError(503, 'Too many logins at once. Try again in a moment.')
+        except BrokenProcessPool:
+            raise self._restart()
+
+    def _restart(self):
+        # a worker was killed. The next hash makes a new pool.
+        with self._lock:
+            self._executor = None
+        return cherrypy.HTTPError(503, 'Password hashing is restarting. Try again in a moment.')
+
+    def shutdown(self):
+        """
+        Stop the worker processes.
+
+        :return:
+        """
+
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
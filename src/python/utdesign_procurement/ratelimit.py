@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import time
+
+from multiprocessing import Array
+
+# seconds in a day
+DAY = 86400
+
+# the fields of a RateLimiter's shared state Array. DONE counts every
+# recipient given to done(), ever.
+SECOND_TOKENS, LAST_REFILL, PENDING, DONE = range(4)
+
+class RateLimiter(object):
+    """
+    Limits how many emails the email workers send, so that the email
+    account isn't throttled or locked for sending too much at once.
+
+    The per second rate is a token bucket, shared by every worker process,
+    which holds burst tokens and refills at perSecond tokens a second.
+    Every recipient of an email takes a token.
+
+    The daily limit is a rolling count: an email is only sent if the
+    recipients sent to in the last day, counted by sentToday, plus the
+    recipients of emails being sent, leave room for its recipients. So no
+    24 hours ever have more than perDay recipients, even across restarts.
+    A worker that reserved an email must call done() once the email has
+    been marked sent or failed.
+
+    sentToday is called outside the lock the workers share, at most once
+    every sentTodayTTL seconds in each process. Recipients given to done()
+    since it was called are counted as well, so a stale count can hold an
+    email back, but never lets too many through.
+
+    :param perSecond: (float). Recipients per second, or None for no limit.
+    :param perDay: (float). Recipients per day, or None for no limit.
+    :param burst: (float). The most recipients sent to at once after the
+        workers have been idle. By default, perSecond.
+    :param clock: (function). Returns the current time in seconds. It must
+        give the same time in every process.
+    :param sentToday: (function). Returns how many recipients were sent to
+        in the last DAY seconds, such as Outbox.recipientsSentSince(DAY).
+        Needed if perDay is set.
+    :param dayRecheck: (float). Seconds to wait before checking the daily
+        limit again, once it is used up.
+    :param sentTodayTTL: (float). Seconds to reuse the count from sentToday
+        for. 0 calls it for every reservation.
+    """
+
+    def __init__(self, perSecond=None, perDay=None, burst=None, clock=time.monotonic,
+                 sentToday=None, dayRecheck=60, sentTodayTTL=5):
+        if perDay is not None and sentToday is None:
+            raise ValueError('A daily limit needs sentToday')
+
+        self.perSecond = perSecond
+        self.perDay = perDay
+        self.burst = burst if burst is not None else perSecond
+        self.clock = clock
+        self.sentToday = sentToday
+        self.dayRecheck = dayRecheck
+        self.sentTodayTTL = sentTodayTTL
+
+        self._state = Array('d', 4)
+        self._state[SECOND_TOKENS] = self.burst or 0
+        self._state[LAST_REFILL] = clock()
+        self._state[PENDING] = 0
+        self._state[DONE] = 0
+
+        # (time, sentToday(), DONE before it was called), in this process
+        self._sentCache = None
+
+    def reserve(self, count=1):
+        """
+        Reserve count recipients, if the bucket has enough tokens and the
+        day has room for them. An email with more recipients than the
+        bucket or the day holds only needs a full bucket or an empty day.
+
+        :param count: (int). How many recipients the email has.
+        :return: (float). 0 if the recipients were reserved. Otherwise, how
+            many seconds to wait before trying again.
+        """
+        if self.perDay is not None:
+            sent = self._readSentToday()
+
+        with self._state.get_lock():
+            self._refill()
+
+            wait = 0
+            if self.perSecond is not None:
+                need = min(count, self.burst)
+                wait = max(wait, (need - self._state[SECOND_TOKENS]) / self.perSecond)
+            if self.perDay is not None:
+                need = min(count, self.perDay)
+                if self._usedToday(*sent) + need > self.perDay:
+                    wait = max(wait, self.dayRecheck)
+
+            # a deficit too small for the clock to measure is rounding error
+            if wait > 1e-6:
+                return wait
+
+            self._state[SECOND_TOKENS] -= count
+            if self.perDay is not None:
+                self._state[PENDING] += count
+            return 0
+
+    def done(self, count=1):
+        """
+        Stop counting count reserved recipients as being sent to, once
+        their email has been marked sent (so sentToday counts them) or
+        failed.
+
+        :param count: (int). The count given to reserve().
+        :return:
+        """
+        if self.perDay is None:
+            return
+        with self._state.get_lock():
+            self._state[PENDING] = max(self._state[PENDING] - count, 0)
+            self._state[DONE] += count
+
+    def status(self):
+        """
+        Report the limits, the tokens left in the bucket and the recipients
+        left in the day.
+
+        Returns::
+
+            {
+                'perSecond': (float or None),
+                'perDay': (float or None),
+                'secondTokens': (float or None),
+                'dayRemaining': (float or None),
+            }
+
+        :return: dict
+        """
+        if self.perDay is not None:
+            sent = self._readSentToday()
+
+        with self._state.get_lock():
+            self._refill()
+            return {
+                'perSecond': self.perSecond,
+                'perDay': self.perDay,
+                'secondTokens': self._state[SECOND_TOKENS] if self.perSecond is not None else None,
+                'dayRemaining': (max(self.perDay - self._usedToday(*sent), 0)
+                                 if self.perDay is not None else None),
+            }
+
+    def _readSentToday(self):
+        # the caller must not hold the state's lock, since sentToday can be
+        # slow. DONE is read first, so that anything done() while sentToday
+        # runs is counted by _usedToday, if not by sentToday.
+        now = self.clock()
+        if self._sentCache is None or now - self._sentCache[0] >= self.sentTodayTTL:
+            doneBefore = self._state[DONE]
+            self._sentCache = (now, self.sentToday(), doneBefore)
+        return self._sentCache[1:]
+
+    def _usedToday(self, sent, doneBefore):
+        # the caller must hold the state's lock
+        return sent + self._state[DONE] - doneBefore + self._state[PENDING]
+
+    def _refill(self):
+        # the caller must hold the state's lock
+        now = self.clock()
+        elapsed = max(now - self._state[LAST_REFILL], 0)
+        self._state[LAST_REFILL] = now
+
+        if self.perSecond is not None:
+            self._state[SECOND_TOKENS] = min(
+                self._state[SECOND_TOKENS] + elapsed * self.perSecond, self.burst)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import cherrypy
+import json
 import os
 
 from mako.lookup import TemplateLookup
@@ -10,8 +11,11 @@ from utdesign_procurement.utils import authorizedRoles
 
 class Root(ApiGateway):
 
-    def __init__(self, email_handler, show_debugger):
-        super(Root, self).__init__(email_handler)
+    def __init__(self, email_handler, show_debugger, password_hasher=None, login_throttle=None,
+                 sequenceBlockSize=1):
+        super(Root, self).__init__(email_handler, sequenceBlockSize=sequenceBlockSize,
+                                   password_hasher=password_hasher,
+                                   login_throttle=login_throttle)
 
         self.show_debugger = show_debugger
         templateDir = os.path.join(cherrypy.Application.wwwDir, 'templates')
@@ -102,6 +106,28 @@ class Root(ApiGateway):
         ret = template.render()
         return ret
 
+    @cherrypy.expose
+    @authorizedRoles("admin")
+    def metrics(self, format='json'):
+        """
+        Return the metrics of the email pipeline, such as the outbox's
+        depth, how long emails wait to be sent, SMTP timings and failures.
+        See EmailHandler.currentMetrics.
+
+        :param format: (str). 'json', or 'prometheus' for the Prometheus
+            text format.
+        """
+
+        metrics = self.email_handler.currentMetrics()
+        if format == 'prometheus':
+            cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+            return metrics.prometheus()
+        if format != 'json':
+            raise cherrypy.HTTPError(400, 'format must be json or prometheus')
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(metrics.snapshot())
+
     # no authorization needed, because this should be removed in production
     @cherrypy.expose
     def debug(self):
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import pickle
+import pymongo as pm
+import threading
+
+from bson.binary import Binary
+from cherrypy.lib.sessions import Session
+from urllib.parse import unquote
+
+# stands in for a key that isn't in the stored session
+_MISSING = object()
+
+class MongoSession(Session):
+    """
+    Stores CherryPy sessions in MongoDB, so that several server processes
+    behind a load balancer can share them.
+
+    Each key of a session is stored separately, and is only fetched from
+    MongoDB when a handler first uses it. When the request ends, only the
+    keys that were set, deleted or changed in place are written back, so a
+    request that only checks the user's role doesn't load or save the
+    bulk upload data kept in the same session. Values are pickled, so any
+    value that can be kept in a RAM session can be kept here.
+
+    A session expires timeout minutes after the last request that used it.
+    A TTL index removes expired sessions, so there is no cleanup thread.
+
+    Locks only hold within one process: two requests for the same session
+    on different processes can run at once. Each one only writes the keys
+    it changed, so requests that change different keys are both kept, but
+    if they change the same key, the last one to save wins.
+
+    Enable it in server.conf::
+
+        tools.sessions.storage_class: utdesign_procurement.sessions.MongoSession
+        tools.sessions.eager_keys: ['email', 'role', 'projectNumbers']
+
+    eager_keys are fetched along with the first key a request uses, since
+    most requests need them all.
+    """
+
+    database = 'procurement'
+    collection_name = 'sessions'
+    eager_keys = ()
+
+    # session id -> [lock, number of requests holding or waiting for it],
+    # for the sessions locked in this process. A lock is dropped once no
+    # request needs it, so the map doesn't grow with every visitor.
+    locks = {}
+    locks_lock = threading.Lock()
+
+    _collection = None
+    _pid = None
+
+    @classmethod
+    def setup(cls, **kwargs):
+        """
+        Set the class attributes from the tools.sessions config, and create
+        the TTL index. CherryPy calls this once, before the first session.
+        """
+        for k, v in kwargs.items():
+            setattr(cls, k, v)
+
+        cls.collection().create_index([('expiration', pm.ASCENDING)],
+                                      name='expiration_ttl', expireAfterSeconds=0)
+
+    @classmethod
+    def collection(cls):
+        # a MongoClient can't be shared with a forked process
+        if cls._collection is None or cls._pid != os.getpid():
+            cls._collection = pm.MongoClient()[cls.database][cls.collection_name]
+            cls._pid = os.getpid()
+        return cls._collection
+
+    def __init__(self, id=None, **kwargs):
+        # key -> value of every key fetched or set in this request. Keys
+        # that were fetched but aren't stored map to _MISSING.
+        self._values = {}
+        # key -> pickle of the value as it was fetched
+        self._fetched = {}
+        self._deleted = set()
+        self._fetchedAll = False
+        super(MongoSession, self).__init__(id, **kwargs)
+
+    def now(self):
+        # MongoDB expires documents by UTC
+        return datetime.datetime.utcnow()
+
+    def _current(self):
+        return {'_id': self.id, 'expiration': {'$gt': self.now()}}
+
+    def _exists(self):
+        return self.collection().find_one(self._current(), {'_id': True}) is not None
+
+    def _fetch(self, keys):
+        """
+        Fetch some keys of the session, if they weren't fetched or set
+        already.
+
+        :param keys: (iterable of str). The keys, or None for every key.
+        :return:
+        """
+        self.loaded = True
+        if self._fetchedAll:
+            for key in keys or ():
+                self._values.setdefault(key, _MISSING)
+            return
+
+        if keys is None:
+            projection = {'data': True}
+        else:
+            keys = [key for key in keys if key not in self._values]
+            if not keys:
+                return
+            projection = {'data.' + _field(key): True for key in keys}
+
+        document = self.collection().find_one(self._current(), projection)
+        data = {unquote(field): value for field, value in (document or {}).get('data', {}).items()}
+
+        for key in (data if keys is None else keys):
+            if key in self._values:
+                continue
+            if key in data:
+                self._fetched[key] = bytes(data[key])
+                self._values[key] = pickle.loads(self._fetched[key])
+            else:
+                self._values[key] = _MISSING
+
+        if keys is None:
+            self._fetchedAll = True
+
+    def _fetchKey(self, key):
+        self._fetch([key] + [eager for eager in self.eager_keys if eager != key])
+
+    def _save(self, expiration_time):
+        update = {'$set': {'expiration': expiration_time}}
+
+        for key, value in self._values.items():
+            if value is _MISSING:
+                continue
+            # values can be changed in place, so compare them to the pickle
+            # they were fetched as
+            pickled = pickle.dumps(value)
+            if self._fetched.get(key) != pickled:
+                update['$set']['data.' + _field(key)] = Binary(pickled)
+        unset = {'data.' + _field(key): '' for key in self._deleted if key in self._fetched}
+        if unset:
+            update['$unset'] = unset
+
+        # a session that was only read is refreshed, but not created, so
+        # visitors who never log in aren't stored
+        changed = len(update['$set']) > 1 or unset
+        self.collection().update_one({'_id': self.id}, update, upsert=bool(changed))
+
+    def _delete(self):
+        self.collection().delete_one({'_id': self.id})
+
+    def _regenerate(self):
+        # the session is copied to its new id, so every key has to be
+        # fetched, and every key written to the new document
+        if self.id is not None:
+            self._fetch(None)
+            self._fetched = {}
+            self._deleted = set()
+        super(MongoSession, self)._regenerate()
+
+    def acquire_lock(self):
+        """Acquire an exclusive lock on the session in this process."""
+        self.locked = True
+        with self.locks_lock:
+            entry = self.locks.setdefault(self.id, [threading.RLock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        self._lockId = self.id
+
+    def release_lock(self):
+        """Release the lock on the session, and drop it if no request needs it."""
+        with self.locks_lock:
+            entry = self.locks[self._lockId]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[self._lockId]
+        self.locked = False
+
+    def load(self):
+        """Fetch every key of the session."""
+        self._fetch(None)
+
+    def __len__(self):
+        """Return the number of active sessions."""
+        return self.collection().count_documents({'expiration': {'$gt': self.now()}})
+
+    def __getitem__(self, key):
+        self._fetchKey(key)
+        value = self._values[key]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.loaded = True
+        self._values[key] = value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        self._fetchKey(key)
+        if self._values[key] is _MISSING:
+            raise KeyError(key)
+        self._values[key] = _MISSING
+        self._deleted.add(key)
+
+    def pop(self, key, default=_MISSING):
+        """Remove the specified key and return the corresponding value."""
+        self._fetchKey(key)
+        value = self._values[key]
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        del self[key]
+        return value
+
+    def __contains__(self, key):
+        self._fetchKey(key)
+        return self._values[key] is not _MISSING
+
+    def get(self, key, default=None):
+        """D.get(k[,d]) -> D[k] if k in D, else d."""
+        self._fetchKey(key)
+        value = self._values[key]
+        return default if value is _MISSING else value
+
+    def update(self, d):
+        """D.update(E) -> None."""
+        for key, value in d.items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        """D.setdefault(k[,d]) -> D.get(k,d), also set D[k]=d if k not in D."""
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        """D.clear() -> None."""
+        for key in list(self.keys()):
+            del self[key]
+
+    def keys(self):
+        """D.keys() -> list of D's keys."""
+        self._fetch(None)
+        return [key for key, value in self._values.items() if value is not _MISSING]
+
+    def items(self):
+        """D.items() -> list of D's (key, value) pairs."""
+        return [(key, self._values[key]) for key in self.keys()]
+
+    def values(self):
+        """D.values() -> list of D's values."""
+        return [self._values[key] for key in self.keys()]
+
+def _field(key):
+    """
+    :param key: (str). A session key.
+    :return: (str). The key, escaped to be a MongoDB field name, which
+        can't have dots or start with $. unquote() reverses it.
+    """
+    return key.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import cherrypy
+import pymongo as pm
+import threading
+import time
+
+from collections import deque
+from datetime import datetime
+
+class LoginThrottle(object):
+    """
+    Limits login attempts per email and per client address over a sliding
+    window, so that a password guessing attack is refused before any
+    password is hashed, instead of costing a hash per guess.
+
+    Every attempt counts against its email and its address until it
+    leaves the window. A successful login forgets the attempts against
+    its email, and its own attempt against its address, so a classroom
+    logging in from behind one address only counts its failed attempts.
+
+    By default the attempts are kept in memory, which only throttles the
+    process they were made on. If several processes serve logins, give
+    them the same MongoDB collection to share the attempts.
+
+    The client address is cherrypy.request.remote.ip. Behind a proxy,
+    turn on tools.proxy so that it is the client's and not the proxy's.
+
+    :param perEmail: (int). The most attempts for one email in the window.
+    :param perAddress: (int). The most attempts from one address in the
+        window.
+    :param window: (float). The length of the window, in seconds.
+    :param collection: a pymongo Collection to keep the attempts in, or
+        None to keep them in memory.
+    :param clock: (function). Returns the current time in seconds since
+        the epoch.
+    """
+
+    def __init__(self, perEmail=5, perAddress=50, window=300, collection=None,
+                 clock=time.time):
+        self.limits = {'email': perEmail, 'address': perAddress}
+        self.window = window
+        self.clock = clock
+        if collection is None:
+            self.attempts = MemoryAttempts(window)
+        else:
+            self.attempts = MongoAttempts(collection, window)
+
+    def attempt(self, email, address):
+        """
+        Record a login attempt, or refuse it with a 429 error if its email
+        or address has run out of attempts.
+
+        The attempt is recorded before the attempts are counted, and taken
+        back if it is refused, so that attempts made at once on several
+        processes can't all be counted before any of them is recorded.
+
+        :param email: (str).
+        :param address: (str). The client's IP address.
+        :return: (float). The time of the attempt, for succeeded() or
+            cancel().
+        """
+        now = self.clock()
+        since = now - self.window
+
+        keys = self._keys(email, address)
+        for kind, key in keys:
+            self.attempts.add(key, now)
+
+        for kind, key in keys:
+            times = self.attempts.times(key, since)
+            if len(times) > self.limits[kind]:
+                for other, otherKey in keys:
+                    self.attempts.remove(otherKey, now)
+
+                # the oldest attempt in the window is the first to leave it
+                retryAfter = max(int(min(times) - since) + 1, 1)
+                cherrypy.response.headers['Retry-After'] = str(retryAfter)
+                raise cherrypy.HTTPError(429, 'Too many login attempts. Try again in %d seconds.' % retryAfter)
+
+        return now
+
+    def succeeded(self, email, address, at):
+        """
+        Forget the attempts against an email that logged in, and its
+        attempt against its address.
+
+        :param email: (str).
+        :param address: (str).
+        :param at: (float). The time returned by attempt().
+        :return:
+        """
+        self.attempts.clear('email:%s' % email)
+        self.attempts.remove('address:%s' % address, at)
+
+    def cancel(self, email, address, at):
+        """
+        Forget an attempt that couldn't be checked, such as one refused
+        because the server was too busy to hash its password.
+
+        :param email: (str).
+        :param address: (str).
+        :param at: (float). The time returned by attempt().
+        :return:
+        """
+        for kind, key in self._keys(email, address):
+            self.attempts.remove(key, at)
+
+    def _keys(self, email, address):
+        return [('email', 'email:%s' % email), ('address', 'address:%s' % address)]
+
+class MemoryAttempts(object):
+    """
+    Keeps the times of login attempts in memory, for a LoginThrottle.
+
+    :param window: (float). The LoginThrottle's window, in seconds.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._times = dict()
+        self._nextSweep = 0
+
+    def times(self, key, since):
+        """
+        :param key: (str). An email or address key.
+        :param since: (float). The start of the window.
+        :return: list of the times of the key's attempts in the window
+        """
+        with self._lock:
+            # keys that stopped making attempts would otherwise be kept
+            # forever, so every key is pruned once per window
+            if since >= self._nextSweep:
+                for other in list(self._times):
+                    self._prune(other, since)
+                self._nextSweep = since + self.window
+
+            self._prune(key, since)
+            return list(self._times.get(key, ()))
+
+    def add(self, key, at):
+        with self._lock:
+            self._times.setdefault(key, deque()).append(at)
+
+    def remove(self, key, at):
+        with self._lock:
+            if at in self._times.get(key, ()):
+                self._times[key].remove(at)
+
+    def clear(self, key):
+        with self._lock:
+            self._times.pop(key, None)
+
+    def _prune(self, key, since):
+        # the caller must hold the lock
+        times = self._times.get(key)
+        while times and times[0] < since:
+            times.popleft()
+        if not times:
+            self._times.pop(key, None)
+
+class MongoAttempts(object):
+    """
+    Keeps the times of login attempts in a MongoDB collection, so that
+    every process of the server shares them, for a LoginThrottle. A TTL
+    index removes attempts once they leave the window. If the window has
+    changed since the index was made, the index is changed to match.
+
+    :param collection: a pymongo Collection
+    :param window: (float). The LoginThrottle's window, in seconds.
+    """
+
+    def __init__(self, collection, window):
+        self.collection = collection
+        collection.create_index([('key', pm.ASCENDING), ('at', pm.ASCENDING)], name='key_at')
+
+        ttl = collection.index_information().get('attemptedAt_ttl')
+        if ttl is None:
+            collection.create_index([('attemptedAt', pm.ASCENDING)], name='attemptedAt_ttl',
+                                    expireAfterSeconds=int(window))
+        elif ttl.get('expireAfterSeconds') != int(window):
+            # create_index can't change an index's options
+            collection.database.command('collMod', collection.name, index={
+                'name': 'attemptedAt_ttl',
+                'expireAfterSeconds': int(window)
+            })
+
+    def times(self, key, since):
+        return [attempt['at'] for attempt in
+                self.collection.find({'key': key, 'at': {'$gte': since}}, {'at': True})]
+
+    def add(self, key, at):
+        # MongoDB expires documents by a UTC datetime
+        self.collection.insert_one({'key': key, 'at': at, 'attemptedAt': datetime.utcfromtimestamp(at)})
+
+    def remove(self, key, at):
+        self.collection.delete_one({'key': key, 'at': at})
+
+    def clear(self, key):
+        self.collection.delete_many({'key': key})
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
+import base64
 import cherrypy
-import hashlib
+import json
 import os
 import re
 import math
@@ -18,6 +19,10 @@ def authorizedRoles(*acceptableRoles, redirect=False):
     If redirect=True, and the user isn't logged in at all, then they are
     redirected to the login page. If redirect=False (default), then they
     are denied access with a 403 error.
+
+    If the decorated method's object has a userCache, the role and project
+    numbers in the session are refreshed from it first, so changes made
+    since the user logged in apply to their next call.
     """
 
     def decorator(func):
@@ -26,6 +31,10 @@ def authorizedRoles(*acceptableRoles, redirect=False):
         def decorated_function(*args, **kwargs):
             role = cherrypy.session.get('role', None)
 
+            userCache = getattr(args[0], 'userCache', None) if args else None
+            if role is not None and userCache is not None:
+                role = refreshUserContext(userCache)
+
             # no role means force a login
             if role is None and redirect:
                 raise cherrypy.HTTPRedirect('/login')
@@ -41,33 +50,23 @@ def authorizedRoles(*acceptableRoles, redirect=False):
 
     return decorator
 
-def verifyPassword(user, password):
+def refreshUserContext(userCache):
     """
-    This function hashes a password and checks if it matches the hash of
-    a given user.
+    Copy the current role and project numbers of the logged in user from
+    a UserCache into their session.
 
-    :param user: a user document from database
-    :param password: a hashed password
+    :param userCache: (UserCache).
+    :return: the user's role, or None if they were removed
     """
+    context = userCache.get(cherrypy.session.get('email'))
+    if context is None:
+        return None
 
-    # user['password'] is hashed password, not plaintext
-    # code assumes salt and password are type checked?
-    if user and 'salt' in user and 'password' in user:
-        return user['password'] == hashPassword(password, user['salt'])
-    else:
-        return False
-
-def hashPassword(password, salt):
-    """
-    This function hashes a password with a given salt.
-
-    :param password: a plaintext password
-    :param salt: a random salt
-    :return: the hashed password
-    """
-    # use pbkdf2 password hash algorithm, with sha-256 and 100,000 iterations
-    # by default, encode encodes string to utf-8
-    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000)
+    # only write what changed, so the session isn't saved for nothing
+    for key in ('role', 'projectNumbers'):
+        if cherrypy.session.get(key) != context[key]:
+            cherrypy.session[key] = list(context[key]) if key == 'projectNumbers' else context[key]
+    return context['role']
 
 def generateSalt():
     """
@@ -413,6 +412,24 @@ STATUS_SET = {
     "rejected"
 }
 
+# the keys the requestData, projectData and userData tables can be sorted by
+REQUEST_SORT_KEYS = ('requestNumber', 'projectNumber', 'status', 'vendor', 'URL', 'requestTotal', 'shippingCost')
+PROJECT_SORT_KEYS = ('projectNumber', 'sponsorName', 'projectName', 'membersEmails', 'defaultBudget')
+USER_SORT_KEYS = ('projectNumbers', 'firstName', 'lastName', 'netID', 'email', 'course', 'role', 'status')
+
+# the fields of a request shown in lists of requests
+REQUEST_SUMMARY_KEYS = ('status', 'requestNumber', 'manager', 'vendor', 'projectNumber', 'URL',
+                        'requestSubtotal', 'shippingCost', 'requestTotal')
+
+# requests with these statuses count against a project's available budget.
+# requests of any status count against its pending budget.
+SPENT_STATUS_SET = {
+    "admin approved",
+    "ordered",
+    "ready for pickup",
+    "complete"
+}
+
 def getRequestKeywords(data):
     """
     Parse and sanitize a dict of keywords to be used in filtering the
@@ -484,4 +501,83 @@ def getRequestKeywords(data):
         if myStatuses:
             myFilter['$and'].append({'$or': myStatuses})
 
-    return myFilter
\ No newline at end of file
+    return myFilter
+
+def encodePageToken(sortBy, order, doc):
+    """
+    Build the opaque continuation token for keyset pagination. The token
+    holds the sort key and the _id of the last document of a page, which
+    is where the next page starts.
+
+    :param sortBy: (str). The key the documents are sorted by.
+    :param order: (str). 'ascending' or 'descending'.
+    :param doc: (dict). The last document of the page.
+    :return: (str). The token.
+    """
+    token = json.dumps({
+        'sortBy': sortBy,
+        'order': order,
+        'value': doc.get(sortBy),
+        '_id': str(doc['_id'])
+    })
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+def decodePageToken(pageToken, sortBy, order):
+    """
+    Parse a continuation token made by encodePageToken. The token must be
+    for the same sort key and order as the current call.
+
+    :param pageToken: (str). The token.
+    :param sortBy: (str). The key the documents are sorted by.
+    :param order: (str). 'ascending' or 'descending'.
+    :return: tuple of the sort key value and ObjectId of the last document
+    """
+    try:
+        token = json.loads(base64.urlsafe_b64decode(pageToken.encode('ascii')).decode('utf-8'))
+        value, myID = token['value'], token['_id']
+        tokenSortBy, tokenOrder = token['sortBy'], token['order']
+    except (ValueError, TypeError, KeyError, AttributeError, UnicodeError):
+        raise cherrypy.HTTPError(400, 'Invalid pageToken')
+
+    if tokenSortBy != sortBy or tokenOrder != order:
+        raise cherrypy.HTTPError(400, 'pageToken was made for a different sortBy or order')
+    if not ObjectId.is_valid(myID):
+        raise cherrypy.HTTPError(400, 'Invalid pageToken')
+
+    return value, ObjectId(myID)
+
+def getKeysetFilter(myFilter, sortBy, order, pageToken):
+    """
+    Add to a filter so that it only finds the documents after the one
+    a continuation token was made from, in the order of (sortBy, _id).
+
+    Documents missing sortBy sort before all others, like MongoDB sorts
+    them. The documents are assumed to store one type in sortBy.
+
+    :param myFilter: (dict). The filter of the query.
+    :param sortBy: (str). The key the documents are sorted by.
+    :param order: (str). 'ascending' or 'descending'.
+    :param pageToken: (str). The token, or None for the first page.
+    :return: the new filter
+    """
+    if pageToken is None:
+        return myFilter
+
+    value, myID = decodePageToken(pageToken, sortBy, order)
+
+    if order == 'ascending':
+        if value is None:
+            after = [{sortBy: None, '_id': {'$gt': myID}},
+                     {sortBy: {'$ne': None}}]
+        else:
+            after = [{sortBy: {'$gt': value}},
+                     {sortBy: value, '_id': {'$gt': myID}}]
+    else:
+        if value is None:
+            after = [{sortBy: None, '_id': {'$lt': myID}}]
+        else:
+            after = [{sortBy: {'$lt': value}},
+                     {sortBy: value, '_id': {'$lt': myID}},
+                     {sortBy: None}]
+
+    return {'$and': [myFilter, {'$or': after}]}
@@ -27,7 +27,7 @@ app.controller('AddProjectsCtrl', ['$scope', '$location', '$http', '$window', 'd
         }
 
         if(validateRequest()) {
-            $http.post('/projectAdd', {'projectNumber':Number($scope.projectInfo.projectNumber), 'sponsorName':$scope.projectInfo.sponsorName, 'projectName':$scope.projectInfo.projectName, 'membersEmails':$scope.membersEmails, 'defaultBudget':$scope.projectInfo.defaultBudget, 'availableBudget':$scope.projectInfo.defaultBudget, 'pendingBudget':$scope.projectInfo.defaultBudget}).then(function(resp) {
+            $http.post('/projectAdd', {'projectNumber':Number($scope.projectInfo.projectNumber), 'sponsorName':$scope.projectInfo.sponsorName, 'projectName':$scope.projectInfo.projectName, 'membersEmails':$scope.membersEmails, 'defaultBudget':$scope.projectInfo.defaultBudget}).then(function(resp) {
                 alert("Success");
             }, function(err) {
                 console.error("Error", err.data);
@@ -80,13 +80,14 @@ app.controller('EditProjectsCtrl', ['$scope', '$location', '$http', 'dispatcher'
     };
 
     $scope.changePage = function(pageNumber) {
-        $http.post('/projectData', {
+        $http.post('/projectQuery', {
             'sortBy': $scope.sortTableBy,
             'order':$scope.orderTableBy,
             'pageNumber': pageNumber-1,
             'keywordSearch': $scope.keywordSearch
         }).then(function(resp) {
-            $scope.projects = cleanData(resp.data);
+            $scope.projects = cleanData(resp.data.results);
+            $scope.numberOfPages = resp.data.pages;
             $scope.pageNumber = pageNumber;
             $scope.updatePageNumberArray();
         }, function(err) {
@@ -119,7 +120,6 @@ app.controller('EditProjectsCtrl', ['$scope', '$location', '$http', 'dispatcher'
             $scope.keywordSearch.defaultBudget = String($scope.keywordSearch.defaultBudget);
         }
 
-        $scope.repage();
         $scope.changePage($scope.pageNumber);
     }
 
@@ -134,15 +134,6 @@ app.controller('EditProjectsCtrl', ['$scope', '$location', '$http', 'dispatcher'
         }
     }
 
-    $scope.repage = function() {
-        $http.post('/projectPages', $scope.keywordSearch).then(function(resp) {
-            $scope.numberOfPages = resp.data;
-            $scope.updatePageNumberArray();
-        }, function(err) {
-            console.error("Error", err.data);
-        });
-    }
-
     $scope.toggleSort = function(keyword) {
         if (keyword == $scope.sortTableBy) {
             if($scope.orderTableBy == 'ascending') {
@@ -157,7 +148,6 @@ app.controller('EditProjectsCtrl', ['$scope', '$location', '$http', 'dispatcher'
         $scope.requery();
     }
 
-    $scope.repage();
     $scope.changePage(1);
 
     dispatcher.on('bulkProjectEnd', function() {
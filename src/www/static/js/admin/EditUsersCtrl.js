@@ -64,13 +64,14 @@ app.controller('EditUsersCtrl', ['$scope', '$location', '$http', 'dispatcher', f
             $scope.keywordSearch.role = undefined;
         }
 
-        $http.post('/userData', {
+        $http.post('/userQuery', {
             'sortBy': $scope.sortTableBy,
             'order':$scope.orderTableBy,
             'pageNumber': pageNumber-1,
             'keywordSearch': $scope.keywordSearch
         }).then(function(resp) {
-            $scope.users = resp.data;
+            $scope.users = resp.data.results;
+            $scope.numberOfPages = resp.data.pages;
             $scope.pageNumber = pageNumber;
             $scope.updatePageNumberArray();
         }, function(err) {
@@ -99,7 +100,6 @@ app.controller('EditUsersCtrl', ['$scope', '$location', '$http', 'dispatcher', f
     }
 
     $scope.requery = function() {
-        $scope.repage();
         $scope.changePage($scope.pageNumber);
     }
 
@@ -114,21 +114,6 @@ app.controller('EditUsersCtrl', ['$scope', '$location', '$http', 'dispatcher', f
         }
     }
 
-    $scope.repage = function() {
-        if (!($scope.keywordSearch.role == 'student' ||
-              $scope.keywordSearch.role == 'manager' ||
-              $scope.keywordSearch.role == 'admin')) {
-            $scope.keywordSearch.role = undefined;
-        }
-
-        $http.post('/userPages', $scope.keywordSearch).then(function(resp) {
-            $scope.numberOfPages = resp.data;
-            $scope.updatePageNumberArray();
-        }, function(err) {
-            console.error("Error", err.data);
-        });
-    }
-
     $scope.toggleSort = function(keyword) {
         if (keyword == $scope.sortTableBy) {
             if($scope.orderTableBy == 'ascending') {
@@ -158,7 +143,6 @@ app.controller('EditUsersCtrl', ['$scope', '$location', '$http', 'dispatcher', f
         return numList;
     }
 
-    $scope.repage();
     $scope.changePage(1);
 
 
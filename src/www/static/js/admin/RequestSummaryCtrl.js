@@ -133,15 +133,44 @@ app.controller('RequestSummaryCtrl', ['$scope', '$location', '$http', '$timeout'
         $("#rejectModal").hide();
     };
 
-    $scope.setShipping = function(e) {
-        $http.post('/procurementOrder', {'_id':$scope.data[shippingRow]._id, "amount":$("#shippingAmt").val()}).then(function(resp) {
-            alert("Success!");
+    // _id -> true for the requests checked in the table
+    $scope.selected = {};
+
+    function selectedIDs() {
+        return Object.keys($scope.selected).filter(function(id) { return $scope.selected[id]; });
+    }
+
+    $scope.selectedCount = function() {
+        return selectedIDs().length;
+    };
+
+    // change the status of many requests with one call. Requests that
+    // aren't in the status before the new one are skipped.
+    function transitionRequests(ids, status, amounts) {
+        return $http.post('/procurementTransitionBulk', {'_ids': ids, 'status': status, 'amounts': amounts || {}}).then(function(resp) {
+            if (resp.data.skipped.length > 0) {
+                alert("Updated " + resp.data.updated.length + " request(s). Skipped " + resp.data.skipped.length + " request(s) not in the right status.");
+            } else {
+                alert("Success!");
+            }
             $scope.requery();
-            $scope.cancelShippingBox();
         }, function(err) {
             console.error("Error", err.data);
             alert("Error");
             $scope.requery();
+        });
+    }
+
+    $scope.transitionSelected = function(status) {
+        transitionRequests(selectedIDs(), status).then(function() {
+            $scope.selected = {};
+        });
+    };
+
+    $scope.setShipping = function(e) {
+        var amounts = {};
+        amounts[$scope.data[shippingRow]._id] = $("#shippingAmt").val();
+        transitionRequests([$scope.data[shippingRow]._id], 'ordered', amounts).then(function() {
             $scope.cancelShippingBox();
         });
     }
@@ -157,25 +186,11 @@ app.controller('RequestSummaryCtrl', ['$scope', '$location', '$http', '$timeout'
     };
 
     $scope.readyRequest = function(e, rowIdx) {
-        $http.post('/procurementReady', {'_id':$scope.data[rowIdx]._id}).then(function(resp) {
-            alert("Success!");
-            $scope.requery();
-        }, function(err) {
-            console.error("Error", err.data)
-            alert("Error");
-            $scope.requery();
-        });
+        transitionRequests([$scope.data[rowIdx]._id], 'ready for pickup');
     };
 
     $scope.completeRequest = function(e, rowIdx) {
-        $http.post('/procurementComplete', {'_id':$scope.data[rowIdx]._id}).then(function(resp) {
-            alert("Success!");
-            $scope.requery();
-        }, function(err) {
-            console.error("Error", err.data);
-            alert("Error");
-            $scope.requery();
-        });
+        transitionRequests([$scope.data[rowIdx]._id], 'complete');
     };
 
     $scope.canOrder = function(status) {
@@ -225,7 +240,7 @@ app.controller('RequestSummaryCtrl', ['$scope', '$location', '$http', '$timeout'
     // ALL PAGE RELATED FUNCTIONS BELOW HERE
 
     $scope.changePage = function(pageNumber) {
-        $http.post('/requestData', {
+        $http.post('/requestQuery', {
             'sortBy': $scope.sortTableBy,
             'order':$scope.orderTableBy,
             'pageNumber': pageNumber-1,
@@ -233,7 +248,8 @@ app.controller('RequestSummaryCtrl', ['$scope', '$location', '$http', '$timeout'
             'secondaryFilter': $scope.secondaryFilter,
             'statusFilter': $scope.selectedStatuses
         }).then(function(resp) {
-            $scope.data = cleanData(resp.data);
+            $scope.data = cleanData(resp.data.results);
+            $scope.numberOfPages = resp.data.pages;
             $scope.pageNumber = pageNumber;
             $scope.updatePageNumberArray();
         }, function(err) {
@@ -262,7 +278,6 @@ app.controller('RequestSummaryCtrl', ['$scope', '$location', '$http', '$timeout'
     }
 
     $scope.requery = function() {
-        $scope.repage();
         $scope.changePage($scope.pageNumber);
     }
 
@@ -277,18 +292,6 @@ app.controller('RequestSummaryCtrl', ['$scope', '$location', '$http', '$timeout'
         }
     }
 
-    $scope.repage = function() {
-        $http.post('/requestPages', {
-            primaryFilter: $scope.primaryFilter,
-            secondaryFilter: $scope.secondaryFilter
-        }).then(function(resp) {
-            $scope.numberOfPages = resp.data;
-            $scope.updatePageNumberArray();
-        }, function(err) {
-            console.error("Error", err.data);
-        });
-    }
-
     $scope.toggleSort = function(keyword) {
         if (keyword == $scope.sortTableBy) {
             if($scope.orderTableBy == 'ascending') {
@@ -303,7 +306,6 @@ app.controller('RequestSummaryCtrl', ['$scope', '$location', '$http', '$timeout'
         $scope.requery();
     }
 
-    $scope.repage();
     $scope.changePage(1);
     dispatcher.on("refreshStatuses", $scope.requery);
 
@@ -61,7 +61,8 @@ app.controller('StudentBudgetCtrl', ['$scope', '$location', '$http', '$window',
 
     $scope.getData = function() {
         var filterData = {"projectNumbers": [$scope.projects[currentProj]["number"]]};
-        $http.post('/procurementStatuses', filterData).then(function(resp) {
+        // the budget table only shows the summary of each request
+        $http.post('/procurementStatuses', angular.extend({"summary": true}, filterData)).then(function(resp) {
             procurementData = resp.data;
             filterRequests();
         }, function(err) {